@@ -5,10 +5,17 @@ from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, System
 from chat_config import *
 from db import *
 
-def chat(chat_history: list[BaseMessage], model: BaseChatModel, stream: bool) -> list[MessageData]:
+def format_message(message: BaseMessage) -> str | None:
+    if isinstance(message, HumanMessage):
+        return f'  User: {message.content}\n\n'
+    elif isinstance(message, AIMessage):
+        return f'  AI: {message.content}\n\n'
+    return None
+
+def chat(chat_history: list[BaseMessage], model: BaseChatModel, stream: bool, pager: TranscriptPager | None) -> list[MessageData]:
     new_messages: list[MessageData] = []
 
-    user_input = input('  User ("quit" to exit): ')
+    user_input = read_input('  User ("quit" to exit): ', pager)
     while user_input != 'quit' and user_input != 'exit':
         print()
         chat_history.append(HumanMessage(content=user_input))
@@ -28,7 +35,7 @@ def chat(chat_history: list[BaseMessage], model: BaseChatModel, stream: bool) ->
         chat_history.append(AIMessage(content=ai_response))
         new_messages.append(MessageData(datetime.datetime.now(), 'assistant', ai_response))
 
-        user_input = input('  User ("quit" to exit): ')
+        user_input = read_input('  User ("quit" to exit): ', pager)
     return new_messages
 
 
@@ -43,12 +50,13 @@ def main():
     else:
         print('Streaming mode disabled.\n')
 
-    chat_id: str = args.chatid
+    chat_id: str | None = resolve_chat_id(conn, args.chatid)
     chat_history: list[BaseMessage] = []
     new_messages: list[MessageData] = []
+    pager: TranscriptPager | None = None
 
-    if args.chatid:
-        chat_history = fetch_history(conn, chat_id)
+    if chat_id:
+        chat_history, _ = fetch_history(conn, chat_id)
 
     if len(chat_history) == 0:
         chat_id = create_new_chat(conn)
@@ -59,12 +67,10 @@ def main():
     else:
         print(f'Chat ID: {chat_id}')
         print(f'Chat history:')
-        for i in range(len(chat_history)):
-            if i == 0: continue
-            speaker = 'User' if i % 2 == 1 else 'AI'
-            print(f'  {speaker}: {chat_history[i].content}\n')
+        pager = TranscriptPager(chat_history, args.last_turns, format_message)
+        pager.show_last()
 
-    new_messages.extend(chat(chat_history, model, args.stream))
+    new_messages.extend(chat(chat_history, model, args.stream, pager))
     for message in new_messages:
         save_message(conn, chat_id, message[0], message[1], message[2])
 
@@ -8,11 +8,12 @@ from db import *
 
 
 class ChatHistory(BaseChatMessageHistory):
-    def __init__(self, chat_id: str, conn: sqlite3.Connection):
+    def __init__(self, chat_id: str | None, conn: sqlite3.Connection, last_turns: int = 3):
         self.chat_id: str = chat_id
         self.conn: sqlite3.Connection = conn
-        self.messages: list[BaseMessage] = fetch_history(self.conn, self.chat_id)
+        self.messages: list[BaseMessage] = fetch_history(self.conn, self.chat_id)[0] if chat_id else []
         self.new_messages: list[MessageData] = []
+        self.pager = TranscriptPager(self.messages, last_turns, format_message)
 
         if len(self.messages) == 0:
             self.chat_id = create_new_chat(conn)
@@ -20,10 +21,7 @@ class ChatHistory(BaseChatMessageHistory):
             self.add_message(SystemMessage(content='You are a helpful assistant.'))
         else:
             print(f'Chat ID: {self.chat_id}\n')
-            for i in range(len(self.messages)):
-                if i == 0: continue
-                print(f'  {"User" if i % 2 == 1 else "AI"}: {self.messages[i].content}\n')
-
+            self.pager.show_last()
 
     def add_message(self, message: BaseMessage) -> None:
         self.messages.append(message)
@@ -38,8 +36,15 @@ class ChatHistory(BaseChatMessageHistory):
         self.new_messages = []
 
 
+def format_message(message: BaseMessage) -> str | None:
+    if isinstance(message, HumanMessage):
+        return f'  User: {message.content}\n\n'
+    elif isinstance(message, AIMessage):
+        return f'  AI: {message.content}\n\n'
+    return None
+
 def chat(chat_history: ChatHistory, chain: Runnable, stream: bool) -> None:
-    user_input = input('  User ("quit" to exit): ')
+    user_input = read_input('  User ("quit" to exit): ', chat_history.pager)
     print(flush=True)
     while user_input != 'quit' and user_input != 'exit':
         ai_response: str = ''
@@ -54,7 +59,7 @@ def chat(chat_history: ChatHistory, chain: Runnable, stream: bool) -> None:
             print(f'  AI: {output_message.content}\n')
             ai_response = str(output_message.content)
 
-        user_input = input('  User ("quit" to exit): ')
+        user_input = read_input('  User ("quit" to exit): ', chat_history.pager)
 
 
 def main():
@@ -73,7 +78,7 @@ def main():
         lambda chat_id: chat_history if chat_id == chat_history.chat_id else ChatHistory(chat_id, conn)
     )
 
-    chat_history = ChatHistory(args.chatid, conn)
+    chat_history = ChatHistory(resolve_chat_id(conn, args.chatid), conn, args.last_turns)
     chat(chat_history, chain, args.stream)
     chat_history.save_messages()
 
@@ -4,7 +4,7 @@ from langchain_core.runnables import Runnable, RunnableWithMessageHistory
 
 from chat_config import *
 from chat_history import ChatHistory
-from db import init_db
+from db import init_db, resolve_chat_id
 
 
 def query_llm(input: str, chat_history: ChatHistory, chain: Runnable) -> list[ToolCall]:
@@ -40,7 +40,7 @@ def query_llm_stream(input: str, chat_history: ChatHistory, chain: Runnable) ->
 
 
 def chat(chat_history: ChatHistory, chain: Runnable, stream: bool) -> None:
-    user_input = input(f'{text_colors["green2"]}User ("quit" to exit): ')
+    user_input = read_input(f'{text_colors["green2"]}User ("quit" to exit): ', chat_history.pager)
     print(flush=True)
     while user_input != 'quit' and user_input != 'exit':
         agent_loop_count = 0
@@ -57,7 +57,7 @@ def chat(chat_history: ChatHistory, chain: Runnable, stream: bool) -> None:
             query_input = ''
             agent_loop_count += 1
 
-        user_input = input(f'{text_colors["green2"]}User: ')
+        user_input = read_input(f'{text_colors["green2"]}User: ', chat_history.pager)
         print()
 
 
@@ -66,7 +66,7 @@ def main():
     args = get_arguments()
     conn = init_db()
 
-    model = get_chat_model(args.vendor).bind_tools([web_search])
+    model = bind_tools(get_chat_model(args.vendor), [web_search])
 
     if args.stream:
         print('Using streaming mode.\n')
@@ -78,7 +78,7 @@ def main():
         lambda chat_id: chat_history if chat_id == chat_history.chat_id else ChatHistory(chat_id, conn)
     )
 
-    chat_history = ChatHistory(args.chatid, conn)
+    chat_history = ChatHistory(resolve_chat_id(conn, args.chatid), conn, args.last_turns)
     chat(chat_history, chain, args.stream)
     chat_history.save_messages()
 
@@ -4,26 +4,27 @@ from langgraph.graph.graph import CompiledGraph
 
 from chat_config import *
 from chat_history import ChatHistory
-from db import init_db
+from cancellation import run_cancellable
+from db import init_db, resolve_chat_id
+from tracing import create_tracer, trace_turn
+from workload import create_recorder
 
 
 def query_llm(agent: CompiledGraph, chat_history: ChatHistory) -> None:
-    result = agent.invoke({'messages': chat_history.messages})
-
-    message_count = len(chat_history.messages)
-    new_messages = (result.get('messages', []))[message_count:]
-
     print(text_colors['blue2'], end='', flush=True)
-    for message in new_messages:
-        if isinstance(message, AIMessage):
-            if message.tool_calls:
-                print(text_colors['violet2'], end='')
-                for tool_call in message.tool_calls:
-                    print(f'Search tool call: {tool_call["args"]["search_input"]}\n', flush=True)
-            if message.content:
-                print(f'{text_colors["blue2"]}{message.content}\n', flush=True)
+    # The messages of each step are kept as soon as it finishes, so a cancelled turn keeps its completed steps.
+    for update in agent.stream({'messages': chat_history.messages}, stream_mode='updates'):
+        for node_update in update.values():
+            for message in (node_update or {}).get('messages', []):
+                if isinstance(message, AIMessage):
+                    if message.tool_calls:
+                        print(text_colors['violet2'], end='')
+                        for tool_call in message.tool_calls:
+                            print(f'Search tool call: {tool_call["args"]["search_input"]}\n', flush=True)
+                    if message.content:
+                        print(f'{text_colors["blue2"]}{message.content}\n', flush=True)
 
-        chat_history.add_message(message)
+                chat_history.add_message(message)
 
 
 def query_llm_stream(agent: CompiledGraph, chat_history: ChatHistory) -> None:
@@ -67,14 +68,19 @@ def query_llm_stream(agent: CompiledGraph, chat_history: ChatHistory) -> None:
 
 
 def chat(agent: CompiledGraph, chat_history: ChatHistory, stream: bool) -> None:
-    user_input = input(f'{text_colors["green2"]}User ("quit" to exit): ')
+    user_input = read_input(f'{text_colors["green2"]}User ("quit" to exit): ', chat_history.pager)
     print()
     while user_input != 'quit' and user_input != 'exit':
         chat_history.add_message(HumanMessage(content=user_input))
 
-        query_llm_stream(agent, chat_history) if stream else query_llm(agent, chat_history)
+        # Ctrl-C cancels the turn and returns to the prompt.
+        with trace_turn(chat_history.chat_id, user_input):
+            completed, _ = run_cancellable(lambda: query_llm_stream(agent, chat_history) if stream else query_llm(agent, chat_history))
+        if not completed:
+            chat_history.end_cancelled_turn()
+            print(f'\n{text_colors["yellow2"]}Turn cancelled, its completed messages were saved.\n', flush=True)
 
-        user_input = input(f'{text_colors["green2"]}User: ')
+        user_input = read_input(f'{text_colors["green2"]}User: ', chat_history.pager)
         print()
 
 
@@ -82,14 +88,15 @@ def main():
     load_dotenv()
     args = get_arguments()
     conn = init_db()
+    create_recorder(args.record) if args.record else create_tracer(args.trace)
 
     if args.stream:
         print('Using streaming mode.\n')
     else:
         print('Streaming mode disabled.\n')
 
-    agent = create_agent(args.vendor, [web_search])
-    chat_history = ChatHistory(args.chatid, conn)
+    agent = create_agent(get_chat_model(args.vendor), [web_search])
+    chat_history = ChatHistory(resolve_chat_id(conn, args.chatid), conn, args.last_turns)
 
     chat(agent, chat_history, args.stream)
     chat_history.save_messages()
@@ -97,4 +104,5 @@ def main():
     conn.close()
 
 
-main()
+if __name__ == '__main__':
+    main()
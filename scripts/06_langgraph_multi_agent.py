@@ -1,31 +1,55 @@
 from dotenv import load_dotenv
 from langchain_core.messages import AIMessageChunk, ToolMessageChunk, ToolCall
 from langchain_core.runnables import Runnable
+from typing import Callable
 
 from chat_config import *
 from chat_history import ChatHistory
-from db import init_db
+from cancellation import run_cancellable
+from db import init_db, resolve_chat_id
+from llm_cache import create_response_cache
+from tracing import create_tracer, trace_turn
+from workload import create_recorder
 
 
-def create_agent_call_tool(agent: CompiledGraph, agent_name: str, description: str | None = None) -> BaseTool:
+TokenConsumer = Callable[[str, str], None]
+
+
+def create_agent_call_tool(agent: CompiledGraph, agent_name: str, description: str | None = None, on_token: TokenConsumer | None = None) -> BaseTool:
     name = f'transfer_to_{agent_name}'
     description = description or f'Delegate task to the {agent_name}.'
 
     @tool(name, description=description)
     def call_tool(query: str) -> str:
-        response = agent.invoke({'messages': [HumanMessage(content=query)]})
+        agent_input = {'messages': [HumanMessage(content=query)]}
+        if on_token is None:
+            response = agent.invoke(agent_input)
+        else:
+            # Forwards the sub-agent tokens as they are generated, instead of waiting for its final message.
+            response = {}
+            for mode, data in agent.stream(agent_input, stream_mode=['messages', 'values']):
+                if mode == 'values':
+                    response = data
+                    continue
+                chunk, metadata = data
+                if isinstance(chunk, AIMessageChunk) and chunk.content and metadata.get('langgraph_node') == 'agent':
+                    on_token(agent_name, str(chunk.content))
+
         message: BaseMessage = response['messages'][-1]
         return str(message.content)
 
     return call_tool
 
 
-def create_agents(vendor: str) -> tuple[Runnable, dict[str, BaseTool]]:
-    llm_model = get_chat_model(vendor)
+def print_token(agent_name: str, token: str) -> None:
+    print(f'{text_colors["cyan"]}{token}', end='', flush=True)
+
 
-    research_agent = create_react_agent(
+def create_agents(models: ChatModels, on_token: TokenConsumer | None = None) -> tuple[Runnable, dict[str, BaseTool]]:
+
+    research_agent = create_agent(
         name='research_agent',
-        model=llm_model,
+        model=model_for(models, 'research_agent'),
         tools=[web_search],
         prompt=(
             'You are a research agent. You only perform web research tasks, using the web_search tool.\n'
@@ -33,18 +57,18 @@ def create_agents(vendor: str) -> tuple[Runnable, dict[str, BaseTool]]:
             'Do not include extra text in the search results.'
         )
     )
-    calculator_agent = create_react_agent(
+    calculator_agent = create_agent(
         name='calculator_agent',
-        model=llm_model,
+        model=model_for(models, 'calculator_agent'),
         tools=[add, subtract, multiply],
         prompt=(
             'You are a calculator agent. Do only sum, subtraction and multiplication, and nothing else.\n'
             'Respond directly to the supervisor, and do not include any text other than the task results.'
         )
     )
-    writer_agent = create_react_agent(
+    writer_agent = create_agent(
         name='writer_agent',
-        model=llm_model,
+        model=model_for(models, 'writer_agent'),
         tools=[],
         prompt=(
             'You are a writer agent. You should only generate text for the response.\n'
@@ -55,20 +79,23 @@ def create_agents(vendor: str) -> tuple[Runnable, dict[str, BaseTool]]:
     call_research_agent = create_agent_call_tool(
         research_agent,
         agent_name='research_agent',
-        description='Assign task to the research agent.'
+        description='Assign task to the research agent.',
+        on_token=on_token
     )
     call_calculator_agent = create_agent_call_tool(
         calculator_agent,
         agent_name='calculator_agent',
-        description='Assing task to the calculator agent. Assign all math operations to the calculator agent, always.'
+        description='Assing task to the calculator agent. Assign all math operations to the calculator agent, always.',
+        on_token=on_token
     )
     call_writer_agent = create_agent_call_tool(
         writer_agent,
         agent_name='writer_agent',
-        description='Assing task to the writer agent. Always use the writer agent to write the responses.'
+        description='Assing task to the writer agent. Always use the writer agent to write the responses.',
+        on_token=on_token
     )
 
-    supervisor_runnable = llm_model.bind_tools([call_research_agent, call_calculator_agent, call_writer_agent])
+    supervisor_runnable = bind_tools(model_for(models, 'supervisor'), [call_research_agent, call_calculator_agent, call_writer_agent])
     return supervisor_runnable, {
         'transfer_to_research_agent': call_research_agent,
         'transfer_to_calculator_agent': call_calculator_agent,
@@ -117,24 +144,33 @@ def query_llm_stream(chat_history: ChatHistory, chain: Runnable) -> list[ToolCal
     return tool_calls
 
 
+def run_turn(chat_history: ChatHistory, chain: Runnable, subagent_calls: dict[str, BaseTool], stream: bool) -> None:
+    agent_loop_count = 0
+    while agent_loop_count < 5:
+        tool_calls = query_llm_stream(chat_history, chain) if stream else query_llm(chat_history, chain)
+        if len(tool_calls) == 0: break
+
+        for tool_call in tool_calls:
+            print(f'{text_colors["violet2"]}Tool call: {tool_call["name"]}\n')
+            selected_tool = subagent_calls[tool_call['name']]
+            tool_response: ToolMessage = selected_tool.invoke(tool_call)
+            chat_history.add_message(tool_response)
+            if stream: print('\n')
+        agent_loop_count += 1
+
 def chat(chat_history: ChatHistory, chain: Runnable, subagent_calls: dict[str, BaseTool], stream: bool) -> None:
-    user_input = input(f'\n{text_colors["green2"]}User ("quit" to exit): ')
+    user_input = read_input(f'\n{text_colors["green2"]}User ("quit" to exit): ', chat_history.pager)
     print(flush=True)
     while user_input != 'quit' and user_input != 'exit':
         chat_history.add_message(HumanMessage(content=user_input))
-        agent_loop_count = 0
-        while agent_loop_count < 5:
-            tool_calls = query_llm_stream(chat_history, chain) if stream else query_llm(chat_history, chain)
-            if len(tool_calls) == 0: break
-
-            for tool_call in tool_calls:
-                print(f'{text_colors["violet2"]}Tool call: {tool_call["name"]}\n')
-                selected_tool = subagent_calls[tool_call['name']]
-                tool_response: ToolMessage = selected_tool.invoke(tool_call)
-                chat_history.add_message(tool_response)
-            agent_loop_count += 1
-
-        user_input = input(f'{text_colors["green2"]}User: ')
+        # Ctrl-C cancels the turn and returns to the prompt.
+        with trace_turn(chat_history.chat_id, user_input):
+            completed, _ = run_cancellable(lambda: run_turn(chat_history, chain, subagent_calls, stream))
+        if not completed:
+            chat_history.end_cancelled_turn()
+            print(f'\n{text_colors["yellow2"]}Turn cancelled, its completed messages were saved.\n', flush=True)
+
+        user_input = read_input(f'{text_colors["green2"]}User: ', chat_history.pager)
         print()
 
 
@@ -142,20 +178,27 @@ def main():
     load_dotenv()
     args = get_arguments()
     conn = init_db()
+    create_recorder(args.record) if args.record else create_tracer(args.trace)
+    llm_cache = create_response_cache(args.llm_cache)
 
     if args.stream:
         print('Using streaming mode.\n')
     else:
         print('Streaming mode disabled.\n')
 
-    chat_history = ChatHistory(args.chatid, conn)
+    chat_history = ChatHistory(resolve_chat_id(conn, args.chatid), conn, args.last_turns)
 
-    supervisor, subagent_calls = create_agents(args.vendor)
+    supervisor, subagent_calls = create_agents(get_chat_models(args.vendor, args.tiers), print_token if args.stream else None)
 
     chat(chat_history, supervisor, subagent_calls, args.stream)
     chat_history.save_messages()
 
+    if llm_cache is not None:
+        print(f'{text_colors["gray"]}LLM cache: {llm_cache.stats()}')
+        llm_cache.close()
+
     conn.close()
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -1,76 +1,86 @@
 from dotenv import load_dotenv
 from enum import Enum
-from langgraph.graph import StateGraph, START
+from langgraph.graph import END, StateGraph, START
 from langgraph.graph.state import CompiledStateGraph
 from pydantic import BaseModel, Field
 
 from chat_config import *
+from budget import ExecutionBudget, create_agent_edge, turn_budget
+from cancellation import run_cancellable
 from chat_history import ChatHistory
-from db import init_db
+from db import init_db, resolve_chat_id
+from llm_cache import create_response_cache
+from tracing import create_tracer, trace_turn
+from views import MessageView, scoped_prompt
+from workload import create_recorder
 
 
-def create_agents(model: BaseChatModel) -> list[CompiledGraph]:
+def create_agents(models: ChatModels) -> list[CompiledGraph]:
     agents: list[CompiledGraph] = []
 
     assign_to_research_agent = create_handoff_tool(agent_name='research_agent', description='Assign task to the research agent.')
     assign_to_calculator_agent = create_handoff_tool(agent_name='calculator_agent', description='Assign task to the calculator agent.')
     assign_to_writer_agent = create_handoff_tool(agent_name='writer_agent', description='Assign task to the writer agent.')
 
-    agents.append(create_react_agent(
+    agents.append(create_agent(
         name='research_agent',
-        model=model,
+        model=model_for(models, 'research_agent'),
         tools=[web_search],
-        prompt=(
+        prompt=scoped_prompt('research_agent', MessageView(history_turns=1), (
             'You are a research agent. You only perform web research tasks, using the web_search tool.\n'
             'As soon as you finish the search, you return to your supervisor the search results.\n'
             'Do not include extra text in the search results.'
-        )
+        ))
     ))
-    agents.append(create_react_agent(
+    agents.append(create_agent(
         name='calculator_agent',
-        model=model,
+        model=model_for(models, 'calculator_agent'),
         tools=[add, subtract, multiply],
-        prompt=(
+        prompt=scoped_prompt('calculator_agent', MessageView(history_turns=1), (
             'You are a calculator agent. Do only sum, subtraction and multiplication, and nothing else.\n'
-            'Respond directly to your supervisor, and do not include any text other than the task results.'
-        )
+            'Your response is sent to the user as the answer, so do not include any text other than the task results.'
+        ))
     ))
-    agents.append(create_react_agent(
+    agents.append(create_agent(
         name='writer_agent',
-        model=model,
+        model=model_for(models, 'writer_agent'),
         tools=[],
-        prompt=(
+        prompt=scoped_prompt('writer_agent', MessageView(history_turns=2, agents=('research_agent',)), (
             'You are a writer agent. You should only generate text for the response.\n'
-            'Respond directly to your supervisor.'
-        )
+            'Your response is sent to the user as the answer.'
+        ))
     ))
-    agents.append(create_react_agent(
+    agents.append(create_agent(
         name='research_supervisor',
-        model=model,
+        model=model_for(models, 'research_supervisor'),
         tools=[assign_to_research_agent, assign_to_writer_agent],
-        prompt=(
+        prompt=scoped_prompt('research_supervisor', MessageView(history_turns=2, agents=None), (
             'You are a supervisor managing two agents:\n'
             '- A research agent. Assign research related tasks to this agent.\n'
             '- A writer agent. Assign text generation tasks to this agent.\n'
             'Assign work to one agent at a time, do not call agents in parallel.\n'
             'Do not do any work yourself.\n'
             'Never write the responses to the user messages, assign the writer agent to do that, always.'
-        )
+        ))
     ))
-    agents.append(create_react_agent(
+    agents.append(create_agent(
         name='calculator_supervisor',
-        model=model,
+        model=model_for(models, 'calculator_supervisor'),
         tools=[assign_to_calculator_agent],
-        prompt=(
+        prompt=scoped_prompt('calculator_supervisor', MessageView(history_turns=2, agents=None), (
             'You are a supervisor managing one agent:\n'
             '- A calculator agent. Assign math tasks to this agent.\n'
             'Do not do any math work yourself.'
-        )
+        ))
     ))
 
     return agents
 
 
+# Agents whose messages answer the user directly, ending the turn.
+ANSWERING_AGENTS: set[str] = {'writer_agent', 'calculator_agent'}
+
+
 class ChatbotSystems(Enum):
     RESEARCH = 'research_supervisor'
     MATH = 'calculator_supervisor'
@@ -99,9 +109,9 @@ def create_router(model: BaseChatModel):
     return router
 
 
-def build_graph(model: BaseChatModel) -> CompiledStateGraph:
-    agents = create_agents(model)
-    router = create_router(model)
+def build_graph(models: ChatModels) -> CompiledStateGraph:
+    agents = create_agents(models)
+    router = create_router(model_for(models, 'router'))
 
     graph = StateGraph(GraphState)
 
@@ -109,49 +119,52 @@ def build_graph(model: BaseChatModel) -> CompiledStateGraph:
         graph.add_node(agent)
 
     graph.add_conditional_edges(START, router)
-    graph.add_edge('research_agent', 'research_supervisor')
-    graph.add_edge('writer_agent', 'research_supervisor')
-    graph.add_edge('calculator_agent', 'calculator_supervisor')
+    graph.add_conditional_edges('research_agent', create_agent_edge('research_supervisor', final_answer=False), ['research_supervisor', END])
+    graph.add_conditional_edges('writer_agent', create_agent_edge('research_supervisor', final_answer=True), ['research_supervisor', END])
+    graph.add_conditional_edges('calculator_agent', create_agent_edge('calculator_supervisor', final_answer=True), ['calculator_supervisor', END])
 
     return graph.compile()
 
 
 def query_llm(graph: CompiledStateGraph, chat_history: ChatHistory) -> None:
-    output = graph.invoke({'messages': chat_history.messages})
-    new_messages = output['messages'][len(chat_history.messages):]
-    for m in new_messages:
-        if isinstance(m, BaseMessage):
-            chat_history.add_message(m)
-            name = str(m.name)
-            if m.content and ('_supervisor' in name or 'transfer_to_' in name or name == 'writer_agent'):
-                print(f'{text_colors["blue2"]}{m.content}\n', flush=True)
+    # The messages of each agent are kept as soon as it finishes, so a cancelled turn keeps its completed steps.
+    for state in graph.stream({'messages': chat_history.messages}, stream_mode='values'):
+        for m in state['messages'][len(chat_history.messages):]:
+            if isinstance(m, BaseMessage):
+                chat_history.add_message(m)
+                name = str(m.name)
+                if m.content and ('_supervisor' in name or 'transfer_to_' in name or name in ANSWERING_AGENTS):
+                    print(f'{text_colors["blue2"]}{m.content}\n', flush=True)
 
 def query_llm_stream(graph: CompiledStateGraph, chat_history: ChatHistory) -> None:
-    for chunk in graph.stream({'messages': chat_history.messages}):
-        new_messages: list[BaseMessage] = chunk.get('research_supervisor', {}).get('messages', [])[len(chat_history.messages):]
-        new_messages.extend(chunk.get('calculator_supervisor', {}).get('messages', [])[len(chat_history.messages):])
-        new_messages.extend(chunk.get('writer_agent', {}).get('messages', [])[len(chat_history.messages):])
-
-        for m in new_messages:
-            if isinstance(m, BaseMessage) and m.content:
+    # The full state is streamed, since handoffs only update the graph with the new messages.
+    for state in graph.stream({'messages': chat_history.messages}, stream_mode='values'):
+        for m in state['messages'][len(chat_history.messages):]:
+            if isinstance(m, BaseMessage):
                 name = str(m.name)
-                if m.content and ('_supervisor' in name or 'transfer_to_' in name or name == 'writer_agent'):
+                if m.content and ('_supervisor' in name or 'transfer_to_' in name or name in ANSWERING_AGENTS):
                     print(f'{text_colors["blue2"]}{m.content}', flush=True)
 
                 chat_history.add_message(m)
     print(flush=True)
 
-def chat(graph: CompiledStateGraph, chat_history: ChatHistory, stream: bool) -> None:
-    user_input = input(f'\n{text_colors["green2"]}User ("quit" to exit): ')
+def chat(graph: CompiledStateGraph, chat_history: ChatHistory, stream: bool, budget: ExecutionBudget) -> None:
+    user_input = read_input(f'\n{text_colors["green2"]}User ("quit" to exit): ', chat_history.pager)
     print(flush=True)
 
     while user_input != 'quit' and user_input != 'exit':
         chat_history.add_message(HumanMessage(content=user_input))
 
         print(text_colors['blue2'], end='', flush=True)
-        query_llm_stream(graph, chat_history) if stream else query_llm(graph, chat_history)
-
-        user_input = input(f'{text_colors["green2"]}User: ')
+        # Ctrl-C cancels the turn and returns to the prompt.
+        with trace_turn(chat_history.chat_id, user_input), turn_budget(budget) as usage:
+            completed, _ = run_cancellable(lambda: query_llm_stream(graph, chat_history) if stream else query_llm(graph, chat_history))
+        if not completed:
+            chat_history.end_cancelled_turn()
+            print(f'\n{text_colors["yellow2"]}Turn cancelled, its completed messages were saved.\n', flush=True)
+        print(f'{text_colors["gray"]}{usage.summary()}\n', flush=True)
+
+        user_input = read_input(f'{text_colors["green2"]}User: ', chat_history.pager)
         print(flush=True)
 
 
@@ -159,21 +172,27 @@ def main():
     load_dotenv()
     args = get_arguments()
     conn = init_db()
+    create_recorder(args.record) if args.record else create_tracer(args.trace)
+    llm_cache = create_response_cache(args.llm_cache)
 
     if args.stream:
         print('Using streaming mode.\n')
     else:
         print('Streaming mode disabled.\n')
 
-    chat_history = ChatHistory(args.chatid, conn)
+    chat_history = ChatHistory(resolve_chat_id(conn, args.chatid), conn, args.last_turns)
 
-    model = get_chat_model(args.vendor)
-    graph = build_graph(model)
+    graph = build_graph(get_chat_models(args.vendor, args.tiers))
 
-    chat(graph, chat_history, args.stream)
+    chat(graph, chat_history, args.stream, ExecutionBudget(args.max_hops, args.max_tokens, args.max_seconds))
     chat_history.save_messages()
 
+    if llm_cache is not None:
+        print(f'{text_colors["gray"]}LLM cache: {llm_cache.stats()}')
+        llm_cache.close()
+
     conn.close()
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -1,82 +1,100 @@
-import base64
-import pickle
+import json
+import uuid
 from dotenv import load_dotenv
 from enum import Enum
-from langgraph.graph import StateGraph, START
+from langgraph.graph import END, StateGraph, START
 from langgraph.graph.state import CompiledStateGraph
+from langgraph.prebuilt.chat_agent_executor import AgentState
 from pydantic import BaseModel, Field
-from typing import Optional
 
 from chat_config import *
+from budget import ExecutionBudget, create_agent_edge, turn_budget
+from cancellation import run_cancellable
 from chat_history import ChatHistory
-from db import init_db
+from db import init_db, resolve_chat_id
+from scheduler import Priority, with_priority
+from speculation import SearchPrefetcher
+from llm_cache import create_response_cache
+from tracing import create_tracer, trace_turn
+from views import MessageView, context_message, scoped_prompt
+from workload import create_recorder
+from schemas import ContextOutput, decode_context, encode_context, render_context
 
 
 CHAT_WINDOW_SIZE: int = 5
 
 
-def create_agents(model: BaseChatModel) -> dict[str, CompiledGraph]:
+def create_agents(models: ChatModels) -> dict[str, CompiledGraph]:
     agents: dict[str, CompiledGraph] = {}
 
     assign_to_research_agent = create_handoff_tool(agent_name='research_agent', description='Assign task to the research agent.')
     assign_to_calculator_agent = create_handoff_tool(agent_name='calculator_agent', description='Assign task to the calculator agent.')
     assign_to_writer_agent = create_handoff_tool(agent_name='writer_agent', description='Assign task to the writer agent.')
 
-    agents['research_agent'] = create_react_agent(
+    agents['research_agent'] = create_agent(
         name='research_agent',
-        model=model,
+        model=model_for(models, 'research_agent'),
+        state_schema=AgentGraphState,
         tools=[web_search],
-        prompt=(
+        prompt=scoped_prompt('research_agent', MessageView(history_turns=1), (
             'You are a research agent. You only perform web research tasks, using the web_search tool.\n'
             'As soon as you finish the search, you return to your supervisor the search results.\n'
             'Do not include extra text in the search results.'
-        )
+        ))
     )
-    agents['calculator_agent'] = create_react_agent(
+    agents['calculator_agent'] = create_agent(
         name='calculator_agent',
-        model=model,
+        model=model_for(models, 'calculator_agent'),
+        state_schema=AgentGraphState,
         tools=[add, subtract, multiply],
-        prompt=(
+        prompt=scoped_prompt('calculator_agent', MessageView(history_turns=1), (
             'You are a calculator agent. Do only sum, subtraction and multiplication, and nothing else.\n'
-            'Respond directly to your supervisor, and do not include any text other than the task results.'
-        )
+            'Your response is sent to the user as the answer, so do not include any text other than the task results.'
+        ))
     )
-    agents['writer_agent'] = create_react_agent(
+    agents['writer_agent'] = create_agent(
         name='writer_agent',
-        model=model,
+        model=model_for(models, 'writer_agent'),
+        state_schema=AgentGraphState,
         tools=[],
-        prompt=(
+        prompt=scoped_prompt('writer_agent', MessageView(history_turns=2, agents=('research_agent',), context=True), (
             'You are a writer agent. You should only generate text for the response.\n'
-            'Respond directly to your supervisor.'
-        )
+            'Your response is sent to the user as the answer.'
+        ))
     )
-    agents['research_supervisor'] = create_react_agent(
+    agents['research_supervisor'] = create_agent(
         name='research_supervisor',
-        model=model,
+        model=model_for(models, 'research_supervisor'),
+        state_schema=AgentGraphState,
         tools=[assign_to_research_agent, assign_to_writer_agent],
-        prompt=(
+        prompt=scoped_prompt('research_supervisor', MessageView(history_turns=2, agents=None, context=True), (
             'You are a supervisor managing two agents:\n'
             '- A research agent. Assign research related tasks to this agent.\n'
             '- A writer agent. Assign text generation tasks to this agent.\n'
             'Assign work to one agent at a time, do not call agents in parallel.\n'
             'Do not do any work yourself.\n'
             'Never write the responses to the user messages, assign the writer agent to do that, always.'
-        )
+        ))
     )
-    agents['calculator_supervisor'] = create_react_agent(
+    agents['calculator_supervisor'] = create_agent(
         name='calculator_supervisor',
-        model=model,
+        model=model_for(models, 'calculator_supervisor'),
+        state_schema=AgentGraphState,
         tools=[assign_to_calculator_agent],
-        prompt=(
+        prompt=scoped_prompt('calculator_supervisor', MessageView(history_turns=2, agents=None, context=True), (
             'You are a supervisor managing one agent:\n'
             '- A calculator agent. Assign math tasks to this agent.\n'
             'Do not do any math work yourself.'
-        )
+        ))
     )
 
     return agents
 
 
+# Agents whose messages answer the user directly, ending the subgraph.
+ANSWERING_AGENTS: set[str] = {'writer_agent', 'calculator_agent'}
+
+
 class ChatbotSystems(Enum):
     RESEARCH = 'research_subgraph'
     MATH = 'calculator_subgraph'
@@ -89,81 +107,98 @@ class RouterOutput(BaseModel):
     decision: ChatbotSystems = Field(default=ChatbotSystems.RESEARCH)
     reason: str = Field(..., description='Why this routing decision was made.')
 
-class UserData(BaseModel):
-    name: Optional[str] = Field(None, description="User's name, if mentioned.")
-    age: Optional[int] = Field(None, description="User's age, if specified.")
-    gender: Optional[str] = Field(None, description="User's gender, if stated.")
-
-class ContextOutput(BaseModel):
-    """
-        Context agent structured output that keeps all the relevant information from the entire chatbot conversation.
-        Keep the context data as short as possible, while keeping the important information.
-    """
-    chat_summary: str = Field(..., description='Summary of the current conversation between the user and the chatbot system.')
-    user_data: UserData = Field(..., description='Relevant information about the user.')
-
 class GraphState(MessagesState):
     context: ContextOutput
 
+class AgentGraphState(AgentState):
+    context: ContextOutput
+
 
-def create_router(model: BaseChatModel):
+def create_router(model: BaseChatModel, prefetcher: SearchPrefetcher | None = None):
     llm = model.with_structured_output(RouterOutput)
 
     def router(state: GraphState) -> str:
         last_message = state['messages'][-1]
+        # The search for the user message runs while the route is decided, and is discarded if it is not research.
+        if prefetcher is not None:
+            prefetcher.start(str(last_message.content))
         result: RouterOutput = llm.invoke([last_message]) # type: ignore
         print(f'{text_colors["cyan2"]}Using {result.decision.name} system.\n')
+
+        if prefetcher is None:
+            return result.decision.value
+        if result.decision == ChatbotSystems.RESEARCH:
+            return 'research_prefetch'
+        prefetcher.discard(str(last_message.content))
         return result.decision.value
 
     return router
 
+def create_prefetch_node(prefetcher: SearchPrefetcher):
+    def research_prefetch(state: GraphState) -> GraphState:
+        # The prefetched results are added as a search already made by the research agent, so it can answer
+        # without searching (and calling the model to choose the search) again.
+        query = str(state['messages'][-1].content)
+        result = prefetcher.take(query)
+        if result is None: return {} # type: ignore
+
+        tool_call_id = f'call_prefetch_{uuid.uuid4().hex[:16]}'
+        return {'messages': [
+            AIMessage(content='', name='research_agent', tool_calls=[
+                {'name': web_search.name, 'args': {'search_input': query}, 'id': tool_call_id, 'type': 'tool_call'}
+            ]),
+            ToolMessage(content=json.dumps(result), name=web_search.name, tool_call_id=tool_call_id)
+        ]} # type: ignore
+
+    return research_prefetch
+
 def create_context_agent(model: BaseChatModel):
-    context_agent = create_react_agent(
+    prompt = (
+        'You are a context agent. You must update the context dictionary with relevant information.\n'
+        'The context dictionary must contain relevant user information, useful facts, summaries and other\n'
+        'information that should persist across calls to the chatbot.\n'
+        'Make the context text as small and brief as possible while keeping the important data.\n'
+        'Finish the conversation immediately after generating the context. You must not call any tools.'
+    )
+    # The structured response call also starts with the system prompt, so it shares the cached prefix.
+    context_agent = create_agent(
         name='context_agent',
-        model=model,
+        model=with_priority(model, Priority.BACKGROUND),
         tools=[],
-        response_format=ContextOutput,
-        prompt=(
-            'You are a context agent. You must update the context dictionary with relevant information.\n'
-            'The context dictionary must contain relevant user information, useful facts, summaries and other\n'
-            'information that should persist across calls to the chatbot.\n'
-            'Make the context text as small and brief as possible while keeping the important data.\n'
-            'Finish the conversation immediately after generating the context. You must not call any tools.'
-        )
+        response_format=(prompt, ContextOutput),
+        prompt=prompt
     )
 
     def context_call(state: GraphState) -> GraphState:
-        invokeState: GraphState = state
-        invokeState['messages'].append(SystemMessage(content=f'Current context of the conversation:\n{state["context"]}'))
-        result = context_agent.invoke(invokeState)
+        # The current context goes before the conversation, so the prompt prefix is the same for every call of the turn.
+        messages = [context_message(render_context(state['context'])), *state['messages']]
+        result = context_agent.invoke({'messages': messages})
 
         current_context: ContextOutput = result['structured_response']
-        state['context'] = current_context
-
-        return state
+        return {'context': current_context} # type: ignore
 
     return context_call
 
 
-def build_graph(model: BaseChatModel) -> CompiledStateGraph:
-    agents = create_agents(model)
-    router = create_router(model)
-    context_agent = create_context_agent(model)
+def build_graph(models: ChatModels, prefetcher: SearchPrefetcher | None = None) -> CompiledStateGraph:
+    agents = create_agents(models)
+    router = create_router(model_for(models, 'router'), prefetcher)
+    context_agent = create_context_agent(model_for(models, 'context_agent'))
 
     research_graph_builder = StateGraph(GraphState)
     research_graph_builder.add_node(agents['research_supervisor'])
     research_graph_builder.add_node(agents['research_agent'])
     research_graph_builder.add_node(agents['writer_agent'])
     research_graph_builder.set_entry_point('research_supervisor')
-    research_graph_builder.add_edge('research_agent', 'research_supervisor')
-    research_graph_builder.add_edge('writer_agent', 'research_supervisor')
+    research_graph_builder.add_conditional_edges('research_agent', create_agent_edge('research_supervisor', final_answer=False), ['research_supervisor', END])
+    research_graph_builder.add_conditional_edges('writer_agent', create_agent_edge('research_supervisor', final_answer=True), ['research_supervisor', END])
     research_subgraph = research_graph_builder.compile()
 
     calculator_graph_builder = StateGraph(GraphState)
     calculator_graph_builder.add_node(agents['calculator_supervisor'])
     calculator_graph_builder.add_node(agents['calculator_agent'])
     calculator_graph_builder.set_entry_point('calculator_supervisor')
-    calculator_graph_builder.add_edge('calculator_agent', 'calculator_supervisor')
+    calculator_graph_builder.add_conditional_edges('calculator_agent', create_agent_edge('calculator_supervisor', final_answer=True), ['calculator_supervisor', END])
     calculator_subgraph = calculator_graph_builder.compile()
 
     graph = StateGraph(GraphState)
@@ -174,45 +209,54 @@ def build_graph(model: BaseChatModel) -> CompiledStateGraph:
     graph.add_edge('research_subgraph', 'context_agent')
     graph.add_edge('calculator_subgraph', 'context_agent')
     graph.set_finish_point('context_agent')
+    if prefetcher is not None:
+        graph.add_node('research_prefetch', create_prefetch_node(prefetcher))
+        graph.add_edge('research_prefetch', 'research_subgraph')
 
     return graph.compile()
 
 
-def encode_context(context: ContextOutput) -> str:
-    return base64.b64encode(pickle.dumps(context)).decode('utf-8')
-
-def decode_context(encoding: str) -> ContextOutput:
-    if encoding == '': return ContextOutput(chat_summary='', user_data=UserData(name=None, age=None, gender=None))
-    return pickle.loads(base64.b64decode(encoding.encode('utf-8')))
-
-
 def query_llm(graph: CompiledStateGraph, chat_history: ChatHistory) -> None:
-    last_messages = chat_history.messages[-CHAT_WINDOW_SIZE:]
+    last_messages = chat_history.window(CHAT_WINDOW_SIZE)
+
+    context: ContextOutput = decode_context(chat_history.context)
+    added = 0
+
+    # The states of the subgraphs are streamed too, so the messages of each agent are kept as soon as it finishes
+    # (and a cancelled turn keeps its completed steps). The states of the agents themselves are skipped.
+    stream = graph.stream({'messages': last_messages, 'context': context}, stream_mode='values', subgraphs=True)
+    for namespace, state in stream:
+        if len(namespace) > 1 or (namespace and not namespace[0].startswith(('research_subgraph:', 'calculator_subgraph:'))): continue
+
+        for m in state['messages'][len(last_messages) + added:]:
+            added += 1
+            if isinstance(m, BaseMessage):
+                chat_history.add_message(m)
+                name = str(m.name)
+                if m.content and ('_supervisor' in name or 'transfer_to_' in name or name in ANSWERING_AGENTS or name == 'context_agent'):
+                    print(f'{text_colors["blue2"]}{m.content}\n', flush=True)
+        if not namespace:
+            context = state['context']
 
-    output = graph.invoke({'messages': last_messages, 'context': decode_context(chat_history.context)})
-
-    new_messages = output['messages'][len(last_messages):]
-    for m in new_messages:
-        if isinstance(m, BaseMessage):
-            chat_history.add_message(m)
-            name = str(m.name)
-            if m.content and ('_supervisor' in name or 'transfer_to_' in name or name == 'writer_agent' or name == 'context_agent'):
-                print(f'{text_colors["blue2"]}{m.content}\n', flush=True)
-
-    context: ContextOutput = output['context']
     chat_history.update_context(encode_context(context))
 
-def chat(graph: CompiledStateGraph, chat_history: ChatHistory) -> None:
-    user_input = input(f'\n{text_colors["green2"]}User ("quit" to exit): ')
+def chat(graph: CompiledStateGraph, chat_history: ChatHistory, budget: ExecutionBudget) -> None:
+    user_input = read_input(f'\n{text_colors["green2"]}User ("quit" to exit): ', chat_history.pager)
     print(flush=True)
 
     while user_input != 'quit' and user_input != 'exit':
         chat_history.add_message(HumanMessage(content=user_input))
 
         print(text_colors['blue2'], end='', flush=True)
-        query_llm(graph, chat_history)
-
-        user_input = input(f'{text_colors["green2"]}User: ')
+        # Ctrl-C cancels the turn and returns to the prompt.
+        with trace_turn(chat_history.chat_id, user_input), turn_budget(budget) as usage:
+            completed, _ = run_cancellable(lambda: query_llm(graph, chat_history))
+        if not completed:
+            chat_history.end_cancelled_turn()
+            print(f'\n{text_colors["yellow2"]}Turn cancelled, its completed messages were saved.\n', flush=True)
+        print(f'{text_colors["gray"]}{usage.summary()}\n', flush=True)
+
+        user_input = read_input(f'{text_colors["green2"]}User: ', chat_history.pager)
         print(flush=True)
 
 
@@ -220,17 +264,28 @@ def main():
     load_dotenv()
     args = get_arguments()
     conn = init_db()
+    create_recorder(args.record) if args.record else create_tracer(args.trace)
+    llm_cache = create_response_cache(args.llm_cache)
 
-    chat_history = ChatHistory(args.chatid, conn)
+    chat_history = ChatHistory(resolve_chat_id(conn, args.chatid), conn, args.last_turns)
 
-    model = get_chat_model(args.vendor)
-    graph = build_graph(model)
+    models = get_chat_models(args.vendor, args.tiers)
+    prefetcher = SearchPrefetcher(compact_search) if args.speculative else None
+    graph = build_graph(models, prefetcher)
 
-    chat(graph, chat_history)
+    chat(graph, chat_history, ExecutionBudget(args.max_hops, args.max_tokens, args.max_seconds))
     chat_history.save_messages()
     chat_history.save_context()
 
+    if prefetcher is not None:
+        print(f'{text_colors["gray"]}Speculative search: {prefetcher.stats()}')
+
+    if llm_cache is not None:
+        print(f'{text_colors["gray"]}LLM cache: {llm_cache.stats()}')
+        llm_cache.close()
+
     conn.close()
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+from dotenv import load_dotenv
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from langgraph.graph.state import CompiledStateGraph
+from typing import Any, Iterator
+
+from budget import ExecutionBudget, turn_budget
+from chat_config import get_chat_models, load_script, text_colors
+from llm_cache import DEFAULT_CACHE_PATH, create_response_cache
+from scheduler import Priority
+
+
+SCRIPT_NAME: str = '07_langgraph_structured_routing'
+
+
+def get_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Runs the prompts of a JSONL file through the routed graph of script 07.')
+    parser.add_argument('path', type=str, help='JSONL file with one {"id": ..., "prompt": ...} object (or JSON string) per line.')
+    parser.add_argument('-o', '--output', type=str, help='JSONL results file, appended to when resuming (default: <path>.results.jsonl).')
+    parser.add_argument('-v', '--vendor', type=str, choices=['openai', 'groq', 'fake', 'failover'], default='openai')
+    parser.add_argument('--tiers', action='store_true', default=False, help='Run the internal hops on a fast model and the answers on a strong one.')
+    parser.add_argument('--llm-cache', type=str, nargs='?', const=DEFAULT_CACHE_PATH, help='Cache the responses of the internal hops in this SQLite file.')
+    parser.add_argument('-n', '--concurrency', type=int, default=4, help='Prompts running at the same time.')
+    parser.add_argument('--retry-errors', action='store_true', default=False, help='Run again the prompts that failed before.')
+    parser.add_argument('--max-hops', type=int, default=ExecutionBudget().max_hops, help='Agent hops allowed per prompt.')
+    parser.add_argument('--max-tokens', type=int, default=ExecutionBudget().max_tokens, help='Model tokens allowed per prompt.')
+    parser.add_argument('--max-seconds', type=float, default=ExecutionBudget().max_seconds, help='Wall time allowed per prompt.')
+    return parser.parse_args()
+
+
+def load_prompts(path: str) -> list[dict[str, Any]]:
+    # Prompts without an id are identified by their line number, so a run can be resumed with the same file.
+    items: list[dict[str, Any]] = []
+    with open(path, encoding='utf-8') as file:
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip(): continue
+            data = json.loads(line)
+            item = {'prompt': data} if isinstance(data, str) else data
+            items.append({'id': str(item.get('id', line_number)), 'prompt': item['prompt']})
+    return items
+
+def load_finished(path: str, retry_errors: bool) -> set[str]:
+    if not os.path.exists(path): return set()
+
+    # An interrupted run may leave the last line unfinished, so the next results start on a new line.
+    with open(path, 'rb+') as file:
+        if file.seek(0, os.SEEK_END) > 0:
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b'\n': file.write(b'\n')
+
+    finished: set[str] = set()
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue # Line cut by an interruption, the prompt runs again.
+            if not (retry_errors and result.get('error')):
+                finished.add(result['id'])
+    return finished
+
+
+def create_runner(graph: CompiledStateGraph, budget: ExecutionBudget) -> RunnableLambda:
+    def run_prompt(item: dict[str, Any], config: RunnableConfig) -> dict[str, Any]:
+        messages = [SystemMessage(content='You are a helpful assistant.'), HumanMessage(content=item['prompt'])]
+        start = time.perf_counter()
+        with turn_budget(budget) as usage:
+            try:
+                output = graph.invoke({'messages': messages}, config)
+                error = None
+            except Exception as e:
+                output = {'messages': messages}
+                error = f'{type(e).__name__}: {e}'
+
+        new_messages = output['messages'][len(messages):]
+        answers = [m for m in new_messages if isinstance(m, AIMessage) and m.content and not m.tool_calls]
+        return {
+            'id': item['id'],
+            'prompt': item['prompt'],
+            'answer': str(answers[-1].content) if answers else None,
+            'agents': [m.name for m in new_messages if isinstance(m, AIMessage)],
+            'error': error,
+            'ms': (time.perf_counter() - start) * 1000,
+            'model_calls': usage.model_calls,
+            'tokens': usage.tokens,
+        }
+
+    return RunnableLambda(run_prompt)
+
+def run_batch(graph: CompiledStateGraph, items: list[dict[str, Any]], concurrency: int, budget: ExecutionBudget) -> Iterator[dict[str, Any]]:
+    runner = create_runner(graph, budget)
+    for _, result in runner.batch_as_completed(items, config={'max_concurrency': concurrency}):
+        yield result
+
+
+def main():
+    load_dotenv()
+    args = get_arguments()
+    output_path = args.output or f'{os.path.splitext(args.path)[0]}.results.jsonl'
+
+    items = load_prompts(args.path)
+    finished = load_finished(output_path, args.retry_errors)
+    pending = [item for item in items if item['id'] not in finished]
+    print(f'{text_colors["yellow2"]}{len(pending)} of {len(items)} prompts to run, writing to {output_path}.{text_colors["normal"]}')
+    if not pending: return
+
+    script = load_script(SCRIPT_NAME)
+    llm_cache = create_response_cache(args.llm_cache)
+    graph = script.build_graph(get_chat_models(args.vendor, args.tiers, Priority.BACKGROUND))
+    budget = ExecutionBudget(args.max_hops, args.max_tokens, args.max_seconds)
+
+    start = time.perf_counter()
+    done = errors = 0
+    # The graph nodes print to the standard output, so the progress goes to the standard error.
+    with open(output_path, 'a', encoding='utf-8') as output, open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for result in run_batch(graph, pending, args.concurrency, budget):
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            done += 1
+            errors += 1 if result['error'] else 0
+            print(f'[{done}/{len(pending)}] {result["id"]}: {result["ms"]:.0f} ms{" (error)" if result["error"] else ""}', file=sys.stderr)
+
+    elapsed = time.perf_counter() - start
+    print(f'{text_colors["yellow2"]}{done} prompts in {elapsed:.1f}s ({done / elapsed:.2f} prompts/s), {errors} errors.{text_colors["normal"]}')
+    if llm_cache is not None:
+        print(f'{text_colors["gray"]}LLM cache: {llm_cache.stats()}{text_colors["normal"]}')
+        llm_cache.close()
+
+
+if __name__ == '__main__':
+    main()
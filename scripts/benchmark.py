@@ -0,0 +1,423 @@
+import argparse
+import contextlib
+import datetime
+import functools
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+import zlib
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import HumanMessage
+from typing import Any, Callable
+
+from chat_config import load_script, text_colors
+from chat_history import ChatHistory
+from db import *
+from failover import FailoverChatModel
+from fake_model import FakeChatModel, fake_search
+from model_tiers import ChatModels, ModelTiers
+import tools
+from schemas import ContextOutput, decode_context, encode_context, render_context
+from speculation import SearchPrefetcher
+from tools import set_search_backend, web_search
+from tracing import percentile
+
+
+PROMPTS: list[str] = [
+    'What are the latest news about the Python programming language?',
+    'How much is 12 plus 30 times 2?',
+    'Who won the last Formula 1 race?',
+    'Subtract 17 from 250 and multiply the result by 3.',
+    'My name is Ana and I am 31 years old. What is the weather like in Sao Paulo today?',
+]
+
+SCRIPTS: dict[str, str] = {
+    '05': '05_langgraph_tooling',
+    '06': '06_langgraph_multi_agent',
+    '07': '07_langgraph_structured_routing',
+    '08': '08_langgraph_custom_memory',
+}
+
+Turn = Callable[[ChatHistory], None]
+
+# How much faster the fake model of the fast tier is than the (default) strong one.
+FAST_TIER_SPEEDUP: float = 4.0
+
+# Insert and read statements of the messages table of each schema version, as used by `db.py` at that version.
+SCHEMA_STATEMENTS: dict[int, tuple[str, str]] = {
+    1: (
+        'INSERT INTO messages (message_id, chat_id, time, role, content) VALUES (:id, :chat_id, :time, :role, :content);',
+        'SELECT role, content, tool_data FROM messages WHERE chat_id = ? ORDER BY time ASC, rowid ASC;'
+    ),
+    2: (
+        'INSERT INTO messages (chat_id, seq, time, role, content) '
+        'SELECT :chat_id, COALESCE(MAX(seq), 0) + 1, :time, :role, :content FROM messages WHERE chat_id = :chat_id;',
+        'SELECT role, content, tool_data FROM messages WHERE chat_id = ? ORDER BY seq ASC;'
+    ),
+}
+SCHEMA_CHATS: int = 100
+
+# Share of the questions of the storage corpus that repeat a common one, the rest are unique.
+STORAGE_REPEATED_SHARE: float = 0.3
+
+# A context as stored by script 08 before the JSON encoding (a base64 pickle of its `__main__` models).
+LEGACY_CONTEXT: str = (
+    'gASVHQEAAAAAAACMCF9fbWFpbl9flIwNQ29udGV4dE91dHB1dJSTlCmBlH2UKIwIX19kaWN0X1+UfZQojAxjaGF0X3N1bW1hcnmU'
+    'jC5UaGUgdXNlciBhc2tlZCBhYm91dCB0aGUgd2VhdGhlciBpbiBTYW8gUGF1bG8ulIwJdXNlcl9kYXRhlGgAjAhVc2VyRGF0YZST'
+    'lCmBlH2UKGgFfZQojARuYW1llIwDQW5hlIwDYWdllEsfjAZnZW5kZXKUTnWMEl9fcHlkYW50aWNfZXh0cmFfX5ROjBdfX3B5ZGFu'
+    'dGljX2ZpZWxkc19zZXRfX5SPlChoD2gRkIwUX19weWRhbnRpY19wcml2YXRlX1+UTnVidWgTTmgUj5QoaAloB5BoFk51Yi4='
+)
+
+
+def get_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Offline benchmark of the chat scripts with a deterministic fake model.')
+    parser.add_argument('-s', '--scenarios', type=str, nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('-n', '--turns', type=int, default=50, help='Turns (or operations) per scenario.')
+    parser.add_argument('--turns-per-chat', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.0, help='Fake model latency before the first token, in seconds.')
+    parser.add_argument('--tokens-per-second', type=float, default=0.0, help='Fake model generation speed (0 for instant).')
+    parser.add_argument('--search-latency', type=float, default=0.0, help='Fake web search latency, in seconds.')
+    parser.add_argument('--memory', action='store_true', default=False, help='Measure the peak Python allocations (slower).')
+    parser.add_argument('--storage', action='store_true', default=False, help=f'Compare the message storage of schema versions {" and ".join(map(str, STORAGE_LAYOUTS))} on chats of script 08.')
+    parser.add_argument('--json', type=str, help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', type=str, help='Compare against a previous JSON result file.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed p50 slowdown against the baseline.')
+    return parser.parse_args()
+
+
+def setup_05(model: BaseChatModel) -> Turn:
+    script = load_script(SCRIPTS['05'])
+    agent = script.create_agent(model, [web_search])
+    return lambda chat_history: script.query_llm(agent, chat_history)
+
+def setup_06(model: BaseChatModel) -> Turn:
+    script = load_script(SCRIPTS['06'])
+    supervisor, subagent_calls = script.create_agents(model)
+    return lambda chat_history: script.run_turn(chat_history, supervisor, subagent_calls, False)
+
+def setup_07(model: BaseChatModel) -> Turn:
+    script = load_script(SCRIPTS['07'])
+    graph = script.build_graph(model)
+    return lambda chat_history: script.query_llm(graph, chat_history)
+
+def setup_08(model: ChatModels) -> Turn:
+    script = load_script(SCRIPTS['08'])
+    graph = script.build_graph(model)
+    return lambda chat_history: script.query_llm(graph, chat_history)
+
+
+def run_chat_scenario(setup: Callable[[BaseChatModel], Turn], model: BaseChatModel, conn: sqlite3.Connection, args: argparse.Namespace) -> list[float]:
+    turn = setup(model)
+    latencies: list[float] = []
+    chat_history: ChatHistory | None = None
+
+    for i in range(args.turns):
+        if i % args.turns_per_chat == 0:
+            chat_history = ChatHistory(None, conn)
+
+        start = time.perf_counter()
+        chat_history.add_message(HumanMessage(content=PROMPTS[i % len(PROMPTS)])) # type: ignore
+        turn(chat_history) # type: ignore
+        chat_history.save_messages() # type: ignore
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+def run_db_scenario(model: BaseChatModel, conn: sqlite3.Connection, args: argparse.Namespace) -> list[float]:
+    chat_id = create_new_chat(conn)
+    latencies: list[float] = []
+
+    for i in range(args.turns):
+        start = time.perf_counter()
+        save_message(conn, chat_id, datetime.datetime.now(), 'user', PROMPTS[i % len(PROMPTS)])
+        save_message(conn, chat_id, datetime.datetime.now(), 'assistant', PROMPTS[(i + 1) % len(PROMPTS)])
+        fetch_history(conn, chat_id)
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+def run_resume_scenario(model: BaseChatModel, conn: sqlite3.Connection, args: argparse.Namespace) -> list[float]:
+    chat_id = create_new_chat(conn)
+    save_message(conn, chat_id, datetime.datetime.now(), 'system', 'You are a helpful assistant.')
+    for i in range(args.turns * 10):
+        save_message(conn, chat_id, datetime.datetime.now(), 'user' if i % 2 == 0 else 'assistant', PROMPTS[i % len(PROMPTS)])
+
+    latencies: list[float] = []
+    for _ in range(args.turns):
+        start = time.perf_counter()
+        ChatHistory(chat_id, conn)
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+def run_context_scenario(model: BaseChatModel, conn: sqlite3.Connection, args: argparse.Namespace) -> list[float]:
+    # Per turn, script 08 parses the new context, stores it, and renders it in the prompt of every agent call.
+    # The contexts of chats stored before the JSON encoding must still be read.
+    legacy = decode_context(LEGACY_CONTEXT)
+    assert legacy.chat_summary == 'The user asked about the weather in Sao Paulo.' and legacy.user_data.name == 'Ana', legacy
+
+    latencies: list[float] = []
+    for i in range(args.turns):
+        response = json.dumps({
+            'chat_summary': ' '.join(PROMPTS[:i % len(PROMPTS) + 1]),
+            'user_data': {'name': 'Ana', 'age': 31 + i, 'gender': None}
+        })
+
+        start = time.perf_counter()
+        context = ContextOutput.model_validate_json(response)
+        stored = encode_context(context)
+        for _ in range(8):
+            render_context(decode_context(stored))
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+def run_speculative_scenario(model: BaseChatModel, conn: sqlite3.Connection, args: argparse.Namespace) -> list[float]:
+    # Script 08 with the search of each user message started while the route is decided.
+    script = load_script(SCRIPTS['08'])
+    prefetcher = SearchPrefetcher(tools.compact_search)
+    graph = script.build_graph(model, prefetcher)
+    latencies = run_chat_scenario(lambda _: lambda chat_history: script.query_llm(graph, chat_history), model, conn, args)
+
+    print(prefetcher.stats(), file=sys.stderr)
+    return latencies
+
+def run_tiers_scenario(model: BaseChatModel, conn: sqlite3.Connection, args: argparse.Namespace) -> list[float]:
+    # Script 08 with the routing, supervision, tool and context calls on a faster model, and the answers on the default one.
+    fast = FakeChatModel(latency=args.latency / FAST_TIER_SPEEDUP, tokens_per_second=args.tokens_per_second * FAST_TIER_SPEEDUP)
+    tiers = ModelTiers({'fast': fast, 'strong': model})
+    return run_chat_scenario(lambda _: setup_08(tiers), model, conn, args)
+
+def run_failover_scenario(model: BaseChatModel, conn: sqlite3.Connection, args: argparse.Namespace) -> list[float]:
+    # A fast but flaky vendor backed by a slower reliable one, with hedged requests.
+    failover = FailoverChatModel(
+        backends={
+            'flaky': FakeChatModel(latency=args.latency + 0.01, failure_rate=0.2),
+            'steady': FakeChatModel(latency=args.latency + 0.03),
+        },
+        hedge=True
+    )
+    latencies: list[float] = []
+
+    for i in range(args.turns):
+        start = time.perf_counter()
+        failover.invoke(PROMPTS[i % len(PROMPTS)])
+        latencies.append(time.perf_counter() - start)
+
+    print(failover.stats(), file=sys.stderr)
+    return latencies
+
+
+CHAT_SETUPS: dict[str, Callable[[BaseChatModel], Turn]] = {
+    '05': setup_05,
+    '06': setup_06,
+    '07': setup_07,
+    '08': setup_08,
+}
+
+def run_schema_scenario(version: int, operation: str, model: BaseChatModel, conn: sqlite3.Connection, args: argparse.Namespace) -> list[float]:
+    # Messages of many chats are written interleaved, as they arrive, to a database of the given schema version.
+    # The write scenario times each insert, and the read scenario then times reading whole chats.
+    insert, read = SCHEMA_STATEMENTS[version]
+    rng = random.Random(0)
+    chat_ids = [str(uuid.uuid4()) for _ in range(SCHEMA_CHATS)]
+    latencies: list[float] = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        schema_conn = open_db(os.path.join(directory, f'schema_v{version}.db'), version)
+        for i in range(args.turns * 20):
+            start = time.perf_counter()
+            schema_conn.execute(insert, {'id': str(uuid.uuid4()), 'chat_id': rng.choice(chat_ids), 'time': datetime.datetime.now(), 'role': 'user', 'content': PROMPTS[i % len(PROMPTS)]})
+            schema_conn.commit()
+            if operation == 'write':
+                latencies.append(time.perf_counter() - start)
+
+        if operation == 'read':
+            for _ in range(args.turns):
+                start = time.perf_counter()
+                schema_conn.execute(read, [rng.choice(chat_ids)]).fetchall()
+                latencies.append(time.perf_counter() - start)
+        schema_conn.close()
+
+    return latencies
+
+
+def write_v2(conn: sqlite3.Connection, chat_id: str, time: str, role: str, content: str, tool_data: str | None) -> None:
+    # `save_message` at schema version 2: tool results longer than 1 KB compressed out of line, the rest inline.
+    payload = None
+    if role == 'tool' and len(content) > 1024:
+        payload, content = zlib.compress(content.encode('utf-8')), ''
+    seq = conn.execute(
+        'INSERT INTO messages (chat_id, seq, time, role, content, tool_data) '
+        'SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ?, ? FROM messages WHERE chat_id = ? RETURNING seq;',
+        (chat_id, time, role, content, tool_data, chat_id)
+    ).fetchone()[0]
+    if payload is not None:
+        conn.execute('INSERT INTO message_payloads (chat_id, seq, payload) VALUES (?, ?, ?);', (chat_id, seq, payload))
+    conn.commit()
+
+def read_v2(conn: sqlite3.Connection, chat_id: str) -> list[str]:
+    return [zlib.decompress(payload).decode('utf-8') if payload is not None else content for content, payload in conn.execute(
+        'SELECT m.content, p.payload FROM messages m LEFT JOIN message_payloads p ON p.chat_id = m.chat_id AND p.seq = m.seq '
+        'WHERE m.chat_id = ? ORDER BY m.seq;', [chat_id]
+    )]
+
+def read_blobs(conn: sqlite3.Connection, chat_id: str) -> list[str]:
+    # `fetch_history` since schema version 3, the bodies are read from the blobs table.
+    return [decode_blob(digest, body) for digest, body in conn.execute(
+        'SELECT b.digest, b.body FROM messages m JOIN blobs b ON b.blob_id = m.blob_id '
+        'WHERE m.chat_id = ? ORDER BY m.seq;', [chat_id]
+    )]
+
+# The layout before the blobs table, and the current one (`save_message` writes all the tables of its version).
+STORAGE_LAYOUTS: dict[int, tuple[Callable[..., None], Callable[[sqlite3.Connection, str], list[str]]]] = {
+    2: (write_v2, read_v2),
+    SCHEMA_VERSION: (save_message, read_blobs),
+}
+
+def run_storage_report(args: argparse.Namespace) -> None:
+    # The corpus is made of the messages (system prompts, questions, tool calls and results, answers) of the
+    # chats of script 08 with the fake model, written again to an empty database of each version. The fake
+    # answers and search results follow the questions, so only some of the questions are repeated.
+    turn = setup_08(FakeChatModel(latency=0.0))
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, 'w') as devnull:
+        conn = init_db(os.path.join(directory, 'corpus.db'), 1)
+        with contextlib.redirect_stdout(devnull):
+            for i in range(args.turns):
+                if i % args.turns_per_chat == 0:
+                    chat_history = ChatHistory(None, conn)
+                question = rng.choice(PROMPTS)
+                if rng.random() >= STORAGE_REPEATED_SHARE:
+                    question = f'{question} Case {i}: {uuid.UUID(int=rng.getrandbits(128)).hex[:12]}.'
+                chat_history.add_message(HumanMessage(content=question))
+                turn(chat_history)
+                chat_history.save_messages()
+        corpus = [(chat_id, time, role, inflate_blob(body), tool_data) for chat_id, time, role, body, tool_data in conn.execute(
+            'SELECT m.chat_id, m.time, m.role, b.body, m.tool_data FROM messages m JOIN blobs b ON b.blob_id = m.blob_id ORDER BY m.time, m.chat_id, m.seq;'
+        ).fetchall()]
+        conn.close()
+        chat_ids = list(dict.fromkeys(chat_id for chat_id, *_ in corpus))
+        contents = [message[3] for message in corpus]
+        print(f'Corpus: {len(chat_ids)} chats, {len(corpus)} messages, {len(set(contents))} distinct bodies, '
+              f'{sum(len(c.encode("utf-8")) for c in contents) / 1024:.1f} KB of text')
+
+        print(f'{"schema":<8} {"file KB":>8} {"write us":>9} {"cold us":>8} {"warm us":>8}')
+        for version, (write, read) in STORAGE_LAYOUTS.items():
+            path = os.path.join(directory, f'storage_v{version}.db')
+            conn = open_db(path, version)
+            start = time.perf_counter()
+            for message in corpus:
+                write(conn, *message)
+            write_time = (time.perf_counter() - start) / len(corpus)
+
+            # Cold reads start without decoded bodies (the writes fill the cache), like the first turn of a chat
+            # in a new process. Warm reads repeat them, like the next turns of the sessions.
+            cold_time = 0.0
+            for chat_id in chat_ids:
+                clear_blob_cache()
+                start = time.perf_counter()
+                read(conn, chat_id)
+                cold_time += time.perf_counter() - start
+            cold_time /= len(chat_ids)
+
+            start = time.perf_counter()
+            for _ in range(args.turns_per_chat):
+                for chat_id in chat_ids:
+                    read(conn, chat_id)
+            warm_time = (time.perf_counter() - start) / (args.turns_per_chat * len(chat_ids))
+            conn.execute('VACUUM;')
+            conn.close()
+            print(f'v{version:<7} {os.path.getsize(path) / 1024:>8.1f} {write_time * 1e6:>9.1f} {cold_time * 1e6:>8.1f} {warm_time * 1e6:>8.1f}')
+
+
+
+SCENARIOS: dict[str, Callable[[BaseChatModel, sqlite3.Connection, argparse.Namespace], list[float]]] = {
+    **{name: functools.partial(run_chat_scenario, setup) for name, setup in CHAT_SETUPS.items()},
+    'db': run_db_scenario,
+    'resume': run_resume_scenario,
+    'failover': run_failover_scenario,
+    '08s': run_speculative_scenario,
+    '08t': run_tiers_scenario,
+    'context': run_context_scenario,
+    **{f'v{version}-{operation}': functools.partial(run_schema_scenario, version, operation) for version in SCHEMA_STATEMENTS for operation in ['write', 'read']},
+}
+
+
+def run_scenario(name: str, args: argparse.Namespace) -> dict[str, Any]:
+    model = FakeChatModel(latency=args.latency, tokens_per_second=args.tokens_per_second)
+
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, 'w') as devnull:
+        conn = init_db(os.path.join(directory, 'benchmark.db'))
+        if args.memory:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(devnull):
+            latencies = SCENARIOS[name](model, conn, args)
+        elapsed = time.perf_counter() - start
+
+        peak_memory = tracemalloc.get_traced_memory()[1] if args.memory else None
+        if args.memory:
+            tracemalloc.stop()
+        conn.close()
+
+    return {
+        'scenario': name,
+        'turns': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_mb': peak_memory / 2**20 if peak_memory is not None else None,
+    }
+
+
+def compare(results: list[dict[str, Any]], baseline_path: str, tolerance: float) -> bool:
+    with open(baseline_path, encoding='utf-8') as file:
+        baseline = {r['scenario']: r for r in json.load(file)['results']}
+
+    passed = True
+    for result in results:
+        previous = baseline.get(result['scenario'])
+        if previous is None: continue
+
+        ratio = result['p50_ms'] / previous['p50_ms'] if previous['p50_ms'] > 0 else 1.0
+        regressed = ratio > 1 + tolerance
+        passed = passed and not regressed
+        color = text_colors['red2'] if regressed else text_colors['green2']
+        print(f'{color}{result["scenario"]:<8} p50 {previous["p50_ms"]:.2f} ms -> {result["p50_ms"]:.2f} ms ({ratio:.2f}x){text_colors["normal"]}')
+    return passed
+
+
+def main():
+    args = get_arguments()
+    set_search_backend(fake_search(args.search_latency))
+
+    results = [run_scenario(name, args) for name in args.scenarios]
+
+    print(f'{"scenario":<8} {"turns":>6} {"turns/s":>9} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"peak MB":>8}')
+    for r in results:
+        peak = f'{r["peak_mb"]:.1f}' if r['peak_mb'] is not None else '-'
+        print(f'{r["scenario"]:<8} {r["turns"]:>6} {r["throughput"]:>9.1f} {r["p50_ms"]:>9.2f} {r["p95_ms"]:>9.2f} {r["p99_ms"]:>9.2f} {peak:>8}')
+    print(f'Max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB')
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump({'arguments': vars(args), 'results': results}, file, indent=2)
+
+    if args.storage:
+        run_storage_report(args)
+
+    if args.baseline and not compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import LLMResult
+from langchain_core.tracers.context import register_configure_hook
+from langgraph.graph import END, MessagesState
+from typing import Any, Callable, Iterator, NamedTuple, Optional
+
+from tracing import get_cached_tokens, get_usage
+
+
+class ExecutionBudget(NamedTuple):
+    max_hops: int = 8
+    max_tokens: int = 50000
+    max_seconds: float = 120.0
+
+
+class BudgetTracker(BaseCallbackHandler):
+    """Counts the hops between agents, the model calls and the tokens used by the current turn."""
+
+    def __init__(self, budget: ExecutionBudget):
+        self.budget: ExecutionBudget = budget
+        self.start: float = time.monotonic()
+        self.hops: int = 0
+        self.model_calls: int = 0
+        self.tokens: int = 0
+        self.input_tokens: int = 0
+        self.cached_tokens: int = 0
+        self.lock = threading.Lock()
+
+    def on_chat_model_start(self, serialized: dict[str, Any], messages: list, **kwargs: Any) -> None:
+        with self.lock:
+            self.model_calls += 1
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        usage = get_usage(response)
+        with self.lock:
+            self.tokens += usage.get('total_tokens', usage.get('input_tokens', 0) + usage.get('output_tokens', 0))
+            self.input_tokens += usage.get('input_tokens', 0)
+            self.cached_tokens += get_cached_tokens(usage)
+
+    def add_hop(self) -> str | None:
+        # Counts a delegation to an agent, or returns why it is refused: `max_hops` delegations were already made,
+        # or the rest of the budget is exhausted.
+        reason = self.exceeded()
+        with self.lock:
+            if reason is None and self.hops >= self.budget.max_hops:
+                reason = f'the limit of {self.budget.max_hops} agent hops was reached'
+            if reason is None:
+                self.hops += 1
+        return reason
+
+    def exceeded(self) -> str | None:
+        elapsed = time.monotonic() - self.start
+        if self.tokens >= self.budget.max_tokens:
+            return f'the limit of {self.budget.max_tokens} tokens was reached'
+        if elapsed >= self.budget.max_seconds:
+            return f'the limit of {self.budget.max_seconds} seconds was reached'
+        return None
+
+    def summary(self) -> str:
+        cached = f' ({100 * self.cached_tokens / self.input_tokens:.0f}% of the input cached)' if self.input_tokens else ''
+        return f'{self.model_calls} model calls, {self.hops} hops, {self.tokens} tokens{cached}, {time.monotonic() - self.start:.1f}s'
+
+
+_budget_var: ContextVar[Optional[BudgetTracker]] = ContextVar('turn_budget', default=None)
+register_configure_hook(_budget_var, inheritable=True)
+
+@contextmanager
+def turn_budget(budget: ExecutionBudget) -> Iterator[BudgetTracker]:
+    tracker = BudgetTracker(budget)
+    token = _budget_var.set(tracker)
+    try:
+        yield tracker
+    finally:
+        _budget_var.reset(token)
+
+def current_budget() -> BudgetTracker | None:
+    return _budget_var.get()
+
+
+def create_agent_edge(supervisor: str, final_answer: bool) -> Callable[[MessagesState], str]:
+    # Agents whose text is the answer to the user finish the turn directly instead of going back to the supervisor,
+    # and every agent finishes the turn when the budget is exhausted. The hops are counted by the handoff tools,
+    # once per delegation, so going back to the supervisor is not counted again.
+    def route(state: MessagesState) -> str:
+        last_message = state['messages'][-1]
+        if final_answer and isinstance(last_message, AIMessage) and last_message.content and not last_message.tool_calls:
+            return END
+
+        tracker = current_budget()
+        if tracker is not None and tracker.exceeded(): return END
+        return supervisor
+
+    return route
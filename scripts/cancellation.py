@@ -0,0 +1,107 @@
+import contextvars
+import logging
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.tracers.context import register_configure_hook
+from typing import Any, Callable, ContextManager, Iterator, Optional, TypeVar
+from uuid import UUID
+
+
+T = TypeVar('T')
+
+
+class TurnCancelled(Exception):
+    pass
+
+
+class CancellationHandler(BaseCallbackHandler):
+    """
+        Cancellation token of a turn, also registered as a callback handler of all its runs. Once cancelled, every
+        graph node, model call (and streamed token) and tool call of the turn raises `TurnCancelled` when it starts,
+        so the sub-agents stop at their next step and the streamed responses stop being generated.
+    """
+    raise_error: bool = True
+    run_inline: bool = True
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def cancel(self) -> None:
+        # Waits for the changes being committed by the turn, none are made after this.
+        with self.lock:
+            self.event.set()
+
+    def check(self) -> None:
+        if self.event.is_set(): raise TurnCancelled()
+
+    @contextmanager
+    def commit(self) -> Iterator[None]:
+        with self.lock:
+            self.check()
+            yield
+
+    def on_chain_start(self, serialized: dict[str, Any], inputs: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self.check()
+
+    def on_chat_model_start(self, serialized: dict[str, Any], messages: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self.check()
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self.check()
+
+    def on_tool_start(self, serialized: dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self.check()
+
+
+class _CancelledRunFilter(logging.Filter):
+    # The callback manager logs the errors raised by the handlers, which is only noise for cancelled turns.
+    def filter(self, record: logging.LogRecord) -> bool:
+        return 'TurnCancelled' not in record.getMessage()
+
+logging.getLogger('langchain_core.callbacks.manager').addFilter(_CancelledRunFilter())
+
+
+_cancellation_var: ContextVar[Optional[CancellationHandler]] = ContextVar('turn_cancellation', default=None)
+register_configure_hook(_cancellation_var, inheritable=True)
+
+def is_cancelled() -> bool:
+    handler = _cancellation_var.get()
+    return handler is not None and handler.cancelled
+
+def cancellation_point() -> ContextManager[None]:
+    # Changes made inside are either completed before the turn is cancelled, or not made at all.
+    handler = _cancellation_var.get()
+    return handler.commit() if handler is not None else nullcontext()
+
+def run_cancellable(turn: Callable[[], T]) -> tuple[bool, T | None]:
+    """
+        Runs the turn in a worker thread, with the context (tracer, budget) of the caller. Ctrl-C cancels the turn
+        and returns `(False, None)` immediately, while the worker stops at its next cancellation point.
+    """
+    handler = CancellationHandler()
+    future: Future = Future()
+    context = contextvars.copy_context()
+
+    def worker() -> None:
+        _cancellation_var.set(handler)
+        try:
+            future.set_result(turn())
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=context.run, args=(worker,), daemon=True).start()
+    try:
+        return True, future.result()
+    except KeyboardInterrupt:
+        handler.cancel()
+        return False, None
+    except TurnCancelled:
+        return False, None
@@ -1,6 +1,8 @@
 import argparse
+import importlib
 import os
 from datetime import datetime
+from types import ModuleType
 from typing import Annotated, NamedTuple
 from langchain.chat_models import init_chat_model
 from langchain_core.language_models import BaseChatModel
@@ -11,49 +13,99 @@ from langgraph.graph.graph import CompiledGraph
 from langgraph.prebuilt import InjectedState, create_react_agent
 from langgraph.types import Command
 
+from budget import ExecutionBudget, current_budget
+from failover import FailoverChatModel
+from llm_cache import DEFAULT_CACHE_PATH
+from fake_model import FakeChatModel, fake_search
+from model_tiers import ChatModels, create_model_tiers, get_model_name, model_for
+from scheduler import Priority, schedule
+from tool_registry import bind_tools, registry
+from transcript import MORE_COMMAND, TranscriptPager, read_input
 from tools import *
 
 class MessageData(NamedTuple):
     time: datetime
     role: str
     content: str
+    tool_data: str | None = None
 
 def get_arguments() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
-    parser.add_argument('-v', '--vendor', type=str, choices=['openai', 'groq'], default='openai')
+    parser.add_argument('-v', '--vendor', type=str, choices=['openai', 'groq', 'fake', 'failover'], default='openai')
     parser.add_argument('-s', '--stream', action='store_true', default=False)
-    parser.add_argument('-c', '--chatid', type=str)
+    parser.add_argument('-c', '--chatid', type=str, help='Chat to resume: its id, a unique prefix of it, or "last".')
+    parser.add_argument('-l', '--last-turns', type=int, default=3, help=f'Turns read and shown when resuming a chat, "{MORE_COMMAND}" reads and shows older ones.')
+    parser.add_argument('-t', '--trace', type=str, help='Append per-turn latency traces to this JSONL file.')
+    parser.add_argument('-r', '--record', type=str, help='Append anonymized per-turn workload records to this JSONL file (`WORKLOAD_SALT` keeps the pseudo-words stable across recordings).')
+    parser.add_argument('--tiers', action='store_true', default=False, help='Run the internal hops on a fast model and the answers on a strong one.')
+    parser.add_argument('--llm-cache', type=str, nargs='?', const=DEFAULT_CACHE_PATH, help='Cache the responses of the internal hops in this SQLite file.')
+    parser.add_argument('--speculative', action='store_true', default=False, help='Search the user message while routing (script 08).')
+    parser.add_argument('--max-hops', type=int, default=ExecutionBudget().max_hops, help='Agent hops allowed per turn.')
+    parser.add_argument('--max-tokens', type=int, default=ExecutionBudget().max_tokens, help='Model tokens allowed per turn.')
+    parser.add_argument('--max-seconds', type=float, default=ExecutionBudget().max_seconds, help='Wall time allowed per turn.')
     return parser.parse_args()
 
-def get_chat_model(vendor: str) -> BaseChatModel:
-    print(f'Selected vendor: {vendor}')
+def get_chat_model(vendor: str, tier: str | None = None) -> BaseChatModel:
+    print(f'Selected vendor: {vendor}' + (f' ({tier} tier)' if tier else ''))
+
+    if vendor == 'fake':
+        # Offline, the web search of the tools is answered by a fake backend too.
+        set_search_backend(fake_search())
+        return FakeChatModel(
+            latency=float(os.environ.get('FAKE_LLM_LATENCY', 0)),
+            tokens_per_second=float(os.environ.get('FAKE_LLM_TOKENS_PER_SECOND', 0))
+        )
+
+    if vendor == 'failover':
+        return FailoverChatModel(
+            backends={'openai': get_chat_model('openai', tier), 'groq': get_chat_model('groq', tier)},
+            timeout=float(os.environ.get('LLM_TIMEOUT', 60)),
+            hedge=os.environ.get('LLM_HEDGE', '') == '1'
+        )
 
     if not os.environ.get(f'{vendor.upper()}_API_KEY'):
         raise ValueError(f'API key not defined for the vendor {vendor}.')
 
-    if vendor == 'openai':
-        return init_chat_model('gpt-4o-mini', model_provider=vendor)
-    else:
-        return init_chat_model('llama-3.3-70b-versatile', model_provider=vendor)
+    return init_chat_model(get_model_name(vendor, tier), model_provider=vendor)
+
+def get_chat_models(vendor: str, tiers: bool = False, priority: Priority = Priority.INTERACTIVE) -> ChatModels:
+    if not tiers: return schedule(get_chat_model(vendor), vendor, priority)
+    return create_model_tiers(lambda tier: schedule(get_chat_model(vendor, tier), vendor, priority))
 
-def create_agent(vendor: str, tools: list[BaseTool]) -> CompiledGraph:
-    model = get_chat_model(vendor)
-    return create_react_agent(model=model, tools=tools)
+def create_agent(model: BaseChatModel, tools: list[BaseTool], **kwargs) -> CompiledGraph:
+    # The model is bound to the tools through the shared registry, so the tool schemas are not generated again.
+    return create_react_agent(model=bind_tools(model, tools), tools=tools, **kwargs)
+
+def load_script(name: str) -> ModuleType:
+    # The numbered scripts are not valid identifiers, so they can only be imported by name.
+    return importlib.import_module(name)
 
 
 def create_handoff_tool(*, agent_name: str, description: str | None = None) -> BaseTool:
+    # The handoff tools are the same for every graph, so each one is created once.
+    return registry.tool(('handoff', agent_name, description), lambda: _create_handoff_tool(agent_name, description))
+
+def _create_handoff_tool(agent_name: str, description: str | None) -> BaseTool:
     name = f'transfer_to_{agent_name}'
     description = description or f'Ask {agent_name} for help.'
 
     @tool(name, description=description)
-    def handoff_tool(state: Annotated[MessagesState, InjectedState], tool_call_id: Annotated[str, InjectedToolCallId]) -> Command:
+    def handoff_tool(state: Annotated[MessagesState, InjectedState], tool_call_id: Annotated[str, InjectedToolCallId]) -> Command | str:
+        tracker = current_budget()
+        if tracker is not None:
+            reason = tracker.add_hop()
+            if reason:
+                return f'Transfer to {agent_name} refused, {reason}. Answer with the information already available.'
+
         tool_message = {
             'role': 'tool',
             'content': f'{text_colors["violet2"]}Successfully transfered to {agent_name}.',
             'name': name,
             'tool_call_id': tool_call_id
         }
-        return Command(goto=agent_name, update={**state, 'messages': state['messages'] + [tool_message]}, graph=Command.PARENT)
+        # Only the supervisor's tool call and its result are new to the parent graph, the rest of the
+        # messages are already in its state.
+        return Command(goto=agent_name, update={'messages': [state['messages'][-1], tool_message]}, graph=Command.PARENT)
 
     return handoff_tool
 
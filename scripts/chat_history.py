@@ -1,51 +1,92 @@
 import datetime as dt
+import uuid
 from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_core.messages import BaseMessage, ToolMessage
 
+from cancellation import cancellation_point
 from chat_config import *
 from db import *
 
 class ChatHistory(BaseChatMessageHistory):
-    def __init__(self, chat_id: str, conn: sqlite3.Connection):
-        self.chat_id: str = chat_id
-        self.conn: sqlite3.Connection = conn
+    def __init__(self, chat_id: str | None, conn: Connection, last_turns: int = 3):
+        self.conn: Connection = conn
+        # A new chat gets its id first, since it chooses the shard the chat is read from and stored in.
+        self.chat_id: str = chat_id or str(uuid.uuid4())
 
-        db_messages, db_context = fetch_history(self.conn, self.chat_id)
-        self.messages: list[BaseMessage] = db_messages
+        # Only the last turns are read, the older ones are read a page at a time by `/more` (and then sent to the model too).
+        page = fetch_history_page(self.conn, self.chat_id, last_turns)
+        self.messages: list[BaseMessage] = page.messages
         self.new_messages: list[MessageData] = []
-        self.context: str = db_context
+        self.context: str = fetch_context(self.conn, self.chat_id)
+        self.page_start: int = page.start
+        self.pager = TranscriptPager(self.messages, last_turns, format_message, load_older=self.load_older, unloaded=page.earlier)
 
         self.initialize_chat()
 
     def add_message(self, message: BaseMessage) -> None:
-        self.messages.append(message)
+        # Messages of a cancelled turn are rejected, from the moment it was cancelled.
+        with cancellation_point():
+            self.messages.append(message)
 
-        if isinstance(message, ToolMessage) or not message.content: return
-        self.new_messages.append(MessageData(dt.datetime.now(), get_message_role(message), str(message.content)))
+            tool_data = get_tool_data(message)
+            if not message.content and tool_data is None: return
+            self.new_messages.append(MessageData(dt.datetime.now(), get_message_role(message), str(message.content), tool_data))
 
     def update_context(self, new_context: str) -> None:
-        self.context = new_context
+        with cancellation_point():
+            self.context = new_context
+
+    def end_cancelled_turn(self) -> None:
+        # The tool calls left without results are dropped, since the vendors reject them, and the rest is saved.
+        self.messages[:] = pair_tool_messages(self.messages)
+        self.save_messages()
+
+    def load_older(self) -> tuple[list[BaseMessage], int]:
+        page = fetch_history_page(self.conn, self.chat_id, self.pager.turns, self.page_start)
+        self.page_start = page.start
+        return page.messages, page.earlier
+
+    def window(self, size: int) -> list[BaseMessage]:
+        # The window is extended back to the call of its first tool results, so they are never sent without it.
+        start = max(0, len(self.messages) - size)
+        while start > 0 and isinstance(self.messages[start], ToolMessage):
+            start -= 1
+        return self.messages[start:]
 
     def save_messages(self) -> None:
         for m in self.new_messages:
-            save_message(self.conn, self.chat_id, m[0], m[1], m[2])
+            save_message(self.conn, self.chat_id, m.time, m.role, m.content, m.tool_data)
+        self.new_messages = []
 
     def save_context(self) -> None:
         save_context(self.conn, self.chat_id, str(self.context))
 
+    def save_turn(self, turn_id: str) -> bool:
+        # The new messages and the context together, once per turn id.
+        saved = save_turn(self.conn, self.chat_id, turn_id, self.new_messages, str(self.context))
+        self.new_messages = []
+        return saved
+
     def clear(self) -> None:
         self.messages = []
         self.new_messages = []
+        self.pager.messages = self.messages
+        self.pager.end = 0
+        self.pager.unloaded = 0
 
     def initialize_chat(self) -> None:
         if len(self.messages) == 0:
-            self.chat_id = create_new_chat(self.conn)
+            self.chat_id = create_new_chat(self.conn, self.chat_id)
             print(f'{text_colors["yellow2"]}Chat ID: {self.chat_id}\n')
             self.add_message(SystemMessage(content='You are a helpful assistant.'))
         else:
             print(f'{text_colors["yellow2"]}Chat ID: {self.chat_id}\n')
-            for m in self.messages:
-                if isinstance(m, AIMessage) and m.content:
-                    print(f'{text_colors["blue2"]}{m.content}\n')
-                elif isinstance(m, HumanMessage):
-                    print(f'{text_colors["green2"]}{m.content}\n')
+            self.pager.show_last()
+
+
+def format_message(message: BaseMessage) -> str | None:
+    if isinstance(message, AIMessage) and message.content:
+        return f'{text_colors["blue2"]}{message.content}\n\n'
+    elif isinstance(message, HumanMessage):
+        return f'{text_colors["green2"]}{message.content}\n\n'
+    return None
@@ -0,0 +1,59 @@
+import argparse
+
+from chat_config import text_colors
+from db import *
+
+
+def get_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Lists and shows the chats from the catalog, without reading their messages.')
+    parser.add_argument('--db', type=str, default='chat_history.db')
+    parser.add_argument('-n', '--shards', type=int, help='Number of shards (`CHAT_DB_SHARDS` by default).')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    listing = commands.add_parser('list', help='Lists the chats, the most recently active first.')
+    listing.add_argument('-l', '--limit', type=int, default=20)
+    listing.add_argument('--before', type=str, help='Start after this chat, the last one of the previous page.')
+
+    show = commands.add_parser('show', help='Shows the statistics of a chat.')
+    show.add_argument('chat', type=str, help='Chat id, a unique prefix of it, or "last".')
+
+    commands.add_parser('rebuild', help='Recomputes the catalog from the messages of every chat.')
+    return parser.parse_args()
+
+
+def print_chat(chat: ChatSummary) -> None:
+    print(f'{text_colors["yellow2"]}{chat.chat_id}{text_colors["normal"]}  {chat.message_count:>6} messages  {chat.tokens:>8} tokens  '
+          f'{chat.last_time:<26}  {chat.title or ""}')
+
+
+def main():
+    args = get_arguments()
+    conn = init_db(args.db, args.shards)
+
+    if args.command == 'list':
+        before = None
+        if args.before:
+            chat = get_chat_summary(conn, resolve_chat_id(conn, args.before))
+            if chat is None:
+                raise SystemExit(f'Unknown chat: {args.before}')
+            before = (chat.last_time, chat.chat_id)
+        for chat in list_recent_chats(conn, args.limit, before):
+            print_chat(chat)
+    elif args.command == 'show':
+        chat = get_chat_summary(conn, resolve_chat_id(conn, args.chat))
+        if chat is None:
+            raise SystemExit(f'Unknown chat: {args.chat}')
+        print_chat(chat)
+        print(f'First message: {chat.first_time}')
+    elif args.command == 'rebuild':
+        chats = 0
+        for shard in all_shards(conn):
+            chats += rebuild_catalog(shard)
+            shard.commit()
+        print(f'{text_colors["yellow2"]}Rebuilt the catalog of {chats} chats.{text_colors["normal"]}')
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
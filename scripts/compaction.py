@@ -0,0 +1,93 @@
+import argparse
+import datetime
+from dotenv import load_dotenv
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import HumanMessage, SystemMessage
+from typing import Callable
+
+from chat_config import get_chat_model, text_colors
+from db import *
+from schemas import ContextOutput, decode_context, encode_context
+
+
+EXTRACTIVE_SUMMARY_SIZE: int = 2000
+
+Summarizer = Callable[[ContextOutput, list[tuple[int, str, str, str]]], ContextOutput]
+
+
+def get_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Folds old messages into the chat context and archives them.')
+    parser.add_argument('-c', '--chatid', type=str, help='Compact only this chat (all the chats with a context by default).')
+    parser.add_argument('-k', '--keep-last', type=int, default=20, help='Number of recent messages kept in the hot table.')
+    parser.add_argument('-a', '--max-age-days', type=float, help='Only compact messages older than this many days.')
+    parser.add_argument('-v', '--vendor', type=str, choices=['openai', 'groq', 'fake', 'failover'], help='Summarize with a model instead of extractively.')
+    parser.add_argument('--db', type=str, default='chat_history.db')
+    parser.add_argument('-n', '--shards', type=int, help='Number of shards (`CHAT_DB_SHARDS` by default).')
+    parser.add_argument('--vacuum-pages', type=int, default=0, help='Free pages returned by the incremental vacuum (0 for all).')
+    return parser.parse_args()
+
+
+def summarize_extractive(context: ContextOutput, rows: list[tuple[int, str, str, str]]) -> ContextOutput:
+    lines = [context.chat_summary] if context.chat_summary else []
+    lines.extend(f'{role}: {content}' for _, _, role, content in rows)
+    summary = '\n'.join(lines)[-EXTRACTIVE_SUMMARY_SIZE:]
+    return ContextOutput(chat_summary=summary, user_data=context.user_data)
+
+def create_summarizer(model: BaseChatModel) -> Summarizer:
+    llm = model.with_structured_output(ContextOutput)
+
+    def summarize(context: ContextOutput, rows: list[tuple[int, str, str, str]]) -> ContextOutput:
+        transcript = '\n'.join(f'{role}: {content}' for _, _, role, content in rows)
+        result: ContextOutput = llm.invoke([
+            SystemMessage(content=(
+                'You are a context agent. Merge the older messages of the conversation into the current context.\n'
+                'Keep the relevant user information, useful facts and summaries, as briefly as possible.'
+            )),
+            HumanMessage(content=f'Current context:\n{context}\n\nOlder messages:\n{transcript}')
+        ]) # type: ignore
+        return result
+
+    return summarize
+
+
+def compact_chat(conn: Connection, chat_id: str, summarize: Summarizer, keep_last: int, older_than: datetime.datetime | None) -> int:
+    rows = fetch_compactable_messages(conn, chat_id, keep_last, older_than)
+    if len(rows) == 0: return 0
+
+    context = summarize(decode_context(fetch_context(conn, chat_id)), rows)
+    archive_messages(conn, chat_id, rows, encode_context(context))
+    return len(rows)
+
+
+def main():
+    load_dotenv()
+    args = get_arguments()
+    conn = init_db(args.db, args.shards)
+
+    summarize = create_summarizer(get_chat_model(args.vendor)) if args.vendor else summarize_extractive
+    older_than = None
+    if args.max_age_days is not None:
+        older_than = datetime.datetime.now() - datetime.timedelta(days=args.max_age_days)
+
+    # Only the chats of script 08 have a context, which is how it reads the archived messages. The other scripts
+    # only send the stored messages, so their chats would lose the archived ones.
+    chat_ids = [resolve_chat_id(conn, args.chatid)] if args.chatid else list_chat_ids(conn)
+    total = 0
+    for chat_id in chat_ids:
+        if not fetch_context(conn, chat_id):
+            if args.chatid:
+                print(f'{text_colors["yellow2"]}{chat_id} has no context (it is not a chat of script 08), it is not compacted.')
+            continue
+        count = compact_chat(conn, chat_id, summarize, args.keep_last, older_than)
+        if count > 0:
+            print(f'{text_colors["yellow2"]}{chat_id}: archived {count} messages.')
+        total += count
+
+    incremental_vacuum(conn, args.vacuum_pages)
+    print(f'{text_colors["normal"]}Archived {total} messages from {len(chat_ids)} chats.')
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
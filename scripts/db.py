@@ -1,10 +1,131 @@
 import datetime
+import glob
+import hashlib
+import json
+import os
+import re
 import sqlite3
+import threading
 import uuid
-from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+import zlib
+from collections import OrderedDict
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+from typing import Callable, NamedTuple
 
-def init_db() -> sqlite3.Connection:
-    conn = sqlite3.connect('chat_history.db')
+from search_results import estimate_tokens
+from tracing import traced
+
+
+# Message bodies shorter than this are stored as they are, compressing them would save little or nothing.
+BLOB_COMPRESS_SIZE: int = 64
+
+# Decoded message bodies kept in memory by their hash, so the bodies repeated across chats are decoded once.
+BLOB_CACHE_SIZE: int = 1024
+
+# Longest title of a chat in the catalog, taken from its first user message.
+TITLE_SIZE: int = 60
+
+# Seconds a connection waits for the lock held by another one, long enough for it to migrate a large file.
+DB_TIMEOUT: float = 300.0
+
+# Tables with the rows of a chat, in the order they are copied when a chat moves to another shard.
+CHAT_TABLES: list[str] = ['chats', 'chat_catalog', 'chat_turns', 'messages', 'messages_archive']
+
+# Upper bound of the sequence numbers (the largest SQLite integer), the end of the last page of a chat.
+MAX_SEQ: int = 2 ** 63 - 1
+
+
+class ChatSummary(NamedTuple):
+    chat_id: str
+    message_count: int
+    tokens: int
+    first_time: str | None
+    last_time: str | None
+    title: str | None
+
+
+class HistoryPage(NamedTuple):
+    messages: list[BaseMessage]
+    start: int  # Sequence number of the first message, the next older page ends before it.
+    earlier: int  # Messages before the page, not read.
+
+
+def shard_of(chat_id: str, shards: int) -> int:
+    # A stable hash (unlike `hash`, which changes between processes), so a chat always goes to the same shard or worker.
+    return int.from_bytes(hashlib.blake2b(chat_id.encode('utf-8'), digest_size=8).digest(), 'big') % shards
+
+def shard_paths(path: str, shards: int) -> list[str]:
+    # `chat_history.db` is split in `chat_history.0.db`, `chat_history.1.db`, ...
+    if shards == 1: return [path]
+    root, extension = os.path.splitext(path)
+    return [f'{root}.{i}{extension}' for i in range(shards)]
+
+def find_shard_files(path: str) -> list[str]:
+    # The existing files of any layout of `path`, the unsharded file first.
+    root, extension = os.path.splitext(path)
+    pattern = re.compile(re.escape(root) + r'\.(\d+)' + re.escape(extension) + '$')
+    numbered = [(int(m.group(1)), f) for f in glob.glob(glob.escape(root) + '.*' + extension) if (m := pattern.match(f))]
+    return ([path] if os.path.exists(path) else []) + [f for _, f in sorted(numbered)]
+
+
+class ShardedConnection:
+    """
+        Chats and their messages partitioned across several SQLite files by the hash of the chat id, so writes to
+        different chats do not wait for the same database lock. Each file records the layout it belongs to.
+    """
+
+    def __init__(self, paths: list[str]):
+        self.paths: list[str] = paths
+        self.shards: list[sqlite3.Connection] = [open_db(path) for path in paths]
+        for index, shard in enumerate(self.shards):
+            shard.execute('CREATE TABLE IF NOT EXISTS shard_layout (shard INTEGER, shards INTEGER);')
+            layout = shard.execute('SELECT shard, shards FROM shard_layout;').fetchone()
+            if layout is None:
+                shard.execute('INSERT INTO shard_layout (shard, shards) VALUES (?, ?);', (index, len(paths)))
+                shard.commit()
+            elif tuple(layout) != (index, len(paths)):
+                self.close()
+                raise ValueError(f'{paths[index]} is shard {layout[0]} of {layout[1]}, run `python shards.py rebalance` to change the number of shards.')
+
+    def for_chat(self, chat_id: str) -> sqlite3.Connection:
+        return self.shards[shard_of(chat_id, len(self.shards))]
+
+    def close(self) -> None:
+        for shard in self.shards:
+            shard.close()
+
+
+Connection = sqlite3.Connection | ShardedConnection
+
+def shard_for(conn: Connection, chat_id: str) -> sqlite3.Connection:
+    return conn.for_chat(chat_id) if isinstance(conn, ShardedConnection) else conn
+
+def all_shards(conn: Connection) -> list[sqlite3.Connection]:
+    return conn.shards if isinstance(conn, ShardedConnection) else [conn]
+
+
+def init_db(path: str = 'chat_history.db', shards: int | None = None) -> Connection:
+    # The number of shards is read from `CHAT_DB_SHARDS` (1, a single file, by default).
+    shards = shards or int(os.environ.get('CHAT_DB_SHARDS', 1))
+    # Files of another layout would hide their chats.
+    paths = shard_paths(path, shards)
+    if any(f not in paths for f in find_shard_files(path)):
+        raise ValueError(f'{path} is stored in other files, run `python shards.py rebalance -n {shards}` first.')
+    return open_db(path) if shards == 1 else ShardedConnection(paths)
+
+def open_db(path: str, version: int | None = None) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=DB_TIMEOUT)
+    # Required by `incremental_vacuum`. It takes effect on a new file right away, while a file created without it
+    # is converted once by a `VACUUM` (which rebuilds the file, and cannot run inside the migration transactions).
+    conn.cursor().execute('PRAGMA auto_vacuum = INCREMENTAL;')
+    if conn.execute('PRAGMA auto_vacuum;').fetchone()[0] != 2:
+        conn.execute('VACUUM;')
+    migrate(conn, version or SCHEMA_VERSION)
+    return conn
+
+
+def migrate_v1(conn: sqlite3.Connection) -> None:
+    # The first schema, databases created before the migrations may already have it.
     conn.cursor().execute(
         """
             CREATE TABLE IF NOT EXISTS chats (
@@ -21,74 +142,452 @@ def init_db() -> sqlite3.Connection:
                 time TIMESTAMP,
                 role TEXT,
                 content TEXT,
+                tool_data TEXT,
                 FOREIGN KEY(chat_id) REFERENCES chats(chat_id)
             );
         """
     )
-    conn.commit()
-    return conn
+    # Databases created before the tool messages were stored lack their column.
+    if 'tool_data' not in [row[1] for row in conn.cursor().execute('PRAGMA table_info(messages);')]:
+        conn.cursor().execute('ALTER TABLE messages ADD COLUMN tool_data TEXT;')
+    conn.cursor().execute(
+        """
+            CREATE TABLE IF NOT EXISTS message_payloads (
+                message_id TEXT PRIMARY KEY,
+                payload BLOB,
+                FOREIGN KEY(message_id) REFERENCES messages(message_id)
+            );
+        """
+    )
+    conn.cursor().execute(
+        """
+            CREATE INDEX IF NOT EXISTS messages_chat_time
+            ON messages (chat_id, time);
+        """
+    )
+    conn.cursor().execute(
+        """
+            CREATE TABLE IF NOT EXISTS messages_archive (
+                archive_id TEXT PRIMARY KEY,
+                chat_id TEXT,
+                first_time TIMESTAMP,
+                last_time TIMESTAMP,
+                message_count INTEGER,
+                payload BLOB,
+                FOREIGN KEY(chat_id) REFERENCES chats(chat_id)
+            );
+        """
+    )
+
+def migrate_v2(conn: sqlite3.Connection) -> None:
+    # Messages are keyed by their chat and a sequence number within it, stored clustered by that key, so the
+    # messages of a chat are contiguous and in order, and new ones are appended at the end of their chat.
+    conn.cursor().execute(
+        """
+            CREATE TABLE messages_v2 (
+                chat_id TEXT,
+                seq INTEGER,
+                time TIMESTAMP,
+                role TEXT,
+                content TEXT,
+                tool_data TEXT,
+                PRIMARY KEY (chat_id, seq),
+                FOREIGN KEY(chat_id) REFERENCES chats(chat_id)
+            ) WITHOUT ROWID;
+        """
+    )
+    conn.cursor().execute(
+        """
+            CREATE TABLE message_payloads_v2 (
+                chat_id TEXT,
+                seq INTEGER,
+                payload BLOB,
+                PRIMARY KEY (chat_id, seq),
+                FOREIGN KEY(chat_id, seq) REFERENCES messages(chat_id, seq)
+            );
+        """
+    )
+    # The existing messages are numbered in the order they were read until now.
+    conn.cursor().execute(
+        """
+            CREATE TEMP TABLE message_seqs AS
+            SELECT message_id, chat_id, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY time, rowid) AS seq
+            FROM messages;
+        """
+    )
+    conn.cursor().execute(
+        """
+            INSERT INTO messages_v2 (chat_id, seq, time, role, content, tool_data)
+            SELECT m.chat_id, s.seq, m.time, m.role, m.content, m.tool_data FROM messages m
+            JOIN message_seqs s ON s.message_id = m.message_id;
+        """
+    )
+    conn.cursor().execute(
+        """
+            INSERT INTO message_payloads_v2 (chat_id, seq, payload)
+            SELECT s.chat_id, s.seq, p.payload FROM message_payloads p
+            JOIN message_seqs s ON s.message_id = p.message_id;
+        """
+    )
+    conn.cursor().execute('DROP TABLE message_seqs;')
+    conn.cursor().execute('DROP TABLE message_payloads;')
+    conn.cursor().execute('DROP TABLE messages;')
+    conn.cursor().execute('ALTER TABLE messages_v2 RENAME TO messages;')
+    conn.cursor().execute('ALTER TABLE message_payloads_v2 RENAME TO message_payloads;')
+
+
+def migrate_v3(conn: sqlite3.Connection) -> None:
+    # Message bodies move to a content-addressed table, where the messages with the same body (like the system
+    # prompt of every chat, or repeated prompts and answers) share one compressed copy.
+    conn.cursor().execute(
+        """
+            CREATE TABLE blobs (
+                blob_id INTEGER PRIMARY KEY,
+                digest BLOB UNIQUE,
+                body BLOB,
+                refs INTEGER
+            );
+        """
+    )
+    conn.cursor().execute(
+        """
+            CREATE TABLE messages_v3 (
+                chat_id TEXT,
+                seq INTEGER,
+                time TIMESTAMP,
+                role TEXT,
+                blob_id INTEGER,
+                tool_data TEXT,
+                PRIMARY KEY (chat_id, seq),
+                FOREIGN KEY(chat_id) REFERENCES chats(chat_id),
+                FOREIGN KEY(blob_id) REFERENCES blobs(blob_id)
+            ) WITHOUT ROWID;
+        """
+    )
+    cursor = conn.cursor()
+    for chat_id, seq, time, role, content, tool_data, payload in conn.cursor().execute(
+        """
+            SELECT m.chat_id, m.seq, m.time, m.role, m.content, m.tool_data, p.payload FROM messages m
+            LEFT JOIN message_payloads p ON p.chat_id = m.chat_id AND p.seq = m.seq;
+        """
+    ):
+        content = zlib.decompress(payload).decode('utf-8') if payload is not None else content
+        cursor.execute(
+            'INSERT INTO messages_v3 (chat_id, seq, time, role, blob_id, tool_data) VALUES (?, ?, ?, ?, ?, ?);',
+            (chat_id, seq, time, role, store_blob(cursor, content), tool_data)
+        )
+    conn.cursor().execute('DROP TABLE message_payloads;')
+    conn.cursor().execute('DROP TABLE messages;')
+    conn.cursor().execute('ALTER TABLE messages_v3 RENAME TO messages;')
+
+
+def migrate_v4(conn: sqlite3.Connection) -> None:
+    # The chat catalog keeps the statistics of each chat, updated with every message, so listing the chats
+    # only reads the catalog (by its index of recent activity) instead of aggregating their messages.
+    conn.cursor().execute(
+        """
+            CREATE TABLE chat_catalog (
+                chat_id TEXT PRIMARY KEY,
+                message_count INTEGER,
+                tokens INTEGER,
+                first_time TIMESTAMP,
+                last_time TIMESTAMP,
+                title TEXT,
+                FOREIGN KEY(chat_id) REFERENCES chats(chat_id)
+            );
+        """
+    )
+    # Chats without messages have an empty `last_time` (not NULL), so they are still paged through, as the oldest.
+    conn.cursor().execute('CREATE INDEX chat_catalog_recent ON chat_catalog (last_time, chat_id);')
+    rebuild_catalog(conn)
 
-def create_new_chat(conn: sqlite3.Connection) -> str:
-    chat_id = str(uuid.uuid4())
+def migrate_v5(conn: sqlite3.Connection) -> None:
+    # The ids of the turns saved with `save_turn`, so a turn sent again (e.g. after its worker died) is not saved twice.
+    conn.cursor().execute(
+        """
+            CREATE TABLE chat_turns (
+                chat_id TEXT,
+                turn_id TEXT,
+                PRIMARY KEY (chat_id, turn_id),
+                FOREIGN KEY(chat_id) REFERENCES chats(chat_id)
+            ) WITHOUT ROWID;
+        """
+    )
+
+
+# The schema version of a database is its `user_version`, and `MIGRATIONS[i]` upgrades it from version i to i + 1.
+MIGRATIONS: list[Callable[[sqlite3.Connection], None]] = [migrate_v1, migrate_v2, migrate_v3, migrate_v4, migrate_v5]
+SCHEMA_VERSION: int = len(MIGRATIONS)
+
+def migrate(conn: sqlite3.Connection, version: int = SCHEMA_VERSION) -> int:
+    current: int = conn.execute('PRAGMA user_version;').fetchone()[0]
+    if current > SCHEMA_VERSION:
+        raise ValueError(f'The database schema (version {current}) is newer than this code (version {SCHEMA_VERSION}).')
+
+    # Each migration is applied in its own transaction, together with the new version number. The transactions take
+    # the write lock first, and the version is read again inside them, since other processes (e.g. the workers of
+    # the pool) may be opening the file at the same time and have migrated it while this one waited.
+    while current < version:
+        conn.execute('BEGIN IMMEDIATE;')
+        try:
+            current = conn.execute('PRAGMA user_version;').fetchone()[0]
+            if current < version:
+                MIGRATIONS[current](conn)
+                current += 1
+                conn.execute(f'PRAGMA user_version = {current};')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return max(current, version)
+
+
+def content_hash(content: str) -> bytes:
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+
+def encode_blob(content: str) -> bytes | str:
+    # Bodies are compressed when it makes them smaller, and kept as text otherwise (the type tells them apart).
+    data = content.encode('utf-8')
+    if len(data) >= BLOB_COMPRESS_SIZE:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data): return compressed
+    return content
+
+def inflate_blob(body: bytes | str) -> str:
+    return zlib.decompress(body).decode('utf-8') if isinstance(body, bytes) else body
+
+
+_decoded_blobs: OrderedDict[bytes, str] = OrderedDict()
+_decoded_lock = threading.Lock()
+
+def cache_blob(digest: bytes, content: str) -> None:
+    with _decoded_lock:
+        _decoded_blobs[digest] = content
+        _decoded_blobs.move_to_end(digest)
+        if len(_decoded_blobs) > BLOB_CACHE_SIZE:
+            _decoded_blobs.popitem(last=False)
+
+def decode_blob(digest: bytes, body: bytes | str) -> str:
+    with _decoded_lock:
+        if digest in _decoded_blobs:
+            _decoded_blobs.move_to_end(digest)
+            return _decoded_blobs[digest]
+    content = inflate_blob(body)
+    cache_blob(digest, content)
+    return content
+
+def clear_blob_cache() -> None:
+    with _decoded_lock:
+        _decoded_blobs.clear()
+
+def store_blob(cursor: sqlite3.Cursor, content: str, refs: int = 1) -> int:
+    # A body already stored only gets more references, it is compressed and inserted the first time. Messages
+    # refer to it by its (small) integer id, the digest is only used to find it.
+    digest = content_hash(content)
+    found = cursor.execute('UPDATE blobs SET refs = refs + ? WHERE digest = ? RETURNING blob_id;', (refs, digest)).fetchone()
+    if found is None:
+        found = cursor.execute('INSERT INTO blobs (digest, body, refs) VALUES (?, ?, ?) RETURNING blob_id;', (digest, encode_blob(content), refs)).fetchone()
+    cache_blob(digest, content)
+    return found[0]
+
+def release_blobs(cursor: sqlite3.Cursor, blob_ids: list[int]) -> None:
+    # Removes one reference per id (of each deleted message), and the bodies left without any.
+    cursor.executemany('UPDATE blobs SET refs = refs - 1 WHERE blob_id = ?;', [(blob_id,) for blob_id in blob_ids])
+    cursor.executemany('DELETE FROM blobs WHERE blob_id = ? AND refs <= 0;', [(blob_id,) for blob_id in set(blob_ids)])
+
+@traced('db')
+def create_new_chat(conn: Connection, chat_id: str | None = None) -> str:
+    # A chat id chosen by the caller (e.g. to route the chat before it exists) is kept if it is already there.
+    chat_id = chat_id or str(uuid.uuid4())
+    conn = shard_for(conn, chat_id)
     cursor = conn.cursor()
     cursor.execute(
         """
-            INSERT INTO chats
+            INSERT OR IGNORE INTO chats
             (chat_id, context) VALUES (?, ?);
         """,
         [chat_id, '']
     )
+    now = datetime.datetime.now()
+    cursor.execute(
+        """
+            INSERT OR IGNORE INTO chat_catalog (chat_id, message_count, tokens, first_time, last_time, title)
+            VALUES (?, 0, 0, ?, ?, NULL);
+        """,
+        (chat_id, now, now)
+    )
     conn.commit()
     return chat_id
 
-def fetch_history(conn: sqlite3.Connection, chat_id: str) -> tuple[list[BaseMessage], str]:
+@traced('db')
+def fetch_history(conn: Connection, chat_id: str) -> tuple[list[BaseMessage], str]:
+    conn = shard_for(conn, chat_id)
     cursor = conn.cursor()
     cursor.execute(
         """
-            SELECT role, content FROM messages
-            WHERE chat_id = ?
-            ORDER BY time ASC;
+            SELECT m.role, b.digest, b.body, m.tool_data FROM messages m
+            JOIN blobs b ON b.blob_id = m.blob_id
+            WHERE m.chat_id = ?
+            ORDER BY m.seq ASC;
         """,
         [chat_id]
     )
-    rows: list[tuple[str, str]] = cursor.fetchall()
+    rows: list[tuple[str, bytes, bytes | str, str | None]] = cursor.fetchall()
+    context = fetch_context(conn, chat_id)
+    return pair_tool_messages(decode_messages(rows)), context
 
-    cursor.execute(
+@traced('db')
+def fetch_history_page(conn: Connection, chat_id: str, turns: int, before: int | None = None) -> HistoryPage:
+    """
+        Reads the last `turns` user turns of a chat before the message `before` (its end by default), walking the
+        primary key backwards, so only the rows of the page are read and decoded whatever the length of the chat.
+        The system message that opens the chat is part of the last page, and is not counted in the older ones.
+    """
+    conn = shard_for(conn, chat_id)
+    cursor = conn.cursor()
+    end = before if before is not None else MAX_SEQ
+    opening = cursor.execute('SELECT seq, role FROM messages WHERE chat_id = ? ORDER BY seq ASC LIMIT 1;', [chat_id]).fetchone()
+    floor = opening[0] if opening is not None and opening[1] == 'system' else 0
+
+    row = cursor.execute(
         """
-            SELECT context FROM chats
-            WHERE chat_id = ?;
+            SELECT seq FROM messages
+            WHERE chat_id = ? AND seq > ? AND seq < ? AND role = 'user'
+            ORDER BY seq DESC LIMIT 1 OFFSET ?;
         """,
-        [chat_id]
-    )
-    context = cursor.fetchone()
-    context: str = context[0] if isinstance(context, list) else ''
+        [chat_id, floor, end, max(1, turns) - 1]
+    ).fetchone()
+    start = row[0] if row is not None else floor + 1
+
+    query = """
+        SELECT m.role, b.digest, b.body, m.tool_data FROM messages m
+        JOIN blobs b ON b.blob_id = m.blob_id
+        WHERE m.chat_id = ? AND m.seq >= ? AND m.seq < ?
+        ORDER BY m.seq ASC;
+    """
+    rows: list[tuple[str, bytes, bytes | str, str | None]] = cursor.execute(query, [chat_id, start, end]).fetchall()
+    if before is None and floor > 0:
+        rows = cursor.execute(query, [chat_id, floor, floor + 1]).fetchall() + rows
+    earlier = cursor.execute('SELECT COUNT(*) FROM messages WHERE chat_id = ? AND seq > ? AND seq < ?;', [chat_id, floor, start]).fetchone()[0]
+    return HistoryPage(pair_tool_messages(decode_messages(rows)), start, earlier)
 
+def decode_messages(rows: list[tuple[str, bytes, bytes | str, str | None]]) -> list[BaseMessage]:
     chat: list[BaseMessage] = []
-    for role, content in rows:
+    for role, digest, body, tool_data in rows:
+        content = decode_blob(digest, body)
+        data = json.loads(tool_data) if tool_data else {}
+
         if role == 'system':
             chat.append(SystemMessage(content))
         elif role == 'user':
             chat.append(HumanMessage(content))
         elif role == 'assistant':
-            chat.append(AIMessage(content))
+            tool_calls = [{'name': name, 'args': args, 'id': call_id, 'type': 'tool_call'} for name, args, call_id in data.get('tool_calls', [])]
+            chat.append(AIMessage(content, name=data.get('name'), tool_calls=tool_calls))
+        elif role == 'tool':
+            chat.append(ToolMessage(content, name=data.get('name'), tool_call_id=data['tool_call_id']))
         else:
             raise ValueError(f'Unknown role in DB: {role}')
-    return chat, context
+    return chat
+
+def get_tool_data(message: BaseMessage) -> str | None:
+    # Tool calls are stored as `[name, args, id]` lists, and tool results with the id of their call.
+    if isinstance(message, AIMessage) and message.tool_calls:
+        data = {'name': message.name, 'tool_calls': [[tc['name'], tc['args'], tc['id']] for tc in message.tool_calls]}
+    elif isinstance(message, ToolMessage):
+        data = {'name': message.name, 'tool_call_id': message.tool_call_id}
+    else:
+        return None
+    return json.dumps(data, separators=(',', ':'))
+
+def pair_tool_messages(chat: list[BaseMessage]) -> list[BaseMessage]:
+    # The vendors reject tool results without their call and calls without their results, which are left
+    # when the older messages of a chat are archived, or when a turn is not saved entirely.
+    answered = {m.tool_call_id for m in chat if isinstance(m, ToolMessage)}
+    called: set[str] = set()
+    paired: list[BaseMessage] = []
+    for m in chat:
+        if isinstance(m, ToolMessage):
+            if m.tool_call_id in called: paired.append(m)
+        elif isinstance(m, AIMessage) and m.tool_calls:
+            tool_calls = [tc for tc in m.tool_calls if tc['id'] in answered]
+            called.update(str(tc['id']) for tc in tool_calls)
+            if tool_calls or m.content:
+                paired.append(m if len(tool_calls) == len(m.tool_calls) else AIMessage(m.content, name=m.name, tool_calls=tool_calls))
+        else:
+            paired.append(m)
+    return paired
 
-def save_message(conn: sqlite3.Connection, chat_id: str, time: datetime.datetime, role: str, content: str) -> None:
+@traced('db')
+def fetch_context(conn: Connection, chat_id: str) -> str:
+    conn = shard_for(conn, chat_id)
     cursor = conn.cursor()
-    message_id = str(uuid.uuid4())
+    cursor.execute(
+        """
+            SELECT context FROM chats
+            WHERE chat_id = ?;
+        """,
+        [chat_id]
+    )
+    context = cursor.fetchone()
+    return context[0] if isinstance(context, tuple) else ''
+
+@traced('db')
+def save_message(conn: Connection, chat_id: str, time: datetime.datetime, role: str, content: str, tool_data: str | None = None) -> None:
+    conn = shard_for(conn, chat_id)
+    insert_message(conn.cursor(), chat_id, time, role, content, tool_data)
+    conn.commit()
 
+def insert_message(cursor: sqlite3.Cursor, chat_id: str, time: datetime.datetime, role: str, content: str, tool_data: str | None = None) -> None:
+    blob_id = store_blob(cursor, content)
+    # The sequence number is taken in the same statement, so concurrent writers of a chat cannot take the same one.
     cursor.execute(
         """
-            INSERT INTO messages (message_id, chat_id, time, role, content)
-            VALUES (?, ?, ?, ?, ?);
+            INSERT INTO messages (chat_id, seq, time, role, blob_id, tool_data)
+            SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ?, ? FROM messages WHERE chat_id = ?;
         """,
-        (message_id, chat_id, time, role, content)
+        (chat_id, time, role, blob_id, tool_data, chat_id)
     )
+    # The catalog is updated in the same transaction, so its statistics always match the saved messages.
+    cursor.execute(
+        """
+            INSERT INTO chat_catalog (chat_id, message_count, tokens, first_time, last_time, title)
+            VALUES (?, 1, ?, ?, ?, ?)
+            ON CONFLICT (chat_id) DO UPDATE SET
+                message_count = message_count + 1,
+                tokens = tokens + excluded.tokens,
+                first_time = MIN(COALESCE(first_time, excluded.first_time), excluded.first_time),
+                last_time = MAX(COALESCE(last_time, excluded.last_time), excluded.last_time),
+                title = COALESCE(title, excluded.title);
+        """,
+        (chat_id, estimate_tokens(content), time, time, chat_title(content) if role == 'user' else None)
+    )
+
+@traced('db')
+def save_turn(conn: Connection, chat_id: str, turn_id: str, messages: list[tuple[datetime.datetime, str, str, str | None]], context: str) -> bool:
+    """
+        Saves the messages and the context of a turn, and its id, in one transaction. A turn already saved is not
+        saved again, and `False` is returned.
+    """
+    conn = shard_for(conn, chat_id)
+    cursor = conn.cursor()
+    cursor.execute('INSERT OR IGNORE INTO chat_turns (chat_id, turn_id) VALUES (?, ?);', (chat_id, turn_id))
+    if cursor.rowcount == 0:
+        conn.rollback()
+        return False
+
+    for time, role, content, tool_data in messages:
+        insert_message(cursor, chat_id, time, role, content, tool_data)
+    cursor.execute('UPDATE chats SET context = ? WHERE chat_id = ?;', (context, chat_id))
     conn.commit()
+    return True
+
+def is_turn_saved(conn: Connection, chat_id: str, turn_id: str) -> bool:
+    return shard_for(conn, chat_id).execute('SELECT 1 FROM chat_turns WHERE chat_id = ? AND turn_id = ?;', (chat_id, turn_id)).fetchone() is not None
 
-def save_context(conn: sqlite3.Connection, chat_id: str, context: str) -> None:
+@traced('db')
+def save_context(conn: Connection, chat_id: str, context: str) -> None:
+    conn = shard_for(conn, chat_id)
     cursor = conn.cursor()
 
     cursor.execute(
@@ -101,3 +600,203 @@ def save_context(conn: sqlite3.Connection, chat_id: str, context: str) -> None:
     )
 
     conn.commit()
+
+
+def fetch_compactable_messages(conn: Connection, chat_id: str, keep_last: int, older_than: datetime.datetime | None) -> list[tuple[int, str, str, str]]:
+    conn = shard_for(conn, chat_id)
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+            SELECT m.seq, m.time, m.role, b.body FROM messages m
+            JOIN blobs b ON b.blob_id = m.blob_id
+            WHERE m.chat_id = ? AND m.role != 'system'
+            ORDER BY m.seq ASC;
+        """,
+        [chat_id]
+    )
+    rows = cursor.fetchall()
+    end = max(0, len(rows) - keep_last)
+    if older_than is not None:
+        end = next((i for i, row in enumerate(rows[:end]) if str(row[1]) >= str(older_than)), end)
+    # Like the window of `ChatHistory`, the cut is moved back to the call of the first kept tool results, so a
+    # call and its results are archived or kept together (the results of an archived call would be dropped).
+    while 0 < end < len(rows) and rows[end][2] == 'tool':
+        end -= 1
+    return [(seq, time, role, inflate_blob(body)) for seq, time, role, body in rows[:end]]
+
+@traced('db')
+def archive_messages(conn: Connection, chat_id: str, rows: list[tuple[int, str, str, str]], context: str) -> None:
+    if len(rows) == 0: return
+
+    conn = shard_for(conn, chat_id)
+    payload = zlib.compress(json.dumps([[str(time), role, content] for _, time, role, content in rows]).encode('utf-8'))
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+            INSERT INTO messages_archive (archive_id, chat_id, first_time, last_time, message_count, payload)
+            VALUES (?, ?, ?, ?, ?, ?);
+        """,
+        (str(uuid.uuid4()), chat_id, rows[0][1], rows[-1][1], len(rows), payload)
+    )
+    release_blobs(cursor, [
+        cursor.execute('SELECT blob_id FROM messages WHERE chat_id = ? AND seq = ?;', (chat_id, row[0])).fetchone()[0] for row in rows
+    ])
+    cursor.executemany('DELETE FROM messages WHERE chat_id = ? AND seq = ?;', [(chat_id, row[0]) for row in rows])
+    cursor.execute('UPDATE chats SET context = ? WHERE chat_id = ?;', (context, chat_id))
+    conn.commit()
+
+def fetch_archived_messages(conn: Connection, chat_id: str) -> list[tuple[str, str, str]]:
+    conn = shard_for(conn, chat_id)
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+            SELECT payload FROM messages_archive
+            WHERE chat_id = ?
+            ORDER BY first_time ASC;
+        """,
+        [chat_id]
+    )
+    messages: list[tuple[str, str, str]] = []
+    for (payload,) in cursor.fetchall():
+        messages.extend(tuple(m) for m in json.loads(zlib.decompress(payload).decode('utf-8')))
+    return messages
+
+def list_chat_ids(conn: Connection) -> list[str]:
+    return [chat_id for shard in all_shards(conn) for (chat_id,) in shard.execute('SELECT chat_id FROM chats;').fetchall()]
+
+def chat_title(content: str) -> str | None:
+    title = ' '.join(content.split())
+    if len(title) > TITLE_SIZE:
+        title = title[:TITLE_SIZE - 3].rsplit(' ', 1)[0] + '...'
+    return title or None
+
+def rebuild_catalog(conn: sqlite3.Connection) -> int:
+    """
+        Recomputes the catalog of every chat of a file from its messages, including the archived ones
+        (which are still part of the chat, only folded into its context).
+    """
+    summaries: dict[str, ChatSummary] = {}
+    def add(chat_id: str, time: str, role: str, content: str) -> None:
+        summary = summaries.get(chat_id) or ChatSummary(chat_id, 0, 0, str(time), str(time), None)
+        summaries[chat_id] = summary._replace(
+            message_count=summary.message_count + 1,
+            tokens=summary.tokens + estimate_tokens(content),
+            first_time=min(str(summary.first_time), str(time)),
+            last_time=max(str(summary.last_time), str(time)),
+            title=summary.title if summary.title is not None or role != 'user' else chat_title(content)
+        )
+
+    for chat_id, payload in conn.execute('SELECT chat_id, payload FROM messages_archive ORDER BY chat_id, first_time;'):
+        for time, role, content in json.loads(zlib.decompress(payload).decode('utf-8')):
+            add(chat_id, time, role, content)
+    for chat_id, time, role, body in conn.execute('SELECT m.chat_id, m.time, m.role, b.body FROM messages m JOIN blobs b ON b.blob_id = m.blob_id ORDER BY m.chat_id, m.seq;'):
+        add(chat_id, time, role, inflate_blob(body))
+
+    conn.execute('DELETE FROM chat_catalog;')
+    conn.executemany(
+        'INSERT INTO chat_catalog (chat_id, message_count, tokens, first_time, last_time, title) VALUES (?, ?, ?, ?, ?, ?);',
+        [summaries.get(chat_id) or ChatSummary(chat_id, 0, 0, '', '', None) for (chat_id,) in conn.execute('SELECT chat_id FROM chats;').fetchall()]
+    )
+    return len(summaries)
+
+def list_recent_chats(conn: Connection, limit: int = 20, before: tuple[str, str] | None = None) -> list[ChatSummary]:
+    # The most recently active chats of all the shards, read from the index of the catalog. `before` is the
+    # `(last_time, chat_id)` of the last chat of the previous page.
+    chats: list[ChatSummary] = []
+    for shard in all_shards(conn):
+        chats.extend(ChatSummary(*row) for row in shard.execute(
+            f"""
+                SELECT chat_id, message_count, tokens, first_time, last_time, title FROM chat_catalog
+                {'WHERE (last_time, chat_id) < (?, ?)' if before is not None else ''}
+                ORDER BY last_time DESC, chat_id DESC
+                LIMIT ?;
+            """,
+            (*(before or ()), limit)
+        ))
+    return sorted(chats, key=lambda chat: (str(chat.last_time), chat.chat_id), reverse=True)[:limit]
+
+def get_chat_summary(conn: Connection, chat_id: str) -> ChatSummary | None:
+    row = shard_for(conn, chat_id).execute(
+        'SELECT chat_id, message_count, tokens, first_time, last_time, title FROM chat_catalog WHERE chat_id = ?;', [chat_id]
+    ).fetchone()
+    return ChatSummary(*row) if row is not None else None
+
+def resolve_chat_id(conn: Connection, text: str | None) -> str | None:
+    """
+        Finds the chat given by the user (the `--chatid` option) by its id, a unique prefix of its id, or `last` for
+        the most recently active one. Anything else is returned unchanged, as the id of a new chat.
+        Ids given by programs are used as they are, so they are never resolved to another chat.
+    """
+    if not text: return text
+    if text == 'last':
+        recent = list_recent_chats(conn, 1)
+        return recent[0].chat_id if recent else text
+    if get_chat_summary(conn, text) is not None: return text
+
+    matches = [chat_id for shard in all_shards(conn) for (chat_id,) in shard.execute(
+        'SELECT chat_id FROM chats WHERE chat_id >= ? AND chat_id < ? LIMIT 2;', (text, text + '\uffff')
+    )]
+    if len(matches) > 1:
+        raise ValueError(f'More than one chat id starts with {text}.')
+    return matches[0] if matches else text
+
+def search_messages(conn: Connection, text: str, limit: int = 20) -> list[tuple[str, str, str, str]]:
+    # Messages of any shard that contain `text` (ignoring case), the most recent first. The bodies are compressed,
+    # so each distinct body is decoded and searched once, and then the messages that use the matching ones are listed.
+    needle = text.lower()
+    found: list[tuple[str, str, str, str]] = []
+    for shard in all_shards(conn):
+        matches = {blob_id: content for blob_id, body in shard.execute('SELECT blob_id, body FROM blobs;') if needle in (content := inflate_blob(body)).lower()}
+        if len(matches) == 0: continue
+
+        cursor = shard.execute('SELECT chat_id, time, role, blob_id FROM messages;')
+        found.extend(
+            (chat_id, time, role, matches[blob_id]) for chat_id, time, role, blob_id in cursor if blob_id in matches
+        )
+    return sorted(found, key=lambda message: str(message[1]), reverse=True)[:limit]
+
+def export_chat(conn: sqlite3.Connection, chat_id: str) -> dict[str, tuple[list[str], list[tuple]]]:
+    # The columns and rows of a chat in each of its tables, and the bodies of its messages, to copy it to another file.
+    exported: dict[str, tuple[list[str], list[tuple]]] = {}
+    for table in CHAT_TABLES:
+        cursor = conn.execute(f'SELECT * FROM {table} WHERE chat_id = ?;', [chat_id])
+        rows = cursor.fetchall()
+        exported[table] = ([column[0] for column in cursor.description], rows)
+    exported['blobs'] = (['blob_id', 'body'], conn.execute(
+        'SELECT DISTINCT b.blob_id, b.body FROM blobs b JOIN messages m ON m.blob_id = b.blob_id WHERE m.chat_id = ?;', [chat_id]
+    ).fetchall())
+    return exported
+
+def import_chat(conn: sqlite3.Connection, chat_id: str, exported: dict[str, tuple[list[str], list[tuple]]]) -> None:
+    # Replaces a previous copy of the chat (e.g. after an interrupted move), so its rows and body references are not
+    # duplicated. The bodies get the ids they have (or take) in this file.
+    cursor = conn.cursor()
+    delete_chat_rows(cursor, chat_id)
+    columns, rows = exported['messages']
+    column = columns.index('blob_id')
+    refs = {blob_id: 0 for blob_id, _ in exported['blobs'][1]}
+    for row in rows:
+        refs[row[column]] += 1
+    blob_ids = {blob_id: store_blob(cursor, inflate_blob(body), refs[blob_id]) for blob_id, body in exported['blobs'][1]}
+    exported = {**exported, 'messages': (columns, [row[:column] + (blob_ids[row[column]],) + row[column + 1:] for row in rows])}
+
+    for table in CHAT_TABLES:
+        columns, rows = exported[table]
+        if len(rows) == 0: continue
+        cursor.executemany(f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))});', rows)
+    conn.commit()
+
+def delete_chat(conn: sqlite3.Connection, chat_id: str) -> None:
+    delete_chat_rows(conn.cursor(), chat_id)
+    conn.commit()
+
+def delete_chat_rows(cursor: sqlite3.Cursor, chat_id: str) -> None:
+    # Without committing, so the deletion is part of the transaction of the caller.
+    release_blobs(cursor, [blob_id for (blob_id,) in cursor.execute('SELECT blob_id FROM messages WHERE chat_id = ?;', [chat_id]).fetchall()])
+    for table in reversed(CHAT_TABLES):
+        cursor.execute(f'DELETE FROM {table} WHERE chat_id = ?;', [chat_id])
+
+def incremental_vacuum(conn: Connection, pages: int = 0) -> None:
+    for shard in all_shards(conn):
+        # `execute` steps the pragma once, which frees a single page, while a script runs it to completion.
+        shard.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
@@ -0,0 +1,222 @@
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+from typing import Any, Callable, Iterator, Optional
+
+from model_wrappers import ChatModelWrapper
+from tracing import percentile
+
+
+class VendorStats:
+    def __init__(self):
+        self.calls: int = 0
+        self.errors: int = 0
+        self.timeouts: int = 0
+        self.consecutive_failures: int = 0
+        self.unhealthy_until: float = 0.0
+        self.latencies: deque[float] = deque(maxlen=200)
+
+    def is_healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def expected_latency(self) -> float:
+        # Vendors without samples are tried first, so every vendor gets measured.
+        return percentile(list(self.latencies), 50) if self.latencies else 0.0
+
+    def summary(self) -> dict[str, Any]:
+        latencies = list(self.latencies)
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'healthy': self.is_healthy(),
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+        }
+
+
+class VendorCall:
+    # A call is recorded once: by its result, or as a timeout when it is abandoned, whichever comes first.
+    def __init__(self, vendor: str):
+        self.vendor: str = vendor
+        self.future: Future = Future()
+        self.recorded: bool = False
+
+
+class FailoverChatModel(ChatModelWrapper):
+    """
+        Chat model that holds one backend per vendor and sends each call to the healthy vendor with the lowest
+        median latency. Errors and timeouts fail over to the next vendor, and vendors that fail repeatedly are
+        skipped for a cooldown period. With `hedge`, a second vendor is called when the first one takes longer
+        than its p95 latency (or `hedge_delay`), and the first response wins.
+    """
+    backends: dict[str, BaseChatModel]
+    timeout: float = 60.0
+    hedge: bool = False
+    hedge_delay: Optional[float] = None
+    failure_threshold: int = 3
+    cooldown: float = 30.0
+
+    _stats: dict[str, VendorStats] = PrivateAttr(default_factory=dict)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _executor: ThreadPoolExecutor = PrivateAttr(default_factory=lambda: ThreadPoolExecutor(max_workers=16))
+
+    def model_post_init(self, context: Any) -> None:
+        self._stats = {vendor: VendorStats() for vendor in self.backends}
+
+    @property
+    def _llm_type(self) -> str:
+        return 'failover'
+
+    @property
+    def _identifying_params(self) -> dict[str, Any]:
+        return {'backends': {vendor: backend._identifying_params for vendor, backend in self.backends.items()}}
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        with self._lock:
+            return {vendor: stats.summary() for vendor, stats in self._stats.items()}
+
+    def vendor_order(self) -> list[str]:
+        # Vendors in their cooldown period are only tried when no vendor is healthy.
+        with self._lock:
+            healthy = [v for v in self.backends if self._stats[v].is_healthy()]
+            return sorted(healthy or self.backends, key=lambda v: self._stats[v].expected_latency())
+
+    def _generate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        submit = lambda vendor: self._submit(vendor, messages, stop, run_manager, **kwargs)
+        vendors = self.vendor_order()
+        if self.hedge and len(vendors) > 1:
+            return self._call_hedged(vendors, submit)
+        return self._call_in_order(vendors, None, submit)
+
+    def _call_in_order(self, vendors: list[str], error: BaseException | None, submit: Callable[[str], VendorCall]) -> Any:
+        for vendor in vendors:
+            call = submit(vendor)
+            try:
+                return call.future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                self._record_failure(vendor, timeout=True, call=call)
+                error = TimeoutError(f'{vendor} did not respond in {self.timeout} seconds.')
+            except Exception as e:
+                error = e
+        raise error # type: ignore
+
+    def _call_hedged(self, vendors: list[str], submit: Callable[[str], VendorCall]) -> Any:
+        primary, secondary = vendors[0], vendors[1]
+        with self._lock:
+            delay = self.hedge_delay if self.hedge_delay is not None else percentile(list(self._stats[primary].latencies), 95)
+
+        # Without latency samples (a delay of 0) the secondary is called right away. Both calls share the timeout.
+        deadline = time.monotonic() + self.timeout
+        first_call = submit(primary)
+        calls: dict[Future, VendorCall] = {first_call.future: first_call}
+        done, _ = wait(calls, timeout=min(delay, self.timeout))
+        if not done or first_call.future.exception() is not None:
+            second_call = submit(secondary)
+            calls[second_call.future] = second_call
+
+        pending: set[Future] = set(calls)
+        error: BaseException | None = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                for future in pending:
+                    self._record_failure(calls[future].vendor, timeout=True, call=calls[future])
+                error = TimeoutError(f'No vendor responded in {self.timeout} seconds.')
+                break
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+
+        # Both hedged calls failed, so the remaining vendors are tried in order.
+        return self._call_in_order(vendors[2:], error, submit)
+
+    def _stream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        # A stream fails over (and is hedged) like a call until its first chunk, which is bound by the timeout.
+        # Afterwards the error is raised to the caller.
+        submit = lambda vendor: self._submit_stream(vendor, messages, stop, run_manager, **kwargs)
+        vendors = self.vendor_order()
+        if self.hedge and len(vendors) > 1:
+            call, start, first_chunk, stream = self._call_hedged(vendors, submit)
+        else:
+            call, start, first_chunk, stream = self._call_in_order(vendors, None, submit)
+
+        if first_chunk is not None:
+            yield first_chunk
+            try:
+                yield from stream
+            except Exception:
+                self._record_failure(call.vendor, call=call)
+                raise
+        self._record_success(call.vendor, time.monotonic() - start, call=call)
+
+    def _submit(self, vendor: str, messages: list[BaseMessage], stop: Optional[list[str]],
+                run_manager: Optional[CallbackManagerForLLMRun], **kwargs: Any) -> VendorCall:
+        def run(call: VendorCall) -> ChatResult:
+            start = time.monotonic()
+            try:
+                result = self.backends[vendor]._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            except Exception:
+                self._record_failure(vendor, call=call)
+                raise
+            self._record_success(vendor, time.monotonic() - start, call=call)
+            for generation in result.generations:
+                generation.message.response_metadata['vendor'] = vendor
+            return result
+
+        return self._start(vendor, run)
+
+    def _submit_stream(self, vendor: str, messages: list[BaseMessage], stop: Optional[list[str]],
+                       run_manager: Optional[CallbackManagerForLLMRun], **kwargs: Any) -> VendorCall:
+        # The call completes with its first chunk (None for an empty stream), the rest is read by the caller.
+        def run(call: VendorCall) -> tuple[VendorCall, float, ChatGenerationChunk | None, Iterator[ChatGenerationChunk]]:
+            start = time.monotonic()
+            stream = self.backends[vendor]._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+            try:
+                first_chunk = next(stream, None)
+            except Exception:
+                self._record_failure(vendor, call=call)
+                raise
+            return call, start, first_chunk, stream
+
+        return self._start(vendor, run)
+
+    def _start(self, vendor: str, run: Callable[[VendorCall], Any]) -> VendorCall:
+        call = VendorCall(vendor)
+        # The call runs in a copy of the caller's context, so the cancellation, budget and tracer of the turn follow it.
+        call.future = self._executor.submit(contextvars.copy_context().run, run, call)
+        return call
+
+    def _record_success(self, vendor: str, latency: float, call: VendorCall | None = None) -> None:
+        with self._lock:
+            if call is not None:
+                if call.recorded: return
+                call.recorded = True
+            stats = self._stats[vendor]
+            stats.calls += 1
+            stats.consecutive_failures = 0
+            stats.latencies.append(latency)
+
+    def _record_failure(self, vendor: str, timeout: bool = False, call: VendorCall | None = None) -> None:
+        with self._lock:
+            if call is not None:
+                if call.recorded: return
+                call.recorded = True
+            stats = self._stats[vendor]
+            stats.calls += 1
+            stats.errors += 0 if timeout else 1
+            stats.timeouts += 1 if timeout else 0
+            stats.consecutive_failures += 1
+            if stats.consecutive_failures >= self.failure_threshold:
+                stats.unhealthy_until = time.monotonic() + self.cooldown
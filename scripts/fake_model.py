@@ -0,0 +1,213 @@
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import Field, PrivateAttr
+from typing import Any, Callable, Iterator, Optional
+
+from tool_registry import tool_schema
+
+
+ToolArgs = dict[str, Any] | Callable[[list[BaseMessage]], dict[str, Any]]
+
+PREFIX_CACHE_SIZE: int = 100000
+
+
+class FakeChatModel(BaseChatModel):
+    """
+        Deterministic chat model used to run the graphs without network access.
+        Scripted `responses` are returned first, in order. Afterwards, the model calls each bound tool once
+        per user message (in the order they were bound) and then answers with a fixed-size text.
+        A `failure_rate` makes a seeded fraction of the calls raise, to test the failover of the callers.
+        Like the vendors' prompt caching, the input tokens of the longest message prefix already seen (with the
+        same tools) are reported as cached.
+    """
+    responses: list[AIMessage | str] = Field(default_factory=list)
+    latency: float = 0.0
+    tokens_per_second: float = 0.0
+    answer_tokens: int = 20
+    tool_args: dict[str, ToolArgs] = Field(default_factory=dict)
+    failure_rate: float = 0.0
+    seed: int = 0
+
+    _script: deque = PrivateAttr(default_factory=deque)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _random: random.Random = PrivateAttr(default_factory=random.Random)
+    _prefixes: set[bytes] = PrivateAttr(default_factory=set)
+
+    def model_post_init(self, context: Any) -> None:
+        self._script.extend(self.responses)
+        self._random.seed(self.seed)
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake'
+
+    @property
+    def _identifying_params(self) -> dict[str, Any]:
+        return {'model_name': 'fake', 'latency': self.latency, 'tokens_per_second': self.tokens_per_second}
+
+    def bind_tools(self, tools: list, *, tool_choice: str | None = None, **kwargs: Any):
+        formatted_tools = [tool_schema(t) for t in tools]
+        return self.bind(tools=formatted_tools, tool_choice=tool_choice, **kwargs)
+
+    def _generate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        message = self.respond(messages, kwargs.get('tools') or [], kwargs.get('tool_choice'))
+        time.sleep(self.latency + self._generation_time(message))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        message = self.respond(messages, kwargs.get('tools') or [], kwargs.get('tool_choice'))
+        time.sleep(self.latency)
+
+        tokens = str(message.content).split(' ') if message.content else []
+        for i, token in enumerate(tokens):
+            if self.tokens_per_second > 0:
+                time.sleep(1 / self.tokens_per_second)
+            text = token if i == 0 else f' {token}'
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text, id=message.id))
+
+        yield ChatGenerationChunk(message=AIMessageChunk(
+            content='',
+            id=message.id,
+            tool_call_chunks=[
+                {'name': tc['name'], 'args': _dumps(tc['args']), 'id': tc['id'], 'index': i}
+                for i, tc in enumerate(message.tool_calls)
+            ],
+            usage_metadata=message.usage_metadata
+        ))
+
+    def respond(self, messages: list[BaseMessage], tools: list[dict], tool_choice: str | None) -> AIMessage:
+        with self._lock:
+            if self.failure_rate > 0 and self._random.random() < self.failure_rate:
+                raise RuntimeError('Fake model failure.')
+            scripted = self._script.popleft() if self._script else None
+        if scripted is not None:
+            message = AIMessage(content=scripted) if isinstance(scripted, str) else scripted.model_copy()
+        else:
+            message = self._policy(messages, tools, tool_choice)
+
+        message.id = message.id or f'run-{uuid.uuid4()}'
+        input_tokens = sum(count_tokens(str(m.content)) for m in messages)
+        output_tokens = count_tokens(str(message.content)) + sum(count_tokens(_dumps(tc['args'])) for tc in message.tool_calls)
+        message.usage_metadata = {
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'total_tokens': input_tokens + output_tokens,
+            'input_token_details': {'cache_read': self._cached_tokens(messages, tools)}
+        }
+        return message
+
+    def _cached_tokens(self, messages: list[BaseMessage], tools: list[dict]) -> int:
+        digest = hashlib.blake2b(_dumps(tools).encode('utf-8'), digest_size=16)
+        cached = prefix_tokens = 0
+        hit = True
+        with self._lock:
+            if len(self._prefixes) > PREFIX_CACHE_SIZE: self._prefixes.clear()
+            for m in messages:
+                digest.update(f'{m.type}\0{m.name}\0{m.content}\0{getattr(m, "tool_calls", "")}\0'.encode('utf-8'))
+                key = digest.copy().digest()
+                prefix_tokens += count_tokens(str(m.content))
+                hit = hit and key in self._prefixes
+                if hit: cached = prefix_tokens
+                self._prefixes.add(key)
+        return cached
+
+    def _policy(self, messages: list[BaseMessage], tools: list[dict], tool_choice: str | None) -> AIMessage:
+        turn = _current_turn(messages)
+        question = str(turn[0].content) if turn and isinstance(turn[0], HumanMessage) else ''
+
+        if tools and tool_choice not in (None, 'auto', 'none'):
+            return self._tool_call(tools[0], messages)
+
+        called = {tc['name'] for m in turn if isinstance(m, AIMessage) for tc in m.tool_calls}
+        for t in tools:
+            if t['function']['name'] not in called:
+                return self._tool_call(t, messages)
+
+        words = (question.split() or ['answer'])
+        content = ' '.join(words[i % len(words)] for i in range(self.answer_tokens))
+        return AIMessage(content=content)
+
+    def _tool_call(self, tool: dict, messages: list[BaseMessage]) -> AIMessage:
+        name = tool['function']['name']
+        args = self.tool_args.get(name)
+        if callable(args):
+            args = args(messages)
+        if args is None:
+            turn = _current_turn(messages)
+            text = str(turn[0].content) if turn else 'fake'
+            args = example_arguments(tool['function'].get('parameters', {}), text)
+        return AIMessage(content='', tool_calls=[{'name': name, 'args': args, 'id': f'call_{uuid.uuid4().hex[:24]}', 'type': 'tool_call'}])
+
+    def _generation_time(self, message: AIMessage) -> float:
+        if self.tokens_per_second <= 0: return 0.0
+        return count_tokens(str(message.content)) / self.tokens_per_second
+
+
+def fake_search(latency: float = 0.0) -> Callable[[str], dict]:
+    def search(query: str) -> dict:
+        time.sleep(latency)
+        # Shaped like the SearchApi results, with the metadata and duplicated entries of a real response.
+        return {
+            'search_metadata': {'id': f'search_{abs(hash(query))}', 'status': 'Success', 'total_time_taken': latency},
+            'search_parameters': {'engine': 'google', 'q': query, 'device': 'desktop', 'google_domain': 'google.com'},
+            'search_information': {'query_displayed': query, 'total_results': 1000000, 'time_taken_displayed': 0.3},
+            'organic_results': [
+                {
+                    'position': i + 1, 'title': f'{query} ({i % 5 + 1})', 'link': f'https://example.com/{i % 5 + 1}',
+                    'displayed_link': f'example.com > {i % 5 + 1}', 'favicon': f'https://example.com/{i % 5 + 1}/favicon.ico',
+                    'snippet': f'Fake result {i % 5 + 1} for {query}. ' * 3,
+                    'sitelinks': {'inline': [{'title': f'Section {j}', 'link': f'https://example.com/{i % 5 + 1}#{j}'} for j in range(3)]}
+                }
+                for i in range(8)
+            ],
+            'related_questions': [{'question': f'What is {query}?', 'answer': f'Fake answer for {query}.', 'source': {'link': 'https://example.com/faq'}}],
+            'related_searches': [{'query': f'{query} {suffix}', 'link': f'https://google.com/search?q={suffix}'} for suffix in ['news', 'today', 'wiki']]
+        }
+
+    return search
+
+
+def count_tokens(text: str) -> int:
+    return len(text.split())
+
+def example_arguments(schema: dict[str, Any], text: str) -> Any:
+    if 'anyOf' in schema:
+        options = [s for s in schema['anyOf'] if s.get('type') != 'null']
+        return example_arguments(options[0], text) if options else None
+    if 'enum' in schema:
+        return schema['enum'][0]
+
+    schema_type = schema.get('type', 'object')
+    if schema_type == 'object':
+        properties: dict[str, Any] = schema.get('properties', {})
+        required = schema.get('required', list(properties))
+        return {key: example_arguments(value, text) for key, value in properties.items() if key in required or 'default' not in value}
+    elif schema_type == 'string':
+        return text
+    elif schema_type in ('number', 'integer'):
+        return 1
+    elif schema_type == 'boolean':
+        return False
+    elif schema_type == 'array':
+        return []
+    return None
+
+def _current_turn(messages: list[BaseMessage]) -> list[BaseMessage]:
+    for i in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[i], HumanMessage):
+            return messages[i:]
+    return list(messages)
+
+def _dumps(args: dict[str, Any]) -> str:
+    return json.dumps(args)
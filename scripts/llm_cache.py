@@ -0,0 +1,226 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import ConfigDict
+from typing import Any, Iterator, Optional
+
+from model_wrappers import ChatModelWrapper
+
+
+DEFAULT_CACHE_PATH: str = 'llm_cache.db'
+
+# Agents whose model calls are cached (`LLM_CACHE_AGENTS`, comma separated, replaces them). Their prompts repeat
+# the most (static system prompts plus short messages), while the writer's answers should not be replayed.
+CACHED_AGENTS: set[str] = set(filter(None, os.environ.get(
+    'LLM_CACHE_AGENTS', 'router,supervisor,research_supervisor,calculator_supervisor,research_agent,calculator_agent'
+).split(',')))
+
+# Words per streamed chunk when a cached response is replayed.
+REPLAY_CHUNK_WORDS: int = 4
+
+
+class ResponseCache:
+    """
+        Exact-match cache of model responses, persisted in SQLite and bounded in size with LRU eviction.
+        Keys hash the model parameters (including the bound tools) and the messages, without their ids, so the same
+        prompt of a different turn or chat is a hit. Tool call ids are numbered by their position in the prompt,
+        since every replay gets new ones.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = 64 * 1024 * 1024):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    response TEXT,
+                    size INTEGER,
+                    last_used REAL
+                );
+            """
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used);')
+        self.conn.commit()
+        self.max_bytes: int = max_bytes
+        self.lock = threading.Lock()
+        self.size: int = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self.wrappers: dict[int, tuple[BaseChatModel, BaseChatModel]] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+        self.stores: int = 0
+        self.evictions: int = 0
+
+    def lookup(self, key: str) -> dict[str, Any] | None:
+        with self.lock:
+            row = self.conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute('UPDATE responses SET last_used = ? WHERE key = ?', (time.time(), key))
+            self.conn.commit()
+            return json.loads(row[0])
+
+    def update(self, key: str, response: dict[str, Any]) -> None:
+        data = json.dumps(response)
+        with self.lock:
+            previous = self.conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', (key, data, len(data), time.time()))
+            self.size += len(data) - (previous[0] if previous else 0)
+            self.stores += 1
+            self._evict()
+            self.conn.commit()
+
+    def wrap(self, model: BaseChatModel) -> BaseChatModel:
+        # One wrapper per model, so the tool bindings of the wrapper are shared too.
+        with self.lock:
+            cached = self.wrappers.get(id(model))
+            if cached is None or cached[0] is not model:
+                cached = (model, CachedChatModel(model=model, responses=self, metadata=model.metadata))
+                self.wrappers[id(model)] = cached
+            return cached[1]
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            entries = self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'entries': entries,
+                'bytes': self.size,
+            }
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes:
+            rows = self.conn.execute('SELECT key, size FROM responses ORDER BY last_used LIMIT 64').fetchall()
+            if not rows: break
+            for key, size in rows:
+                if self.size <= self.max_bytes: break
+                self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.size -= size
+                self.evictions += 1
+
+
+class CachedChatModel(ChatModelWrapper):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    model: BaseChatModel
+    responses: ResponseCache
+
+    @property
+    def _llm_type(self) -> str:
+        return f'cached-{self.model._llm_type}'
+
+    @property
+    def _identifying_params(self) -> dict[str, Any]:
+        return self.model._identifying_params
+
+    def _generate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        key = self._key(messages, stop, kwargs)
+        cached = self.responses.lookup(key)
+        if cached is not None:
+            return ChatResult(generations=[ChatGeneration(message=replay_message(cached))])
+
+        result = self.model._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        if len(result.generations) == 1:
+            self.responses.update(key, store_message(result.generations[0].message))
+        return result
+
+    def _stream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        key = self._key(messages, stop, kwargs)
+        cached = self.responses.lookup(key)
+        if cached is not None:
+            yield from replay_chunks(cached)
+            return
+
+        message: AIMessageChunk | None = None
+        for chunk in self.model._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            message = chunk.message if message is None else message + chunk.message # type: ignore
+            yield chunk
+        if message is not None:
+            self.responses.update(key, store_message(message))
+
+    def _key(self, messages: list[BaseMessage], stop: Optional[list[str]], kwargs: dict[str, Any]) -> str:
+        payload = json.dumps([self.model._get_llm_string(stop=stop, **kwargs), normalize_messages(messages)], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def normalize_messages(messages: list[BaseMessage]) -> list[dict[str, Any]]:
+    tool_call_ids: dict[str, str] = {}
+    def normalize_id(tool_call_id: str | None) -> str:
+        return tool_call_ids.setdefault(str(tool_call_id), f'call_{len(tool_call_ids)}')
+
+    normalized: list[dict[str, Any]] = []
+    for m in messages:
+        item: dict[str, Any] = {'type': m.type, 'name': m.name, 'content': m.content}
+        if isinstance(m, AIMessage) and m.tool_calls:
+            item['tool_calls'] = [{'name': t['name'], 'args': t['args'], 'id': normalize_id(t['id'])} for t in m.tool_calls]
+        if isinstance(m, ToolMessage):
+            item['tool_call_id'] = normalize_id(m.tool_call_id)
+        normalized.append(item)
+    return normalized
+
+def store_message(message: BaseMessage) -> dict[str, Any]:
+    tool_calls = message.tool_calls if isinstance(message, AIMessage) else []
+    return {
+        'content': message.content,
+        'tool_calls': [{'name': t['name'], 'args': t['args']} for t in tool_calls],
+        'model_name': message.response_metadata.get('model_name'),
+    }
+
+def replay_message(cached: dict[str, Any]) -> AIMessage:
+    # Replayed responses get new tool call ids, and no token usage since no tokens were spent.
+    return AIMessage(
+        content=cached['content'],
+        tool_calls=[{'name': t['name'], 'args': t['args'], 'id': f'call_{uuid.uuid4().hex[:24]}', 'type': 'tool_call'} for t in cached['tool_calls']],
+        response_metadata={'model_name': cached['model_name'], 'cache_hit': True}
+    )
+
+def replay_chunks(cached: dict[str, Any]) -> Iterator[ChatGenerationChunk]:
+    message = replay_message(cached)
+    content = message.content if isinstance(message.content, str) else ''
+    words = content.split(' ')
+    for i in range(0, len(words), REPLAY_CHUNK_WORDS):
+        text = ' '.join(words[i:i + REPLAY_CHUNK_WORDS]) + (' ' if i + REPLAY_CHUNK_WORDS < len(words) else '')
+        yield ChatGenerationChunk(message=AIMessageChunk(content=text))
+
+    yield ChatGenerationChunk(message=AIMessageChunk(
+        content='' if isinstance(message.content, str) else message.content,
+        tool_call_chunks=[
+            {'name': t['name'], 'args': json.dumps(t['args']), 'id': t['id'], 'index': i, 'type': 'tool_call_chunk'}
+            for i, t in enumerate(message.tool_calls)
+        ],
+        response_metadata=message.response_metadata
+    ))
+
+
+_cache: ResponseCache | None = None
+
+def create_response_cache(path: str | None) -> ResponseCache | None:
+    # The cache size is read from `LLM_CACHE_MAX_MB`.
+    global _cache
+    _cache = ResponseCache(path, int(float(os.environ.get('LLM_CACHE_MAX_MB', 64)) * 1024 * 1024)) if path else None
+    return _cache
+
+def get_response_cache() -> ResponseCache | None:
+    return _cache
+
+def cached_model(model: BaseChatModel, agent_name: str) -> BaseChatModel:
+    if _cache is None or agent_name not in CACHED_AGENTS: return model
+    return _cache.wrap(model)
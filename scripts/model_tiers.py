@@ -0,0 +1,61 @@
+import os
+from langchain_core.language_models import BaseChatModel
+from typing import Callable
+
+from llm_cache import cached_model
+from scheduler import Priority, with_priority
+
+
+# Internal steps (routing, delegation, search queries, math and context summaries) run on the fast tier,
+# while the answers written to the user run on the strong tier.
+AGENT_TIERS: dict[str, str] = {
+    'router': 'fast',
+    'supervisor': 'fast',
+    'research_supervisor': 'fast',
+    'calculator_supervisor': 'fast',
+    'research_agent': 'fast',
+    'calculator_agent': 'fast',
+    'context_agent': 'fast',
+    'writer_agent': 'strong',
+}
+# Agents whose output is read by another agent and not by the user, scheduled after the answers of the waiting turns.
+INTERNAL_AGENTS: set[str] = {'router', 'research_supervisor', 'calculator_supervisor', 'research_agent', 'context_agent'}
+TIERS: list[str] = ['fast', 'strong']
+DEFAULT_TIER: str = 'strong'
+
+TIER_MODELS: dict[str, dict[str, str]] = {
+    'openai': {'fast': 'gpt-4.1-nano', 'strong': 'gpt-4o-mini'},
+    'groq': {'fast': 'llama-3.1-8b-instant', 'strong': 'llama-3.3-70b-versatile'},
+}
+
+
+def get_model_name(vendor: str, tier: str | None = None) -> str:
+    # `<VENDOR>_<TIER>_MODEL` (e.g. `GROQ_FAST_MODEL=gemma2-9b-it`) replaces the model of a tier.
+    tier = tier or DEFAULT_TIER
+    return os.environ.get(f'{vendor.upper()}_{tier.upper()}_MODEL', TIER_MODELS[vendor][tier])
+
+
+class ModelTiers:
+    """
+        Chat models by tier, each one instantiated once and shared by all the agents of its tier.
+        Agents without a configured tier use the default (strong) tier.
+    """
+
+    def __init__(self, models: dict[str, BaseChatModel]):
+        self.models: dict[str, BaseChatModel] = models
+
+    def for_agent(self, agent_name: str) -> BaseChatModel:
+        return self.models.get(AGENT_TIERS.get(agent_name, DEFAULT_TIER), self.models[DEFAULT_TIER])
+
+
+ChatModels = BaseChatModel | ModelTiers
+
+def model_for(models: ChatModels, agent_name: str) -> BaseChatModel:
+    model = models.for_agent(agent_name) if isinstance(models, ModelTiers) else models
+    if agent_name in INTERNAL_AGENTS:
+        model = with_priority(model, Priority.INTERNAL, lower_only=True)
+    return cached_model(model, agent_name)
+
+def create_model_tiers(create_model: Callable[[str], BaseChatModel]) -> ModelTiers:
+    # The tier goes to the callbacks metadata, so the traces report the latency of each tier.
+    return ModelTiers({tier: create_model(tier).model_copy(update={'metadata': {'tier': tier}}) for tier in TIERS})
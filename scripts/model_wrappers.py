@@ -0,0 +1,23 @@
+from langchain_core.language_models import BaseChatModel
+from typing import Any
+
+from tool_registry import tool_schema
+
+
+class ChatModelWrapper(BaseChatModel):
+    """
+        Base class of the chat models that wrap other chat models (failover, scheduling, caching).
+        Tools are bound in the OpenAI format, which both the OpenAI and Groq models accept in their `_generate` kwargs.
+    """
+
+    def bind_tools(self, tools: list, *, tool_choice: str | dict | bool | None = None, **kwargs: Any):
+        formatted_tools = [tool_schema(t) for t in tools]
+        tool_names = [t['function']['name'] for t in formatted_tools]
+
+        if tool_choice:
+            if tool_choice in tool_names:
+                tool_choice = {'type': 'function', 'function': {'name': tool_choice}}
+            elif tool_choice == 'any' or tool_choice is True:
+                tool_choice = 'required'
+            kwargs['tool_choice'] = tool_choice
+        return self.bind(tools=formatted_tools, **kwargs)
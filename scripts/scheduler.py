@@ -0,0 +1,226 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from enum import IntEnum
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from pydantic import ConfigDict
+from typing import Any, Iterator, Optional
+
+from cancellation import TurnCancelled, is_cancelled
+from failover import FailoverChatModel
+from llm_cache import CachedChatModel
+from model_wrappers import ChatModelWrapper
+from tracing import get_tracer, percentile
+
+
+# Rough output allowance reserved for each call, settled with the real usage once the response arrives.
+EXPECTED_OUTPUT_TOKENS: int = 256
+
+# How often the waiting calls check whether their turn was cancelled, in seconds.
+CANCEL_POLL_INTERVAL: float = 0.25
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    INTERNAL = 1
+    BACKGROUND = 2
+
+
+class SchedulerBusy(RuntimeError):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity: float = per_minute
+        self.tokens: float = per_minute
+        self.rate: float = per_minute / 60
+        self.updated: float = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self.refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+
+class VendorQueue:
+    def __init__(self, requests_per_minute: float | None, tokens_per_minute: float | None):
+        self.requests: TokenBucket | None = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens: TokenBucket | None = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.waiting: list[tuple[int, int]] = []
+        self.waits: dict[Priority, deque[float]] = {p: deque(maxlen=1000) for p in Priority}
+        self.rejected: int = 0
+
+    def wait_time(self, tokens: int) -> float:
+        return max(
+            self.requests.wait_time(1) if self.requests else 0.0,
+            self.tokens.wait_time(tokens) if self.tokens else 0.0
+        )
+
+    def take(self, tokens: int) -> None:
+        if self.requests: self.requests.take(1)
+        if self.tokens: self.tokens.take(tokens)
+
+
+class RequestScheduler:
+    """
+        Shared client-side scheduler of the model calls. Each vendor has token buckets for requests and tokens
+        per minute, and the waiting calls are served by priority (then arrival order). When more than
+        `max_queue` calls are waiting for a vendor, new calls are rejected with `SchedulerBusy`, and the calls
+        of cancelled turns leave the queue.
+    """
+
+    def __init__(self, limits: dict[str, tuple[float | None, float | None]] | None = None, max_queue: int = 64):
+        self.limits = limits or {}
+        self.max_queue: int = max_queue
+        self.queues: dict[str, VendorQueue] = {}
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+
+    def _queue(self, vendor: str) -> VendorQueue:
+        if vendor not in self.queues:
+            self.queues[vendor] = VendorQueue(*self.limits.get(vendor, (None, None)))
+        return self.queues[vendor]
+
+    def acquire(self, vendor: str, tokens: int, priority: Priority = Priority.INTERACTIVE) -> float:
+        start = time.monotonic()
+        with self.condition:
+            queue = self._queue(vendor)
+            if len(queue.waiting) >= self.max_queue:
+                queue.rejected += 1
+                raise SchedulerBusy(f'{len(queue.waiting)} calls are already waiting for {vendor}.')
+
+            ticket = (int(priority), next(self.counter))
+            heapq.heappush(queue.waiting, ticket)
+            while True:
+                delay = queue.wait_time(tokens)
+                if queue.waiting[0] == ticket and delay == 0:
+                    heapq.heappop(queue.waiting)
+                    queue.take(tokens)
+                    self.condition.notify_all()
+                    break
+                if is_cancelled():
+                    # Calls of a cancelled turn leave the queue without being sent.
+                    queue.waiting.remove(ticket)
+                    heapq.heapify(queue.waiting)
+                    self.condition.notify_all()
+                    raise TurnCancelled()
+                self.condition.wait(timeout=min(delay, CANCEL_POLL_INTERVAL) if queue.waiting[0] == ticket else CANCEL_POLL_INTERVAL)
+
+            waited = time.monotonic() - start
+            queue.waits[priority].append(waited)
+        return waited
+
+    def settle(self, vendor: str, estimated_tokens: int, used_tokens: int) -> None:
+        with self.condition:
+            queue = self._queue(vendor)
+            if queue.tokens:
+                queue.tokens.take(used_tokens - estimated_tokens)
+
+    def metrics(self) -> dict[str, dict[str, Any]]:
+        with self.condition:
+            return {
+                vendor: {
+                    'waiting': len(queue.waiting),
+                    'rejected': queue.rejected,
+                    **{
+                        f'{priority.name.lower()}_wait_p{p}_ms': percentile(list(queue.waits[priority]), p) * 1000
+                        for priority in Priority if queue.waits[priority] for p in (50, 95, 99)
+                    }
+                }
+                for vendor, queue in self.queues.items()
+            }
+
+
+class ScheduledChatModel(ChatModelWrapper):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    model: BaseChatModel
+    scheduler: RequestScheduler
+    vendor: str
+    priority: Priority = Priority.INTERACTIVE
+
+    @property
+    def _llm_type(self) -> str:
+        return f'scheduled-{self.model._llm_type}'
+
+    @property
+    def _identifying_params(self) -> dict[str, Any]:
+        return self.model._identifying_params
+
+    def _generate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        estimated = self._acquire(messages)
+        result = self.model._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        usage = getattr(result.generations[0].message, 'usage_metadata', None) if result.generations else None
+        if usage:
+            self.scheduler.settle(self.vendor, estimated, usage['total_tokens'])
+        return result
+
+    def _stream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        estimated = self._acquire(messages)
+        used = 0
+        for chunk in self.model._stream(messages, stop=stop, **kwargs):
+            usage = getattr(chunk.message, 'usage_metadata', None)
+            used += usage['total_tokens'] if usage else 0
+            yield chunk
+        if used:
+            self.scheduler.settle(self.vendor, estimated, used)
+
+    def _acquire(self, messages: list[BaseMessage]) -> int:
+        estimated = estimate_tokens(messages) + EXPECTED_OUTPUT_TOKENS
+        waited = self.scheduler.acquire(self.vendor, estimated, self.priority)
+        tracer = get_tracer()
+        if tracer is not None:
+            tracer.add_span('queue', f'{self.vendor}/{self.priority.name.lower()}', waited)
+        return estimated
+
+
+def estimate_tokens(messages: list[BaseMessage]) -> int:
+    return sum(len(str(m.content)) for m in messages) // 4 + 4 * len(messages)
+
+
+_scheduler: RequestScheduler | None = None
+
+def get_scheduler() -> RequestScheduler:
+    # The limits of each vendor are read from `<VENDOR>_RPM` and `<VENDOR>_TPM`, unset means unlimited.
+    global _scheduler
+    if _scheduler is None:
+        limits: dict[str, tuple[float | None, float | None]] = {}
+        for vendor in ['openai', 'groq', 'fake']:
+            rpm = os.environ.get(f'{vendor.upper()}_RPM')
+            tpm = os.environ.get(f'{vendor.upper()}_TPM')
+            limits[vendor] = (float(rpm) if rpm else None, float(tpm) if tpm else None)
+        _scheduler = RequestScheduler(limits, int(os.environ.get('LLM_MAX_QUEUE', 64)))
+    return _scheduler
+
+def schedule(model: BaseChatModel, vendor: str, priority: Priority = Priority.INTERACTIVE) -> BaseChatModel:
+    # The backends of a failover model are scheduled each with the limits of its vendor, which it calls.
+    if isinstance(model, FailoverChatModel):
+        return model.model_copy(update={'backends': {v: schedule(backend, v, priority) for v, backend in model.backends.items()}})
+    return ScheduledChatModel(model=model, scheduler=get_scheduler(), vendor=vendor, priority=priority)
+
+def with_priority(model: BaseChatModel, priority: Priority, lower_only: bool = False) -> BaseChatModel:
+    # With `lower_only`, a model scheduled at a lower priority (e.g. the background batches) keeps it.
+    if isinstance(model, ScheduledChatModel):
+        return model.model_copy(update={'priority': max(model.priority, priority) if lower_only else priority})
+    if isinstance(model, CachedChatModel):
+        return model.model_copy(update={'model': with_priority(model.model, priority, lower_only)})
+    if isinstance(model, FailoverChatModel):
+        return model.model_copy(update={'backends': {v: with_priority(backend, priority, lower_only) for v, backend in model.backends.items()}})
+    return model
@@ -0,0 +1,53 @@
+import base64
+import io
+import pickle
+from functools import lru_cache
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Optional
+
+
+class UserData(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    name: Optional[str] = Field(None, description="User's name, if mentioned.")
+    age: Optional[int] = Field(None, description="User's age, if specified.")
+    gender: Optional[str] = Field(None, description="User's gender, if stated.")
+
+class ContextOutput(BaseModel):
+    """
+        Context agent structured output that keeps all the relevant information from the entire chatbot conversation.
+        Keep the context data as short as possible, while keeping the important information.
+    """
+    model_config = ConfigDict(frozen=True)
+
+    chat_summary: str = Field(..., description='Summary of the current conversation between the user and the chatbot system.')
+    user_data: UserData = Field(..., description='Relevant information about the user.')
+
+
+EMPTY_CONTEXT = ContextOutput(chat_summary='', user_data=UserData(name=None, age=None, gender=None))
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    # The pickled contexts reference the models as classes of script 08, which was run as `__main__`.
+    def find_class(self, module: str, name: str):
+        if module == '__main__' and name in ('ContextOutput', 'UserData'):
+            return globals()[name]
+        return super().find_class(module, name)
+
+
+# The models are frozen, so the same instance (and its rendering) can be shared until the context changes.
+@lru_cache(maxsize=64)
+def render_context(context: ContextOutput) -> str:
+    return context.model_dump_json(exclude_none=True)
+
+def encode_context(context: ContextOutput) -> str:
+    return context.model_dump_json()
+
+@lru_cache(maxsize=64)
+def decode_context(encoding: str) -> ContextOutput:
+    if encoding == '': return EMPTY_CONTEXT
+    if encoding.startswith('{'): return ContextOutput.model_validate_json(encoding)
+
+    # Contexts stored before the JSON encoding are base64 pickles.
+    legacy: ContextOutput = _LegacyUnpickler(io.BytesIO(base64.b64decode(encoding.encode('utf-8')))).load()
+    return ContextOutput.model_validate(legacy.model_dump())
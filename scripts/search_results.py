@@ -0,0 +1,109 @@
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Callable
+
+
+COMPACT_CACHE_SIZE: int = 128
+
+# Shortest snippet kept when an entry is truncated to fit the budget, in tokens.
+MIN_SNIPPET_TOKENS: int = 16
+
+# Fields kept from each section of the SearchApi results, in order of relevance.
+SECTIONS: list[tuple[str, list[str]]] = [
+    ('answer_box', ['title', 'answer', 'snippet', 'link', 'date']),
+    ('knowledge_graph', ['title', 'type', 'description']),
+    ('top_stories', ['title', 'source', 'link', 'date']),
+    ('organic_results', ['title', 'snippet', 'link', 'date']),
+    ('related_questions', ['question', 'answer', 'snippet']),
+]
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+def compact_results(results: dict, max_tokens: int) -> dict[str, Any]:
+    """
+        Keeps only the fields of the search results that help to answer (answers, titles, snippets, sources and dates),
+        without duplicated links or snippets, and as many entries as fit in `max_tokens`.
+    """
+    compacted: dict[str, Any] = {'query': (results.get('search_parameters') or {}).get('q', ''), 'results': []}
+    if 'error' in results:
+        compacted['error'] = str(results['error'])
+    used = estimate_tokens(json.dumps(compacted))
+    seen: set[str] = set()
+
+    for section, fields in SECTIONS:
+        items = results.get(section) or []
+        for item in ([items] if isinstance(items, dict) else items):
+            if not isinstance(item, dict): continue
+
+            entry = {field: str(item[field]).strip() for field in fields if item.get(field)}
+            keys = {' '.join(v.lower().split()) for k, v in entry.items() if k in ('link', 'snippet', 'answer', 'description')}
+            if not entry or keys & seen: continue
+
+            size = estimate_tokens(json.dumps(entry)) + 1
+            if used + size > max_tokens:
+                # The entry is cut to the remaining budget, if enough of it is left to be useful.
+                text_field = next((f for f in ('snippet', 'answer', 'description') if f in entry), None)
+                remaining = max_tokens - used - (size - estimate_tokens(entry.get(text_field, ''))) if text_field else 0
+                if text_field is not None and remaining >= MIN_SNIPPET_TOKENS:
+                    entry[text_field] = entry[text_field][:remaining * 4].rsplit(' ', 1)[0] + '...'
+                    compacted['results'].append(entry)
+                return compacted
+
+            seen.update(keys)
+            compacted['results'].append(entry)
+            used += size
+
+    return compacted
+
+
+class CompactSearch:
+    """
+        Web search that returns the compacted results, cached by query, so the searches repeated in a session
+        (and their compaction) are not made again. The statistics compare the size of the raw and compacted results.
+    """
+
+    def __init__(self, search: Callable[[str], dict], max_tokens: int):
+        self.search: Callable[[str], dict] = search
+        self.max_tokens: int = max_tokens
+        self.results: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.raw_tokens: int = 0
+        self.compact_tokens: int = 0
+
+    def __call__(self, query: str) -> dict[str, Any]:
+        with self.lock:
+            if query in self.results:
+                self.hits += 1
+                self.results.move_to_end(query)
+                return self.results[query]
+
+        raw = self.search(query)
+        compacted = compact_results(raw, self.max_tokens)
+        with self.lock:
+            self.misses += 1
+            self.raw_tokens += estimate_tokens(json.dumps(raw, default=str))
+            self.compact_tokens += estimate_tokens(json.dumps(compacted))
+            # Errors are not cached, so the search is retried.
+            if 'error' not in compacted:
+                self.results[query] = compacted
+                if len(self.results) > COMPACT_CACHE_SIZE:
+                    self.results.popitem(last=False)
+        return compacted
+
+    def clear(self) -> None:
+        with self.lock:
+            self.results.clear()
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'raw_tokens': self.raw_tokens,
+                'compact_tokens': self.compact_tokens,
+            }
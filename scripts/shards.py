@@ -0,0 +1,121 @@
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+
+from chat_config import text_colors
+from db import *
+
+
+def get_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Manages the chat history split across several SQLite files.')
+    parser.add_argument('--db', type=str, default='chat_history.db')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    rebalance = commands.add_parser('rebalance', help='Moves the chats of any existing layout to the given number of shards.')
+    rebalance.add_argument('-n', '--shards', type=int, required=True)
+
+    listing = commands.add_parser('list', help='Lists the chats of all the shards, the most recent first.')
+    listing.add_argument('-n', '--shards', type=int, help='Number of shards (`CHAT_DB_SHARDS` by default).')
+    listing.add_argument('-l', '--limit', type=int, default=20)
+
+    search = commands.add_parser('search', help='Searches the messages of all the shards.')
+    search.add_argument('text', type=str)
+    search.add_argument('-n', '--shards', type=int, help='Number of shards (`CHAT_DB_SHARDS` by default).')
+    search.add_argument('-l', '--limit', type=int, default=20)
+
+    bench = commands.add_parser('bench', help='Measures the write throughput of concurrent writers for each number of shards.')
+    bench.add_argument('-n', '--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    bench.add_argument('-w', '--writers', type=int, default=8, help='Concurrent writers, each with its own connection.')
+    bench.add_argument('-m', '--messages', type=int, default=200, help='Messages written by each writer.')
+    bench.add_argument('--chats', type=int, default=64)
+    return parser.parse_args()
+
+
+def rebalance(path: str, shards: int) -> int:
+    """
+        Moves every chat whose shard changes to its new file: it is copied and committed there first, and only then
+        deleted from its old file, so an interrupted rebalance loses nothing and is completed by running it again.
+        Each old file is locked for writing (`BEGIN IMMEDIATE`) from the listing of its chats until their deletion,
+        so the messages saved meanwhile wait for the move instead of being deleted without being copied.
+        The processes still running with the old layout keep writing to the old files, so they must be stopped first.
+    """
+    targets = shard_paths(path, shards)
+    files = {f: open_db(f) for f in dict.fromkeys(find_shard_files(path) + targets)}
+    moved = 0
+
+    for source, conn in files.items():
+        conn.execute('BEGIN IMMEDIATE;')
+        cursor = conn.cursor()
+        for chat_id in list_chat_ids(conn):
+            target = targets[shard_of(chat_id, shards)]
+            if target == source: continue
+            import_chat(files[target], chat_id, export_chat(conn, chat_id))
+            delete_chat_rows(cursor, chat_id)
+            moved += 1
+        conn.commit()
+
+    for f, conn in files.items():
+        conn.execute('DROP TABLE IF EXISTS shard_layout;')
+        conn.commit()
+        conn.close()
+        if f not in targets:
+            os.remove(f)
+
+    # The new layout is recorded in the files when they are opened.
+    init_db(path, shards).close()
+    return moved
+
+
+def run_bench(shard_counts: list[int], writers: int, messages: int, chats: int) -> None:
+    print(f'{"shards":>6} {"messages":>9} {"seconds":>8} {"msg/s":>8}')
+    for shards in shard_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bench.db')
+            conn = init_db(path, shards)
+            chat_ids = [create_new_chat(conn, str(uuid.uuid4())) for _ in range(chats)]
+            conn.close()
+
+            def write(seed: int) -> None:
+                # Each writer has its own connection, like the workers of the pool.
+                writer_conn = init_db(path, shards)
+                rng = random.Random(seed)
+                for i in range(messages):
+                    save_message(writer_conn, rng.choice(chat_ids), datetime.datetime.now(), 'user', f'Message {i} of writer {seed}.')
+                writer_conn.close()
+
+            threads = [threading.Thread(target=write, args=(seed,)) for seed in range(writers)]
+            start = time.perf_counter()
+            for thread in threads: thread.start()
+            for thread in threads: thread.join()
+            elapsed = time.perf_counter() - start
+
+        print(f'{shards:>6} {writers * messages:>9} {elapsed:>8.2f} {writers * messages / elapsed:>8.0f}')
+
+
+def main():
+    args = get_arguments()
+
+    if args.command == 'rebalance':
+        moved = rebalance(args.db, args.shards)
+        print(f'{text_colors["yellow2"]}Moved {moved} chats, {args.db} is now stored in {args.shards} files.{text_colors["normal"]}')
+    elif args.command == 'list':
+        conn = init_db(args.db, args.shards)
+        for chat in list_recent_chats(conn, args.limit):
+            print(f'{chat.chat_id}  {chat.message_count:>6} messages  {chat.last_time}  {chat.title or ""}')
+        conn.close()
+    elif args.command == 'search':
+        conn = init_db(args.db, args.shards)
+        for chat_id, time, role, content in search_messages(conn, args.text, args.limit):
+            print(f'{text_colors["yellow2"]}{chat_id} {time} {role}:{text_colors["normal"]} {content}')
+        conn.close()
+    elif args.command == 'bench':
+        run_bench(args.shards, args.writers, args.messages, args.chats)
+
+
+if __name__ == '__main__':
+    main()
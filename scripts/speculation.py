@@ -0,0 +1,99 @@
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+
+RESULT_CACHE_SIZE: int = 128
+
+
+class SearchPrefetcher:
+    """
+        Runs web searches speculatively, before it is known whether their results will be used.
+        Each query is searched at most once while its result is cached, and the statistics count the prefetches
+        that were used (and the search time they saved) and the ones that were discarded.
+    """
+
+    def __init__(self, search: Callable[[str], dict], max_workers: int = 4):
+        self.search: Callable[[str], dict] = search
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending: dict[str, tuple[Future, float]] = {}
+        self.results: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.requests: int = 0
+        self.searches: int = 0
+        self.hits: int = 0
+        self.discarded: int = 0
+        self.saved_seconds: float = 0.0
+        self.wasted_seconds: float = 0.0
+
+    def start(self, query: str) -> None:
+        with self.lock:
+            self.requests += 1
+            if query in self.results or query in self.pending: return
+            self.searches += 1
+            # The search runs in a copy of the caller's context, so its spans go to the turn that started it.
+            self.pending[query] = (self.executor.submit(contextvars.copy_context().run, self._timed_search, query), time.monotonic())
+
+    def take(self, query: str) -> dict | None:
+        with self.lock:
+            if query in self.results:
+                result, duration = self.results[query]
+                self.hits += 1
+                self.saved_seconds += duration
+                self.results.move_to_end(query)
+                return result
+            future, started = self.pending.pop(query, (None, 0.0))
+        if future is None: return None
+
+        # The search time that overlapped the routing is saved, the rest is still waited for here.
+        waited_from = time.monotonic()
+        try:
+            result, duration = future.result()
+        except Exception:
+            return None
+        with self.lock:
+            self.hits += 1
+            self.saved_seconds += max(0.0, min(duration, waited_from - started))
+            self._cache(query, result, duration)
+        return result
+
+    def discard(self, query: str) -> None:
+        with self.lock:
+            future, _ = self.pending.pop(query, (None, 0.0))
+        if future is None: return
+
+        with self.lock:
+            self.discarded += 1
+        if not future.cancel():
+            future.add_done_callback(self._count_waste)
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'searches': self.searches,
+                'hits': self.hits,
+                'discarded': self.discarded,
+                'hit_rate': self.hits / self.requests if self.requests else 0.0,
+                'saved_seconds': self.saved_seconds,
+                'wasted_seconds': self.wasted_seconds,
+            }
+
+    def _timed_search(self, query: str) -> tuple[dict, float]:
+        start = time.monotonic()
+        result = self.search(query)
+        return result, time.monotonic() - start
+
+    def _cache(self, query: str, result: dict, duration: float) -> None:
+        self.results[query] = (result, duration)
+        if len(self.results) > RESULT_CACHE_SIZE:
+            self.results.popitem(last=False)
+
+    def _count_waste(self, future: Future) -> None:
+        if future.exception() is not None: return
+        result, duration = future.result()
+        with self.lock:
+            self.wasted_seconds += duration
@@ -0,0 +1,98 @@
+import json
+import threading
+import weakref
+from collections import OrderedDict
+from langchain_core.language_models import BaseChatModel
+from langchain_core.runnables import Runnable
+from langchain_core.tools import BaseTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from typing import Any, Callable
+
+
+BINDING_CACHE_SIZE: int = 256
+
+
+class ToolRegistry:
+    """
+        Shared cache of the tools used by the graph builders. The JSON schema of each tool is generated once
+        (the returned dictionaries must not be modified), tools created by factories (e.g. the handoff tools)
+        are created once per key, and the models bound to a toolset are reused while the model is the same.
+    """
+
+    def __init__(self):
+        self.schemas: dict[int, tuple[weakref.ref, dict[str, Any]]] = {}
+        self.tools: dict[tuple, BaseTool] = {}
+        self.bindings: OrderedDict[tuple, tuple[BaseChatModel, Runnable]] = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def schema(self, tool: BaseTool | Callable | dict) -> dict[str, Any]:
+        if isinstance(tool, dict): return convert_to_openai_tool(tool)
+
+        # The tools are not hashable, so their schemas are keyed by their id. The tool is only referenced weakly,
+        # so the tools of rebuilt graphs (and the sub-agents they call) are not kept alive, and its schema is
+        # dropped along with it, before its id can be reused by another object.
+        with self.lock:
+            key = id(tool)
+            cached = self.schemas.get(key)
+            if cached is not None and cached[0]() is tool:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            schema = convert_to_openai_tool(tool)
+            self.schemas[key] = (weakref.ref(tool, lambda ref: self._forget(key, ref)), schema)
+            return schema
+
+    def _forget(self, key: int, ref: weakref.ref) -> None:
+        cached = self.schemas.get(key)
+        if cached is not None and cached[0] is ref:
+            self.schemas.pop(key, None)
+
+    def tool(self, key: tuple, factory: Callable[[], BaseTool]) -> BaseTool:
+        with self.lock:
+            if key not in self.tools:
+                self.misses += 1
+                self.tools[key] = factory()
+            else:
+                self.hits += 1
+            return self.tools[key]
+
+    def bind(self, model: BaseChatModel, tools: list, **kwargs: Any) -> Runnable:
+        if not tools: return model
+
+        # Keyed by the schemas of the tools (not only their names), so different tools with the same name are not merged.
+        schemas = [self.schema(t) for t in tools]
+        key = (id(model), json.dumps(schemas, sort_keys=True, default=str), json.dumps(kwargs, sort_keys=True, default=str))
+        with self.lock:
+            cached = self.bindings.get(key)
+            if cached is not None and cached[0] is model:
+                self.bindings.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+
+            self.misses += 1
+            binding = model.bind_tools(schemas, **kwargs)
+            self.bindings[key] = (model, binding)
+            if len(self.bindings) > BINDING_CACHE_SIZE:
+                self.bindings.popitem(last=False)
+            return binding
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                'schemas': len(self.schemas),
+                'tools': len(self.tools),
+                'bindings': len(self.bindings),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+registry = ToolRegistry()
+
+def tool_schema(tool: BaseTool | Callable | dict) -> dict[str, Any]:
+    return registry.schema(tool)
+
+def bind_tools(model: BaseChatModel, tools: list, **kwargs: Any) -> Runnable:
+    return registry.bind(model, tools, **kwargs)
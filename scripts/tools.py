@@ -1,5 +1,25 @@
+import os
 from langchain_core.tools import tool
 from langchain_community.utilities import SearchApiAPIWrapper
+from typing import Callable
+
+from search_results import CompactSearch
+
+
+def search_api(search_input: str) -> dict:
+    search = SearchApiAPIWrapper()
+    return search.results(search_input)
+
+search_backend: Callable[[str], dict] = search_api
+
+# The results sent to the models are compacted to `SEARCH_RESULT_TOKENS` tokens (400 by default).
+compact_search = CompactSearch(lambda query: search_backend(query), int(os.environ.get('SEARCH_RESULT_TOKENS', 400)))
+
+def set_search_backend(backend: Callable[[str], dict]) -> None:
+    global search_backend
+    search_backend = backend
+    compact_search.clear()
+
 
 @tool
 def web_search(search_input: str) -> dict:
@@ -8,8 +28,7 @@ def web_search(search_input: str) -> dict:
         Ideal for questions that requires recent data, such as news, ongoing events or constantly changing topics.
     """
 
-    search = SearchApiAPIWrapper()
-    return search.results(search_input)
+    return compact_search(search_input)
 
 
 @tool
@@ -0,0 +1,269 @@
+import argparse
+import datetime
+import functools
+import json
+import math
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+from langchain_core.tracers.context import register_configure_hook
+from typing import Any, Callable, Iterator, Optional
+from uuid import UUID
+
+
+class JsonlSink:
+    def __init__(self, path: str):
+        self.path: str = path
+        self.lock = threading.Lock()
+
+    def write(self, record: dict[str, Any]) -> None:
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(record) + '\n')
+
+
+class TurnTracer(BaseCallbackHandler):
+    """
+        Records the wall time of every graph node, model call, tool call and database function of a turn.
+        Model calls also record the time to the first token, the token usage and the model (and its tier) used.
+        The open turn is held by the context that started it, so the turns run concurrently (e.g. by several
+        threads sharing the tracer) each get their own spans.
+    """
+
+    def __init__(self, sink: JsonlSink):
+        self.sink: JsonlSink = sink
+        self.lock = threading.Lock()
+        self._turn_var: ContextVar[Optional[dict[str, Any]]] = ContextVar('open_turn', default=None)
+        self.paths: dict[UUID, str] = {}
+        self.starts: dict[UUID, float] = {}
+        self.first_tokens: dict[UUID, float] = {}
+        self.models: dict[UUID, str] = {}
+
+    @property
+    def turn(self) -> Optional[dict[str, Any]]:
+        return self._turn_var.get()
+
+    def start_turn(self, chat_id: str | None, user_input: str | None = None) -> None:
+        self._turn_var.set({
+            'turn_id': str(uuid.uuid4()),
+            'chat_id': chat_id,
+            'time': str(datetime.datetime.now()),
+            'start': time.perf_counter(),
+            'spans': []
+        })
+
+    def end_turn(self) -> dict[str, Any] | None:
+        turn = self._turn_var.get()
+        if turn is None: return None
+        self._turn_var.set(None)
+
+        turn['wall_ms'] = (time.perf_counter() - turn.pop('start')) * 1000
+        self.sink.write(turn)
+        return turn
+
+    def add_span(self, kind: str, name: str, duration: float, **fields: Any) -> None:
+        span = {'kind': kind, 'name': name, 'ms': duration * 1000, **fields}
+        turn = self._turn_var.get()
+        with self.lock:
+            if turn is not None:
+                turn['spans'].append(span)
+                return
+        self.sink.write({'turn_id': None, 'time': str(datetime.datetime.now()), 'wall_ms': span['ms'], 'spans': [span]})
+
+    def on_chain_start(self, serialized: dict[str, Any], inputs: Any, *, run_id: UUID, parent_run_id: UUID | None = None,
+                       metadata: dict[str, Any] | None = None, **kwargs: Any) -> None:
+        name = kwargs.get('name') or (serialized or {}).get('name', 'chain')
+        with self.lock:
+            parent_path = self.paths.get(parent_run_id, '') if parent_run_id else ''
+            if parent_run_id is None or (metadata or {}).get('langgraph_node') == name:
+                self.paths[run_id] = f'{parent_path}/{name}' if parent_path else name
+                self.starts[run_id] = time.perf_counter()
+            else:
+                self.paths[run_id] = parent_path
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end_run(run_id, 'node')
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end_run(run_id, 'node', error=type(error).__name__)
+
+    def on_tool_start(self, serialized: dict[str, Any], input_str: str, *, run_id: UUID, parent_run_id: UUID | None = None,
+                      **kwargs: Any) -> None:
+        name = kwargs.get('name') or (serialized or {}).get('name', 'tool')
+        with self.lock:
+            parent_path = self.paths.get(parent_run_id, '') if parent_run_id else ''
+            self.paths[run_id] = f'{parent_path}/{name}' if parent_path else name
+            self.starts[run_id] = time.perf_counter()
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end_run(run_id, 'tool')
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end_run(run_id, 'tool', error=type(error).__name__)
+
+    def on_chat_model_start(self, serialized: dict[str, Any], messages: list[list[BaseMessage]], *, run_id: UUID,
+                            parent_run_id: UUID | None = None, **kwargs: Any) -> None:
+        model = get_model_label(kwargs.get('invocation_params') or {}, kwargs.get('metadata') or {})
+        with self.lock:
+            self.paths[run_id] = self.paths.get(parent_run_id, '') if parent_run_id else ''
+            self.models[run_id] = model
+            self.starts[run_id] = time.perf_counter()
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        with self.lock:
+            self.first_tokens.setdefault(run_id, time.perf_counter())
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        end = time.perf_counter()
+        with self.lock:
+            start = self.starts.pop(run_id, None)
+            path = self.paths.pop(run_id, '')
+            model = self.models.pop(run_id, 'model')
+            first_token = self.first_tokens.pop(run_id, end)
+        if start is None: return
+
+        usage = get_usage(response)
+        self.add_span(
+            'llm', path or 'llm', end - start,
+            model=model,
+            cache_hit=is_cache_hit(response),
+            ttft_ms=(first_token - start) * 1000,
+            input_tokens=usage.get('input_tokens', 0),
+            cached_tokens=get_cached_tokens(usage),
+            output_tokens=usage.get('output_tokens', 0)
+        )
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        with self.lock:
+            start = self.starts.pop(run_id, None)
+            path = self.paths.pop(run_id, '')
+            model = self.models.pop(run_id, 'model')
+            self.first_tokens.pop(run_id, None)
+        if start is not None:
+            self.add_span('llm', path or 'llm', time.perf_counter() - start, model=model, error=type(error).__name__)
+
+    def _end_run(self, run_id: UUID, kind: str, **fields: Any) -> None:
+        with self.lock:
+            start = self.starts.pop(run_id, None)
+            path = self.paths.pop(run_id, '')
+        if start is not None:
+            self.add_span(kind, path, time.perf_counter() - start, **fields)
+
+
+def get_model_label(invocation_params: dict[str, Any], metadata: dict[str, Any]) -> str:
+    name = invocation_params.get('model_name') or invocation_params.get('model') or metadata.get('ls_model_name') or 'model'
+    return f'{metadata["tier"]}:{name}' if metadata.get('tier') else str(name)
+
+def is_cache_hit(response: LLMResult) -> bool:
+    return any(isinstance(g, ChatGeneration) and g.message.response_metadata.get('cache_hit', False) for gs in response.generations for g in gs)
+
+def get_usage(response: LLMResult) -> dict[str, int]:
+    for generations in response.generations:
+        for generation in generations:
+            if isinstance(generation, ChatGeneration) and getattr(generation.message, 'usage_metadata', None):
+                return dict(generation.message.usage_metadata) # type: ignore
+    return (response.llm_output or {}).get('token_usage', {}) or {}
+
+def get_cached_tokens(usage: dict[str, Any]) -> int:
+    # Input tokens served from the vendor's prompt prefix cache.
+    details = usage.get('input_token_details') or usage.get('prompt_tokens_details') or {}
+    return details.get('cache_read', details.get('cached_tokens', 0)) or 0
+
+
+_tracer_var: ContextVar[Optional[TurnTracer]] = ContextVar('turn_tracer', default=None)
+register_configure_hook(_tracer_var, inheritable=True)
+
+def set_tracer(tracer: TurnTracer | None) -> None:
+    _tracer_var.set(tracer)
+
+def get_tracer() -> TurnTracer | None:
+    # Threads started by the turn see the tracer when they run in a copy of its context (see `run_cancellable`).
+    return _tracer_var.get()
+
+def create_tracer(path: str | None) -> TurnTracer | None:
+    tracer = TurnTracer(JsonlSink(path)) if path else None
+    set_tracer(tracer)
+    return tracer
+
+@contextmanager
+def trace_turn(chat_id: str | None, user_input: str | None = None) -> Iterator[None]:
+    tracer = get_tracer()
+    if tracer is None:
+        yield
+        return
+
+    tracer.start_turn(chat_id, user_input)
+    try:
+        yield
+    finally:
+        tracer.end_turn()
+
+def traced(kind: str) -> Callable[[Callable], Callable]:
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            tracer = get_tracer()
+            if tracer is None:
+                return function(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                tracer.add_span(kind, function.__name__, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def percentile(values: list[float], p: float) -> float:
+    if len(values) == 0: return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def load_turns(path: str) -> list[dict[str, Any]]:
+    with open(path, encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+def report(turns: list[dict[str, Any]]) -> str:
+    groups: dict[tuple[str, str], list[dict[str, Any]]] = {}
+    for turn in turns:
+        for span in turn['spans']:
+            groups.setdefault((span['kind'], span['name']), []).append(span)
+            # Model calls are also grouped by model (and tier), to compare the latency of each one.
+            if span['kind'] == 'llm' and 'model' in span:
+                groups.setdefault(('model', span['model']), []).append(span)
+        if turn.get('turn_id'):
+            groups.setdefault(('turn', 'total'), []).append({'ms': turn['wall_ms']})
+
+    lines = [f'{"kind":<6} {"name":<48} {"count":>6} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"ttft p50":>9} {"tokens":>8} {"cached":>7}']
+    for (kind, name), spans in sorted(groups.items()):
+        durations = [s['ms'] for s in spans]
+        ttfts = [s['ttft_ms'] for s in spans if 'ttft_ms' in s]
+        tokens = sum(s.get('input_tokens', 0) + s.get('output_tokens', 0) for s in spans)
+        input_tokens = sum(s.get('input_tokens', 0) for s in spans)
+        cached = f'{100 * sum(s.get("cached_tokens", 0) for s in spans) / input_tokens:.0f}%' if input_tokens else '-'
+        lines.append(
+            f'{kind:<6} {name[-48:]:<48} {len(spans):>6} {percentile(durations, 50):>9.1f} {percentile(durations, 95):>9.1f} '
+            f'{percentile(durations, 99):>9.1f} {(f"{percentile(ttfts, 50):.1f}" if ttfts else "-"):>9} {tokens:>8} {cached:>7}'
+        )
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency breakdown of the traced turns.')
+    parser.add_argument('path', type=str, help='JSONL trace file written with the --trace option.')
+    args = parser.parse_args()
+
+    print(report(load_turns(args.path)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import sys
+from langchain_core.messages import BaseMessage, HumanMessage
+from typing import Callable, TextIO
+
+
+MORE_COMMAND: str = '/more'
+
+MessageFormatter = Callable[[BaseMessage], str | None]
+
+# Reads the page of messages before those loaded, with the number of messages still before it.
+PageLoader = Callable[[], tuple[list[BaseMessage], int]]
+
+
+class TranscriptPager:
+    """
+        Shows a resumed chat from its end, `turns` user turns at a time, so the time to resume does not depend
+        on the length of the chat. Older pages are shown on demand with `/more`, and each page is written at once.
+        With `load_older`, `messages` holds only the end of the chat (after its opening system message), and the
+        `unloaded` older messages are inserted in it a page at a time when `/more` reaches them.
+    """
+
+    def __init__(self, messages: list[BaseMessage], turns: int, format_message: MessageFormatter, output: TextIO | None = None,
+                 load_older: PageLoader | None = None, unloaded: int = 0):
+        self.messages: list[BaseMessage] = messages
+        self.turns: int = turns
+        self.format_message: MessageFormatter = format_message
+        self.output: TextIO | None = output
+        self.load_older: PageLoader | None = load_older
+        self.unloaded: int = unloaded
+        self.end: int = len(messages)
+
+    def show_last(self) -> None:
+        self.end = len(self.messages)
+        self.more(header=False)
+
+    def more(self, header: bool = True) -> bool:
+        output = self.output or sys.stdout
+        # Only the opening system message is left before the shown ones, so the older page goes right after it.
+        if self.load_older is not None and self.unloaded > 0 and not any(isinstance(m, HumanMessage) for m in self.messages[:self.end]):
+            older, self.unloaded = self.load_older()
+            self.messages[self.end:self.end] = older
+            self.end += len(older)
+
+        if self.end == 0:
+            output.write('No earlier messages.\n\n')
+            output.flush()
+            return False
+
+        # Only the messages of the page are visited, searching the start of its first turn from the end.
+        start, found = self.end, 0
+        while start > 0 and found < self.turns:
+            start -= 1
+            if isinstance(self.messages[start], HumanMessage): found += 1
+
+        earlier = start + self.unloaded
+        parts: list[str] = [f'--- {earlier} earlier messages, "{MORE_COMMAND}" shows more ---\n\n'] if earlier > 0 else []
+        if header:
+            parts.insert(0, f'--- Messages {earlier + 1} to {self.end + self.unloaded} ---\n\n')
+        for m in self.messages[start:self.end]:
+            text = self.format_message(m)
+            if text is not None: parts.append(text)
+
+        output.write(''.join(parts))
+        output.flush()
+        self.end = start
+        return True
+
+
+def read_input(prompt: str, pager: TranscriptPager | None = None) -> str:
+    # Ctrl-C (or the end of the input) at the prompt quits, so the chat is still saved.
+    try:
+        user_input = input(prompt)
+        while pager is not None and user_input.strip() == MORE_COMMAND:
+            print(flush=True)
+            pager.more()
+            user_input = input(prompt)
+    except (KeyboardInterrupt, EOFError):
+        print(flush=True)
+        return 'quit'
+    return user_input
@@ -0,0 +1,125 @@
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+from langgraph.graph import MessagesState
+from typing import Any, Callable, NamedTuple
+
+from schemas import ContextOutput, render_context
+
+
+VIEW_CACHE_SIZE: int = 256
+
+
+class MessageView(NamedTuple):
+    """
+        Messages an agent receives from the shared graph state. Besides its own messages and the last user message,
+        the agent sees the previous `history_turns` turns (without tool calls and their results), the handoff that
+        assigned the task to it when `instruction` is set, and the messages of the current turn from the `agents`
+        listed (all of them when `None`). With `context`, the summarized context in the state is also included.
+    """
+    history_turns: int = 0
+    instruction: bool = True
+    agents: tuple[str, ...] | None = ()
+    context: bool = False
+
+
+class ScopedPrompt:
+    """
+        Prompt callable for `create_react_agent` that projects the shared state into the agent's `MessageView`.
+        The agent output is still appended to the shared state, only the messages sent to the model are trimmed.
+        The messages are assembled from the most to the least stable (system prompts, context, older turns and
+        the current turn), and the same message objects are reused, so the vendors can cache the prompt prefix.
+    """
+
+    def __init__(self, agent_name: str, prompt: str, view: MessageView):
+        self.agent_name: str = agent_name
+        self.system_message = SystemMessage(content=prompt)
+        self.view: MessageView = view
+        # The history part of the view only changes between turns, while the agent may call the model many times per turn.
+        self.history_cache: OrderedDict[tuple, list[BaseMessage]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __call__(self, state: MessagesState) -> list[BaseMessage]:
+        messages: list[BaseMessage] = state['messages']
+        turn_start = _turn_start(messages)
+        return [
+            *self.prefix(messages, state.get('context') if self.view.context else None),
+            *self.history(messages[:turn_start]),
+            *self.current_turn(messages[turn_start:])
+        ]
+
+    def prefix(self, messages: list[BaseMessage], context: Any) -> list[BaseMessage]:
+        # The system messages of the conversation are moved before the turns, since they rarely change.
+        prefix: list[BaseMessage] = [self.system_message, *(m for m in messages if isinstance(m, SystemMessage))]
+        if isinstance(context, ContextOutput):
+            prefix.append(context_message(render_context(context)))
+        return prefix
+
+    def history(self, messages: list[BaseMessage]) -> list[BaseMessage]:
+        if not messages: return []
+
+        key = (len(messages), messages[-1].id or id(messages[-1]))
+        with self.lock:
+            if key in self.history_cache:
+                self.history_cache.move_to_end(key)
+                return self.history_cache[key]
+
+        turn_starts = [i for i, m in enumerate(messages) if isinstance(m, HumanMessage)]
+        if self.view.history_turns <= 0:
+            first_turn = len(messages)
+        else:
+            first_turn = turn_starts[-self.view.history_turns] if self.view.history_turns <= len(turn_starts) else 0
+
+        view = [m for m in messages[first_turn:] if _is_visible_answer(m)]
+
+        with self.lock:
+            self.history_cache[key] = view
+            if len(self.history_cache) > VIEW_CACHE_SIZE:
+                self.history_cache.popitem(last=False)
+        return view
+
+    def current_turn(self, messages: list[BaseMessage]) -> list[BaseMessage]:
+        handoff = f'transfer_to_{self.agent_name}'
+        view: list[BaseMessage] = []
+        visible_calls: set[str] = set()
+
+        for m in messages:
+            if isinstance(m, SystemMessage): continue
+            if isinstance(m, ToolMessage):
+                # Tool results are only sent along with the call that requested them.
+                if m.tool_call_id in visible_calls: view.append(m)
+                continue
+
+            if isinstance(m, AIMessage):
+                visible = (
+                    m.name == self.agent_name
+                    or self.view.agents is None
+                    or m.name in self.view.agents
+                    or (self.view.instruction and any(tc['name'] == handoff for tc in m.tool_calls))
+                )
+                if not visible: continue
+                visible_calls.update(tc['id'] for tc in m.tool_calls if tc['id'])
+            view.append(m)
+
+        return view
+
+
+def scoped_prompt(agent_name: str, view: MessageView, prompt: str) -> Callable[[MessagesState], list[BaseMessage]]:
+    return ScopedPrompt(agent_name, prompt, view)
+
+
+@lru_cache(maxsize=64)
+def context_message(rendered_context: str) -> SystemMessage:
+    return SystemMessage(content=f'Current context of the conversation:\n{rendered_context}')
+
+
+def _turn_start(messages: list[BaseMessage]) -> int:
+    for i in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[i], HumanMessage):
+            return i
+    return len(messages)
+
+def _is_visible_answer(message: BaseMessage) -> bool:
+    if isinstance(message, HumanMessage): return True
+    return isinstance(message, AIMessage) and bool(message.content) and not message.tool_calls
@@ -0,0 +1,265 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import time
+import uuid
+from collections import OrderedDict
+from dotenv import load_dotenv
+from langchain_core.messages import AIMessage, HumanMessage
+from typing import Any, Iterator, NamedTuple
+
+from budget import ExecutionBudget, turn_budget
+from chat_config import get_chat_models, load_script, text_colors
+from chat_history import ChatHistory
+from db import init_db, is_turn_saved, shard_of
+from tracing import percentile
+
+
+SCRIPTS: dict[str, str] = {
+    '07': '07_langgraph_structured_routing',
+    '08': '08_langgraph_custom_memory',
+}
+
+# Chat histories kept in memory by each worker, so the next turns of a chat do not read it again.
+SESSION_CACHE_SIZE: int = 256
+
+# Times a request is sent again after its worker dies, before it is reported as failed.
+MAX_ATTEMPTS: int = 2
+
+SAMPLE_PROMPTS: list[str] = [
+    'What are the latest news about the Python programming language?',
+    'How much is 12 plus 30 times 2?',
+    'Who won the last Formula 1 race?',
+    'Subtract 17 from 250 and multiply the result by 3.',
+    'My name is Ana and I am 31 years old. What is the weather like in Sao Paulo today?',
+]
+
+
+class WorkerConfig(NamedTuple):
+    script: str = '08'
+    vendor: str = 'fake'
+    tiers: bool = False
+    db: str = 'chat_history.db'
+    budget: ExecutionBudget = ExecutionBudget()
+
+class TurnRequest(NamedTuple):
+    request_id: int
+    chat_id: str
+    prompt: str
+    turn_id: str
+
+
+def get_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Runs chat turns on a pool of worker processes, each chat always on the same worker.')
+    parser.add_argument('path', type=str, nargs='?', help='JSONL file with one {"chat_id": ..., "prompt": ...} object per line (a sample load by default).')
+    parser.add_argument('-o', '--output', type=str, help='Write the results to this JSONL file.')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('-s', '--script', type=str, choices=list(SCRIPTS), default='08')
+    parser.add_argument('-v', '--vendor', type=str, choices=['openai', 'groq', 'fake', 'failover'], default='fake')
+    parser.add_argument('--tiers', action='store_true', default=False, help='Run the internal hops on a fast model and the answers on a strong one.')
+    parser.add_argument('--db', type=str, default='chat_history.db')
+    parser.add_argument('--sessions', type=int, default=16, help='Chats of the sample load.')
+    parser.add_argument('--turns', type=int, default=5, help='Turns per chat of the sample load.')
+    return parser.parse_args()
+
+
+def worker_main(index: int, config: WorkerConfig, requests: multiprocessing.Queue, results: multiprocessing.Queue) -> None:
+    load_dotenv()
+    script = load_script(SCRIPTS[config.script])
+    conn = init_db(config.db)
+    sessions: OrderedDict[str, ChatHistory] = OrderedDict()
+
+    # The graph nodes print to the standard output, which only the main process uses.
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        graph = script.build_graph(get_chat_models(config.vendor, config.tiers))
+        results.put({'worker': index, 'ready': True})
+        while True:
+            request: TurnRequest | None = requests.get()
+            if request is None: break
+            results.put(run_turn(index, script, graph, conn, sessions, request, config.budget))
+    conn.close()
+
+def run_turn(index: int, script: Any, graph: Any, conn: Any, sessions: OrderedDict[str, ChatHistory],
+             request: TurnRequest, budget: ExecutionBudget) -> dict[str, Any]:
+    start = time.perf_counter()
+    error = None
+    answers: list[AIMessage] = []
+
+    with turn_budget(budget) as usage:
+        try:
+            chat_history = sessions.pop(request.chat_id, None) or ChatHistory(request.chat_id, conn)
+            sessions[request.chat_id] = chat_history
+            if len(sessions) > SESSION_CACHE_SIZE:
+                sessions.popitem(last=False)
+
+            # A turn sent again after its worker died may have been saved already, then its answer is the stored one.
+            if is_turn_saved(conn, request.chat_id, request.turn_id):
+                first = max((i for i, m in enumerate(chat_history.messages) if isinstance(m, HumanMessage) and m.content == request.prompt), default=len(chat_history.messages))
+            else:
+                first = len(chat_history.messages)
+                chat_history.add_message(HumanMessage(content=request.prompt))
+                script.query_llm(graph, chat_history)
+                chat_history.save_turn(request.turn_id)
+            answers = [m for m in chat_history.messages[first:] if isinstance(m, AIMessage) and m.content and not m.tool_calls]
+        except Exception as e:
+            # The chat is read again on its next turn, in case its history was left halfway.
+            sessions.pop(request.chat_id, None)
+            error = f'{type(e).__name__}: {e}'
+
+    return {
+        'request_id': request.request_id,
+        'chat_id': request.chat_id,
+        'worker': index,
+        'answer': str(answers[-1].content) if answers else None,
+        'error': error,
+        'ms': (time.perf_counter() - start) * 1000,
+        'model_calls': usage.model_calls,
+        'tokens': usage.tokens,
+    }
+
+
+class WorkerPool:
+    """
+        Pool of worker processes, each one with its own compiled graph, models and database connection.
+        The turns of a chat always go to the same worker (by the hash of the chat id), where they run in order and
+        its history stays in memory. Dead workers are restarted, and their pending turns sent to them again.
+    """
+
+    def __init__(self, workers: int, config: WorkerConfig):
+        self.config: WorkerConfig = config
+        self.context = multiprocessing.get_context('spawn')
+        self.results: multiprocessing.Queue = self.context.Queue()
+        self.queues: list[multiprocessing.Queue] = []
+        self.processes: list[Any] = []
+        self.pending: list[OrderedDict[int, TurnRequest]] = [OrderedDict() for _ in range(workers)]
+        self.attempts: dict[int, int] = {}
+        self.next_id: int = 0
+        self.restarts: int = 0
+        self.latencies: list[float] = []
+        self.turns: list[int] = [0] * workers
+        self.errors: int = 0
+        for index in range(workers):
+            self.queues.append(self.context.Queue())
+            self.processes.append(self._start(index))
+
+        # The throughput is measured once all the workers have loaded their graphs.
+        ready: set[int] = set()
+        while len(ready) < workers:
+            try:
+                ready.add(self.results.get(timeout=1.0)['worker'])
+            except queue.Empty:
+                failed = [i for i, p in enumerate(self.processes) if i not in ready and not p.is_alive()]
+                if failed:
+                    self.close()
+                    raise RuntimeError(f'Worker {failed[0]} exited with code {self.processes[failed[0]].exitcode} while starting.')
+        self.started: float = time.perf_counter()
+
+    def submit(self, chat_id: str, prompt: str) -> int:
+        request = TurnRequest(self.next_id, chat_id, prompt, uuid.uuid4().hex)
+        self.next_id += 1
+        worker = shard_of(chat_id, len(self.processes))
+        self.pending[worker][request.request_id] = request
+        self.queues[worker].put(request)
+        return request.request_id
+
+    def as_completed(self) -> Iterator[dict[str, Any]]:
+        while any(self.pending):
+            try:
+                result = self.results.get(timeout=1.0)
+            except queue.Empty:
+                yield from self._supervise()
+                continue
+
+            if result.get('ready'): continue
+            if self.pending[result['worker']].pop(result['request_id'], None) is None: continue
+            self.latencies.append(result['ms'])
+            self.turns[result['worker']] += 1
+            self.errors += 1 if result['error'] else 0
+            yield result
+
+    def stats(self) -> dict[str, Any]:
+        elapsed = time.perf_counter() - self.started
+        return {
+            'workers': len(self.processes),
+            'turns': sum(self.turns),
+            'turns_per_worker': self.turns,
+            'errors': self.errors,
+            'restarts': self.restarts,
+            'seconds': elapsed,
+            'turns_per_second': sum(self.turns) / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(self.latencies, 50),
+            'p95_ms': percentile(self.latencies, 95),
+        }
+
+    def close(self) -> None:
+        for requests in self.queues:
+            requests.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive(): process.terminate()
+
+    def _start(self, index: int) -> Any:
+        process = self.context.Process(target=worker_main, args=(index, self.config, self.queues[index], self.results), daemon=True)
+        process.start()
+        return process
+
+    def _supervise(self) -> Iterator[dict[str, Any]]:
+        for index, process in enumerate(self.processes):
+            if process.is_alive() or not self.pending[index]: continue
+
+            # The first pending turn was running when the worker died, it fails after `MAX_ATTEMPTS` tries.
+            self.restarts += 1
+            request_id, request = next(iter(self.pending[index].items()))
+            self.attempts[request_id] = self.attempts.get(request_id, 1) + 1
+            if self.attempts[request_id] > MAX_ATTEMPTS:
+                del self.pending[index][request_id]
+                self.errors += 1
+                yield {'request_id': request_id, 'chat_id': request.chat_id, 'worker': index, 'answer': None,
+                       'error': f'Worker exited with code {process.exitcode}.', 'ms': 0.0, 'model_calls': 0, 'tokens': 0}
+
+            self.queues[index] = self.context.Queue()
+            for pending in self.pending[index].values():
+                self.queues[index].put(pending)
+            self.processes[index] = self._start(index)
+
+
+def load_requests(path: str | None, sessions: int, turns: int) -> list[tuple[str, str]]:
+    if path is None:
+        chat_ids = [str(uuid.uuid4()) for _ in range(sessions)]
+        return [(chat_id, SAMPLE_PROMPTS[(i + turn) % len(SAMPLE_PROMPTS)]) for turn in range(turns) for i, chat_id in enumerate(chat_ids)]
+
+    # Lines without a chat id start a new chat each.
+    with open(path, encoding='utf-8') as file:
+        items = [json.loads(line) for line in file if line.strip()]
+    return [(item.get('chat_id') or str(uuid.uuid4()), item['prompt']) for item in items]
+
+
+def main():
+    load_dotenv()
+    args = get_arguments()
+    requests = load_requests(args.path, args.sessions, args.turns)
+
+    print(f'{text_colors["yellow2"]}Running {len(requests)} turns on {args.workers} workers.{text_colors["normal"]}')
+    pool = WorkerPool(args.workers, WorkerConfig(args.script, args.vendor, args.tiers, args.db))
+    output = open(args.output, 'w', encoding='utf-8') if args.output else None
+    try:
+        for chat_id, prompt in requests:
+            pool.submit(chat_id, prompt)
+        for done, result in enumerate(pool.as_completed(), start=1):
+            if output is not None:
+                output.write(json.dumps(result) + '\n')
+            if result['error']:
+                print(f'[{done}/{len(requests)}] {result["chat_id"]}: {result["error"]}', file=sys.stderr)
+    finally:
+        pool.close()
+        if output is not None: output.close()
+
+    print(f'{text_colors["yellow2"]}{json.dumps(pool.stats())}{text_colors["normal"]}')
+
+
+if __name__ == '__main__':
+    main()
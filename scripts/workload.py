@@ -0,0 +1,187 @@
+import argparse
+import contextlib
+import datetime
+import hashlib
+import os
+import re
+import secrets
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.messages import BaseMessage, HumanMessage
+from typing import Any
+from uuid import UUID
+
+from benchmark import CHAT_SETUPS, SCRIPTS
+from chat_config import load_script, text_colors
+from chat_history import ChatHistory
+from db import init_db
+from fake_model import FakeChatModel, fake_search
+from tools import set_search_backend
+from tracing import JsonlSink, TurnTracer, load_turns, percentile, set_tracer
+
+
+WORD_PATTERN = re.compile(r'[^\W\d_]+')
+NUMBER_PATTERN = re.compile(r'\d+')
+NUMBER_PLACEHOLDER: str = '9'
+ROUTER_FUNCTION: str = 'router'
+ROUTER_TOOL: str = 'RouterOutput'
+
+
+def anonymize(text: str, salt: str) -> str:
+    # Words are replaced by stable lowercase pseudo-words whose length comes from the hash and not from the word,
+    # and every digit is masked, while operators and punctuation are kept, so repeated prompts stay identical
+    # and math questions still look like math questions.
+    def pseudo_word(match: re.Match) -> str:
+        digest = hashlib.blake2b(f'{salt}{match.group(0).lower()}'.encode('utf-8'), digest_size=32).digest()
+        return ''.join(chr(ord('a') + b % 26) for b in digest[1:])[:3 + digest[0] % 8]
+
+    text = NUMBER_PATTERN.sub(lambda match: NUMBER_PLACEHOLDER * len(match.group(0)), text)
+    return WORD_PATTERN.sub(pseudo_word, text)
+
+def anonymize_id(value: str, salt: str) -> str:
+    # Ids are replaced whole by their hash, since masking their digits would merge the ids that differ only there.
+    return hashlib.blake2b(f'{salt}{value}'.encode('utf-8'), digest_size=16).hexdigest() if value else ''
+
+
+class WorkloadRecorder(TurnTracer):
+    """
+        Turn tracer that also records the anonymized user message and the routing decision of each turn,
+        so the trace can be replayed with `python workload.py`.
+    """
+
+    def __init__(self, sink: JsonlSink, salt: str | None = None):
+        super().__init__(sink)
+        # Without a salt, a random one is drawn for this recording and never written, so its pseudo-words
+        # cannot be reversed by hashing a dictionary, nor matched against those of other recordings.
+        self.salt: str = salt or secrets.token_hex(16)
+        self.router_runs: set[UUID] = set()
+
+    def start_turn(self, chat_id: str | None, user_input: str | None = None) -> None:
+        super().start_turn(anonymize_id(chat_id or '', self.salt), user_input)
+        if self.turn is not None:
+            self.turn['input'] = anonymize(user_input or '', self.salt)
+            self.turn['route'] = None
+
+    def on_chain_start(self, serialized: dict[str, Any], inputs: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        super().on_chain_start(serialized, inputs, run_id=run_id, **kwargs)
+        if kwargs.get('name') == ROUTER_FUNCTION:
+            with self.lock:
+                self.router_runs.add(run_id)
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        super().on_chain_end(outputs, run_id=run_id, **kwargs)
+        with self.lock:
+            if run_id not in self.router_runs: return
+            self.router_runs.discard(run_id)
+        turn = self.turn
+        if turn is not None and isinstance(outputs, str):
+            turn['route'] = outputs
+
+
+def create_recorder(path: str) -> WorkloadRecorder:
+    recorder = WorkloadRecorder(JsonlSink(path), os.environ.get('WORKLOAD_SALT'))
+    set_tracer(recorder)
+    return recorder
+
+
+def summarize_latencies(turns: list[dict[str, Any]], kind: str, name: str | None = None) -> float:
+    durations = [
+        span['ms'] for turn in turns for span in turn['spans']
+        if span['kind'] == kind and (name is None or span['name'].split('/')[-1] == name)
+    ]
+    return statistics.mean(durations) / 1000 if durations else 0.0
+
+def create_route_arguments(script: Any, turns: list[dict[str, Any]]):
+    routes: dict[str, str] = {turn['input']: turn['route'] for turn in turns if turn.get('route')}
+    systems = list(getattr(script, 'ChatbotSystems', []))
+
+    def route_arguments(messages: list[BaseMessage]) -> dict[str, Any]:
+        # The recorded route may come from another script (e.g. `research_subgraph` replayed on the
+        # `research_supervisor` of script 07), so it is matched by its prefix.
+        recorded = routes.get(str(messages[-1].content), '')
+        decision = next((s.value for s in systems if s.value.split('_')[0] == recorded.split('_')[0]), None)
+        return {'reason': 'Replayed decision.', **({'decision': decision} if decision else {})}
+
+    return route_arguments
+
+
+def replay(turns: list[dict[str, Any]], script_name: str, concurrency: int, speedup: float, keep_timing: bool) -> list[float]:
+    turns = [turn for turn in turns if turn.get('input') is not None]
+    output_tokens = [span.get('output_tokens', 0) for turn in turns for span in turn['spans'] if span['kind'] == 'llm']
+    set_search_backend(fake_search(summarize_latencies(turns, 'tool', 'web_search') / speedup))
+    script = load_script(SCRIPTS[script_name])
+    model = FakeChatModel(
+        latency=summarize_latencies(turns, 'llm') / speedup,
+        answer_tokens=max(1, int(statistics.median(output_tokens))) if output_tokens else 20,
+        tool_args={ROUTER_TOOL: create_route_arguments(script, turns)}
+    )
+    turn_function = CHAT_SETUPS[script_name](model)
+
+    sessions: dict[str, list[dict[str, Any]]] = {}
+    for turn in turns:
+        sessions.setdefault(turn.get('chat_id') or '', []).append(turn)
+    trace_start = min((_turn_time(turn) for turn in turns), default=0.0)
+
+    latencies: list[float] = []
+    lock = threading.Lock()
+
+    with tempfile.TemporaryDirectory() as directory:
+        replay_start = time.perf_counter()
+
+        def run_session(index: int, session: list[dict[str, Any]]) -> None:
+            conn = init_db(os.path.join(directory, f'replay_{index}.db'))
+            chat_history = ChatHistory(None, conn) # type: ignore
+            for turn in session:
+                if keep_timing:
+                    delay = (_turn_time(turn) - trace_start) / speedup - (time.perf_counter() - replay_start)
+                    if delay > 0: time.sleep(delay)
+
+                start = time.perf_counter()
+                chat_history.add_message(HumanMessage(content=turn['input']))
+                turn_function(chat_history)
+                chat_history.save_messages()
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+            conn.close()
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = [executor.submit(run_session, i, session) for i, session in enumerate(sessions.values())]
+                for future in futures:
+                    future.result()
+
+    return latencies
+
+
+def _turn_time(turn: dict[str, Any]) -> float:
+    return datetime.datetime.fromisoformat(turn['time']).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays a recorded workload against stubbed models and tools.')
+    parser.add_argument('path', type=str, help='JSONL workload written with the --record option.')
+    parser.add_argument('-s', '--script', type=str, choices=list(SCRIPTS), default='08')
+    parser.add_argument('-c', '--concurrency', type=int, default=1, help='Sessions replayed in parallel.')
+    parser.add_argument('-x', '--speedup', type=float, default=1.0, help='Divides the recorded latencies and think times.')
+    parser.add_argument('--no-timing', action='store_true', default=False, help='Replay the turns back to back.')
+    args = parser.parse_args()
+
+    turns = [turn for turn in load_turns(args.path) if turn.get('input') is not None]
+    recorded = [turn['wall_ms'] / 1000 for turn in turns]
+
+    start = time.perf_counter()
+    replayed = replay(turns, args.script, args.concurrency, args.speedup, not args.no_timing)
+    elapsed = time.perf_counter() - start
+
+    print(f'{"":<10} {"turns":>6} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9}')
+    for label, values in [('recorded', recorded), ('replayed', replayed)]:
+        print(f'{label:<10} {len(values):>6} {percentile(values, 50) * 1000:>9.1f} {percentile(values, 95) * 1000:>9.1f} {percentile(values, 99) * 1000:>9.1f}')
+    print(f'{text_colors["yellow2"]}Replay throughput: {len(replayed) / elapsed:.2f} turns/s '
+          f'({args.concurrency} concurrent sessions, {args.speedup}x speed-up){text_colors["normal"]}')
+
+
+if __name__ == '__main__':
+    main()